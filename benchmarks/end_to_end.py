@@ -0,0 +1,265 @@
+"""
+Runs the invoker and consent code handlers end to end against local
+stand-ins for the dataservice and dbGaP, and reports throughput, requests
+per record, peak memory and latencies.
+
+Lambda invocations are run in this process: the invoker's invocations of
+the consent code function call `service.handler` directly. With
+`--runner cli` the studies are run by the command line runner instead, and
+with `--in-process` the invoker sends every study itself instead of
+invoking itself for each study.
+
+Usage:
+    python benchmarks/end_to_end.py --studies 2 --samples 5000 \\
+        --latency 0.005 --output bench.json
+    python benchmarks/end_to_end.py --studies 2 --samples 5000 \\
+        --latency 0.005 --baseline bench.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_dataservice import FakeDataservice  # noqa: E402
+from fake_dbgap import FakeDbGaP, make_samples  # noqa: E402
+from fake_server import serve_in_subprocess  # noqa: E402
+
+INVOKER = 'kf-lambda-dbgap-consent-invoker'
+CONSENT = 'kf-lambda-dbgap-consent-updater'
+
+
+class LocalContext:
+    """
+    A lambda context without a deadline
+    """
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+class LocalLambda:
+    """
+    A lambda client that runs the invoked handler in this process and keeps
+    the responses
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.responses = []
+        self.lock = threading.Lock()
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        event = json.loads(Payload)
+        res = self.handlers[FunctionName](event, LocalContext(FunctionName))
+        with self.lock:
+            self.responses.append((FunctionName, res))
+        return {'StatusCode': 202}
+
+
+def make_studies(count, samples):
+    rows = make_samples(samples)
+    return [{'external_id': 'phs{:06}'.format(900000 + i),
+             'kf_id': 'SD_{:08}'.format(i),
+             'version': 'v1.p1',
+             'accession': 'phs{:06}.v1.p1'.format(900000 + i),
+             'samples': rows} for i in range(count)]
+
+
+def server_stats(url):
+    with urlopen(url + '/_stats') as resp:
+        return json.loads(resp.read())
+
+
+def run_once(invoker, service, metrics, ds_url, dbgap_url, in_process=False):
+    """
+    Runs the invoker for every study and totals the results of every
+    function that was invoked
+    """
+    lam = LocalLambda({INVOKER: invoker.handler, CONSENT: service.handler})
+    ds_before = server_stats(ds_url)['requests']
+    dbgap_before = server_stats(dbgap_url)['requests']
+    start = time.monotonic()
+    with patch('boto3.client', return_value=lam), \
+            open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        invoker.handler({'in_process': in_process}, LocalContext(INVOKER))
+    elapsed = time.monotonic() - start
+
+    total = metrics.Metrics()
+    statuses = {}
+    for function, res in lam.responses:
+        if isinstance(res, dict) and 'metrics' in res:
+            total.add_summary(res['metrics'])
+        if function == CONSENT:
+            for result in res['results']:
+                statuses[result['status']] = (
+                    statuses.get(result['status'], 0) + 1)
+    records = sum(statuses.values())
+    requests = server_stats(ds_url)['requests'] - ds_before
+    summary = total.summary()
+    return {
+        'seconds': round(elapsed, 3),
+        'records': records,
+        'statuses': statuses,
+        'records_per_second': round(records / elapsed, 1),
+        'dataservice_requests': requests,
+        'requests_per_record': round(requests / records, 3) if records else 0,
+        'dbgap_requests': server_stats(dbgap_url)['requests'] - dbgap_before,
+        'invocations': sum(1 for f, _ in lam.responses if f == CONSENT),
+        'peak_rss_mb': round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'latency': {name: {'count': hist['count'], 'p50_ms': hist['p50_ms'],
+                           'p99_ms': hist['p99_ms']}
+                    for name, hist in sorted(summary['latency'].items())},
+        'counts': summary['counts']
+    }
+
+
+def run_cli_once(cli, ds_url, dbgap_url, jobs=1):
+    """
+    Runs every study with the command line runner
+    """
+    ds_before = server_stats(ds_url)['requests']
+    dbgap_before = server_stats(dbgap_url)['requests']
+    start = time.monotonic()
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        res = cli.run(None, ds_url, jobs=jobs, quiet=True)
+    elapsed = time.monotonic() - start
+
+    statuses = {}
+    for study in res['studies']:
+        for status, count in study['statuses'].items():
+            statuses[status] = statuses.get(status, 0) + count
+    records = sum(statuses.values())
+    requests = server_stats(ds_url)['requests'] - ds_before
+    return {
+        'seconds': round(elapsed, 3),
+        'records': records,
+        'statuses': statuses,
+        'records_per_second': round(records / elapsed, 1),
+        'dataservice_requests': requests,
+        'requests_per_record': round(requests / records, 3) if records else 0,
+        'dbgap_requests': server_stats(dbgap_url)['requests'] - dbgap_before,
+        'invocations': 0,
+        'peak_rss_mb': round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'latency': {name: {'count': hist['count'], 'p50_ms': hist['p50_ms'],
+                           'p99_ms': hist['p99_ms']}
+                    for name, hist in sorted(
+                        res['metrics']['latency'].items())},
+        'counts': res['metrics']['counts']
+    }
+
+
+def report(run, baseline=None):
+    keys = ['seconds', 'records', 'records_per_second',
+            'dataservice_requests', 'requests_per_record', 'dbgap_requests',
+            'invocations', 'peak_rss_mb']
+    for key in keys:
+        line = f'  {key:<22} {run[key]:>12}'
+        if baseline and baseline.get(key):
+            change = (run[key] - baseline[key]) / baseline[key] * 100
+            line += f'  ({change:+.1f}% vs baseline {baseline[key]})'
+        print(line)
+    print('  statuses', json.dumps(run['statuses']))
+    print(f'  {"latency":<30} {"count":>8} {"p50 ms":>10} {"p99 ms":>10}')
+    for name, hist in run['latency'].items():
+        print(f'  {name:<30} {hist["count"]:>8} {hist["p50_ms"]:>10.1f} '
+              f'{hist["p99_ms"]:>10.1f}')
+
+
+def main(args):
+    studies = make_studies(args.studies, args.samples)
+    ds_url, ds = serve_in_subprocess(
+        FakeDataservice, studies=studies, latency=args.latency,
+        error_rate=args.error_rate, files_per_sample=args.files_per_sample,
+        changed=args.changed, bulk=not args.no_bulk)
+    dbgap_url, dbgap = serve_in_subprocess(
+        FakeDbGaP, studies=studies, latency=args.latency)
+
+    state = tempfile.TemporaryDirectory() if args.runs > 1 else None
+    os.environ.update({'DATASERVICE': ds_url, 'FUNCTION': CONSENT,
+                       'DBGAP_URL': dbgap_url})
+    os.environ.pop('STATE_BUCKET', None)
+    os.environ.pop('STATE_DIR', None)
+    if state is not None:
+        os.environ['STATE_DIR'] = state.name
+
+    # The handlers read their settings when they are imported
+    import cli
+    import invoker
+    import metrics
+    import service
+
+    print(f'{args.studies} studies of {args.samples} samples, '
+          f'{args.files_per_sample} files per sample, {args.changed:.0%} '
+          f'changed, {args.latency*1000:.0f}ms latency, '
+          f'{args.error_rate:.0%} errors')
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    runs = []
+    try:
+        for n in range(args.runs):
+            if args.runner == 'cli':
+                run = run_cli_once(cli, ds_url, dbgap_url, jobs=args.jobs)
+            else:
+                run = run_once(invoker, service, metrics, ds_url, dbgap_url,
+                               in_process=args.in_process)
+            runs.append(run)
+            print(f'run {n+1}:')
+            report(run, baseline[n] if baseline and n < len(baseline)
+                   else None)
+    finally:
+        ds.terminate()
+        dbgap.terminate()
+        if state is not None:
+            state.cleanup()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(runs, f, indent=2)
+    return runs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--studies', type=int, default=1)
+    parser.add_argument('--samples', type=int, default=2000,
+                        help='samples in each study')
+    parser.add_argument('--files-per-sample', type=int, default=2)
+    parser.add_argument('--changed', type=float, default=1.0,
+                        help='fraction of samples that need to be updated')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='seconds each fake service takes to respond')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of dataservice requests that fail')
+    parser.add_argument('--no-bulk', action='store_true',
+                        help='the fake dataservice rejects bulk updates')
+    parser.add_argument('--runner', choices=['lambda', 'cli'],
+                        default='lambda',
+                        help='run the studies through the lambda handlers or '
+                             'the command line runner')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='studies the command line runner runs at once')
+    parser.add_argument('--in-process', action='store_true',
+                        help='the invoker sends every study itself')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='runs to make, keeping state between them')
+    parser.add_argument('--output', help='file to save the results to')
+    parser.add_argument('--baseline',
+                        help='results of an earlier run to compare to')
+    main(parser.parse_args())
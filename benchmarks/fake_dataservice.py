@@ -0,0 +1,145 @@
+"""
+A local stand-in for the dataservice api used by the benchmarks
+
+Serves the studies, biospecimens and genomic files that the consent code
+functions read and update. Listings are paginated with `limit` and `offset`
+and link to their next page like the dataservice does.
+"""
+import random
+
+from fake_server import FakeServer
+
+
+class FakeDataservice(FakeServer):
+    """
+    Serves studies with a biospecimen for each sample and
+    `files_per_sample` genomic files for each biospecimen
+
+    Biospecimens and genomic files start with the consent codes and acls of
+    their sample, except for a fraction `changed` of the samples which start
+    without any so that they need to be updated.
+
+    :param studies: A list of dicts with the `external_id`, `kf_id`,
+        `version` and `samples` of each study
+    :param files_per_sample: The number of genomic files of each biospecimen
+    :param changed: The fraction of samples that need to be updated
+    :param bulk: Whether bulk updates are accepted, as a PATCH of a list of
+        entities to an entity's endpoint
+    """
+
+    def __init__(self, studies=(), files_per_sample=2, changed=1.0,
+                 bulk=True, **kwargs):
+        super().__init__(**kwargs)
+        self.bulk = bulk
+        rand = random.Random(kwargs.get('seed', 0))
+        self.studies = []
+        self.biospecimens = {}
+        self.genomic_files = {}
+        self.links = []
+        self.biospecimen_files = {}
+        # Biospecimens by external sample id, so that looking up a sample
+        # does not scan every biospecimen, as the dataservice's index avoids
+        self.sample_biospecimens = {}
+        # Results of each listing, so pages after the first are not filtered
+        # again. Entities are never added or removed after they are made.
+        self.listings = {}
+        for study in studies:
+            self.studies.append({'kf_id': study['kf_id'],
+                                 'external_id': study['external_id'],
+                                 'version': study['version']})
+            dbgap_id = study['external_id']
+            for sample_id, consent_code, consent_name in study['samples']:
+                bs_id = 'BS_{:08}'.format(len(self.biospecimens))
+                stale = rand.random() < changed
+                consent = f'{dbgap_id}.c{consent_code}'
+                self.biospecimens[bs_id] = {
+                    'kf_id': bs_id,
+                    'study_id': study['kf_id'],
+                    'external_sample_id': sample_id,
+                    'dbgap_consent_code': None if stale else consent,
+                    'consent_type': None if stale else consent_name,
+                    'visible': True
+                }
+                self.sample_biospecimens.setdefault(sample_id, []).append(
+                    self.biospecimens[bs_id])
+                for _ in range(files_per_sample):
+                    gf_id = 'GF_{:08}'.format(len(self.genomic_files))
+                    self.genomic_files[gf_id] = {
+                        'kf_id': gf_id,
+                        'study_id': study['kf_id'],
+                        'acl': ([] if stale else
+                                [consent, dbgap_id, study['kf_id']]),
+                        'visible': True
+                    }
+                    self.links.append({'biospecimen_id': bs_id,
+                                       'genomic_file_id': gf_id,
+                                       'study_id': study['kf_id']})
+                    self.biospecimen_files.setdefault(bs_id, []).append(
+                        self.genomic_files[gf_id])
+
+    def respond(self, method, path, query, body):
+        parts = path.strip('/').split('/')
+        entities = {
+            'studies': self.studies,
+            'biospecimens': self.biospecimens,
+            'genomic-files': self.genomic_files,
+            'biospecimen-genomic-files': self.links
+        }
+        if parts[0] not in entities:
+            return 404, {'_status': {'code': 404}}, {}
+        if len(parts) == 2:
+            return self.entity(method, entities[parts[0]], parts[1], body)
+        if method == 'PATCH' and self.bulk and isinstance(body, list):
+            return self.bulk_update(entities[parts[0]], body)
+        if method != 'GET':
+            return 405, {'_status': {'code': 405}}, {}
+        return self.listing(path, entities[parts[0]], query)
+
+    def bulk_update(self, entities, body):
+        errors = []
+        for change in body:
+            change = dict(change)
+            kf_id = change.pop('kf_id', None)
+            if not isinstance(entities, dict) or kf_id not in entities:
+                errors.append({'kf_id': kf_id, 'message': 'not found'})
+            else:
+                entities[kf_id].update(change)
+        return (207 if errors else 200), {'errors': errors}, {}
+
+    def entity(self, method, entities, kf_id, body):
+        if not isinstance(entities, dict) or kf_id not in entities:
+            return 404, {'_status': {'code': 404}}, {}
+        if method == 'PATCH':
+            entities[kf_id].update(body or {})
+        return 200, {'results': entities[kf_id]}, {}
+
+    def listing(self, path, entities, query):
+        if isinstance(entities, dict):
+            entities = entities.values()
+        if 'biospecimen_id' in query and path == '/genomic-files':
+            entities = self.biospecimen_files.get(query['biospecimen_id'], [])
+        if 'external_sample_id' in query and path == '/biospecimens':
+            entities = self.sample_biospecimens.get(
+                query['external_sample_id'], [])
+        filters = {k: v for k, v in query.items()
+                   if k not in ['limit', 'offset', 'biospecimen_id',
+                                '_headers']}
+        key = (path, query.get('biospecimen_id'),
+               tuple(sorted(filters.items())))
+        if key not in self.listings:
+            self.listings[key] = [
+                e for e in entities
+                if all(e.get(k) == v for k, v in filters.items())]
+        results = self.listings[key]
+        limit = int(query.get('limit', 10))
+        offset = int(query.get('offset', 0))
+        page = {'results': results[offset:offset+limit],
+                'total': len(results),
+                '_links': {}}
+        if offset + limit < len(results):
+            params = dict(filters, limit=limit, offset=offset+limit)
+            if 'biospecimen_id' in query:
+                params['biospecimen_id'] = query['biospecimen_id']
+            page['_links']['next'] = path + '?' + '&'.join(
+                f'{k}={v}' for k, v in params.items())
+        return 200, page, {}
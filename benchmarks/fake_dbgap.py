@@ -0,0 +1,86 @@
+"""
+A local stand-in for dbGaP's GetSampleStatus
+
+Studies are served as xml scaled up from the samples in
+`tests/test_study.xml`, with the same attributes for every sample.
+"""
+import hashlib
+import os
+import xml.etree.ElementTree as ET
+
+from fake_server import FakeServer
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tests', 'test_study.xml')
+
+
+def template_samples():
+    """
+    Returns the attributes of every sample in the test study
+    """
+    root = ET.parse(TEMPLATE).getroot()
+    return [dict(s.attrib) for s in root.iter('Sample')]
+
+
+def make_samples(count):
+    """
+    Returns `count` sample tuples (sample_id, consent_code, consent_name),
+    repeating the samples of the test study with new ids as needed
+    """
+    template = template_samples()
+    samples = []
+    for n in range(count):
+        attrs = template[n % len(template)]
+        sample_id = attrs['submitted_sample_id']
+        if n >= len(template):
+            sample_id += '-{}'.format(n // len(template))
+        samples.append((sample_id, attrs['consent_code'],
+                        attrs['consent_short_name']))
+    return samples
+
+
+def study_xml(accession, samples):
+    """
+    Builds the GetSampleStatus xml for a study with the given samples
+    """
+    template = template_samples()
+    root = ET.Element('DbGap')
+    study = ET.SubElement(root, 'Study', accession=accession,
+                          registration_status='released')
+    sample_list = ET.SubElement(study, 'SampleList')
+    for n, (sample_id, consent_code, consent_name) in enumerate(samples):
+        attrs = dict(template[n % len(template)])
+        attrs.update(submitted_sample_id=sample_id,
+                     consent_code=consent_code,
+                     consent_short_name=consent_name)
+        sample = ET.SubElement(sample_list, 'Sample', attrs)
+        for tag in ['Aliases', 'Uses', 'SRAData']:
+            ET.SubElement(sample, tag)
+    return ET.tostring(root, encoding='utf-8')
+
+
+class FakeDbGaP(FakeServer):
+    """
+    Serves the xml of each study, answering conditional requests with a 304
+    if the xml has not changed
+
+    :param studies: A list of dicts with the `accession` and `samples` of
+        each study
+    """
+
+    def __init__(self, studies=(), **kwargs):
+        super().__init__(**kwargs)
+        self.studies = {s['accession']: s['samples'] for s in studies}
+        self.xml = {}
+
+    def respond(self, method, path, query, body):
+        accession = query.get('study_id')
+        if accession not in self.studies:
+            return 404, b'', {}
+        if accession not in self.xml:
+            xml = study_xml(accession, self.studies[accession])
+            self.xml[accession] = (xml, hashlib.md5(xml).hexdigest())
+        xml, etag = self.xml[accession]
+        if query['_headers'].get('If-None-Match') == etag:
+            return 304, b'', {}
+        return 200, xml, {'Content-Type': 'text/xml', 'ETag': etag}
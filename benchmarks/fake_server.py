@@ -0,0 +1,146 @@
+"""
+The base of the local stand-ins for the services used by the benchmarks
+"""
+import json
+import multiprocessing
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakeServer:
+    """
+    Serves a fake api on a local port from a background thread
+
+    Every request waits `latency` seconds before it is answered, and a
+    fraction `error_rate` of requests are answered with a 503. The time of
+    each request is recorded, and the number of requests for each endpoint
+    can be requested from `/_stats`.
+
+    Subclasses implement `respond`.
+
+    :param latency: Seconds to wait before answering each request
+    :param error_rate: The fraction of requests that fail
+    :param seed: Seeds the choice of which requests fail
+    """
+
+    def __init__(self, latency=0, error_rate=0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = []
+        self.endpoints = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          self.handler_class())
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, method, path):
+        """
+        Records a request and decides whether it should fail
+        """
+        name = '{} {}'.format(method, urlparse(path).path.split('/')[1])
+        with self.lock:
+            self.requests.append((time.monotonic(), method, path))
+            self.endpoints[name] = self.endpoints.get(name, 0) + 1
+            return self.random.random() < self.error_rate
+
+    def stats(self):
+        with self.lock:
+            return {'requests': len(self.requests),
+                    'endpoints': dict(self.endpoints)}
+
+    def respond(self, method, path, query, body):
+        """
+        Answers a request
+
+        :param path: The path of the request without the query string
+        :param query: A dict of the first value of each query parameter
+        :param body: The json body of the request, if there was one
+        :returns: A tuple of the status code, the body and a dict of headers.
+            A body that is not bytes is encoded as json.
+        """
+        raise NotImplementedError
+
+    def handler_class(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                url = urlparse(self.path)
+                if url.path == '/_stats':
+                    return self.send(200, service.stats(), {})
+                failed = service.record(self.command, self.path)
+                if service.latency:
+                    time.sleep(service.latency)
+                if failed:
+                    return self.send(503, {'_status': {'code': 503}}, {})
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                query['_headers'] = self.headers
+                self.send(*service.respond(self.command, url.path, query,
+                                           body))
+
+            def send(self, status, body, headers):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode('utf-8')
+                    headers.setdefault('Content-Type', 'application/json')
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = handle_request
+            do_PATCH = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def _serve(factory, kwargs, urls):
+    with factory(**kwargs) as server:
+        urls.put(server.url)
+        server.thread.join()
+
+
+def serve_in_subprocess(factory, **kwargs):
+    """
+    Runs a fake server in its own process so that its memory and cpu are
+    not counted against the code being measured
+
+    :returns: The url of the server and the process running it
+    """
+    urls = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve,
+                                      args=(factory, kwargs, urls),
+                                      daemon=True)
+    process.start()
+    return urls.get(timeout=30), process
@@ -0,0 +1,72 @@
+"""
+Shows that the dataservice client holds its write rate at the configured
+limit no matter how many threads are sending requests.
+
+Usage:
+    python benchmarks/rate_limit.py --write-rate 50 --threads 16 --seconds 5
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dataservice import DataserviceClient  # noqa: E402
+from fake_dataservice import FakeDataservice  # noqa: E402
+from fake_dbgap import make_samples  # noqa: E402
+
+
+def run(write_rate, threads, seconds, latency):
+    study = {'external_id': 'phs000001', 'kf_id': 'SD_00000001',
+             'version': 'v1.p1', 'samples': make_samples(100)}
+    with FakeDataservice([study], latency=latency) as ds:
+        client = DataserviceClient(ds.url, pool_size=threads,
+                                   write_rate=write_rate)
+        deadline = time.monotonic() + seconds
+
+        def worker(n):
+            sent = 0
+            while time.monotonic() < deadline:
+                kf_id = 'GF_{:08}'.format((n + sent) % 200)
+                client.patch('/genomic-files/'+kf_id, json={'acl': []})
+                sent += 1
+            return sent
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            sent = sum(pool.map(worker, range(threads)))
+        elapsed = time.monotonic() - start
+        times = [t for t, _, _ in ds.requests]
+
+    print(f'write rate limit: {write_rate}/s, threads: {threads}, '
+          f'server latency: {latency*1000:.0f}ms')
+    print(f'sent {sent} requests in {elapsed:.2f}s: '
+          f'{sent/elapsed:.1f}/s overall')
+    print('requests received each second:')
+    first = min(times)
+    per_second = {}
+    for t in times:
+        second = int(t - first)
+        per_second[second] = per_second.get(second, 0) + 1
+    for second in sorted(per_second):
+        print(f'  {second:>3}s {per_second[second]:>6}')
+    # The first second also includes the initial burst
+    steady = [per_second[s] for s in sorted(per_second)[1:-1]]
+    if steady:
+        peak = max(steady)
+        print(f'peak steady rate: {peak}/s '
+              f'({peak/write_rate*100:.0f}% of limit)')
+    return sent / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--write-rate', type=float, default=50)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds the fake dataservice takes to respond')
+    args = parser.parse_args()
+    run(args.write_rate, args.threads, args.seconds, args.latency)
@@ -0,0 +1,315 @@
+"""
+Updates the consent codes and acls of one study, or of every study, from
+the command line without invoking any lambda functions
+
+The dbGaP xml of each study is read and its samples are updated by a pool
+of threads in this process, the same way the consent code function updates
+a batch. Several studies can be run at once in separate processes. The
+samples that are finished are saved to a checkpoint file so that an
+interrupted run can be resumed with the same command.
+
+Usage:
+    python cli.py --dataservice http://localhost:5000 phs001247 phs001228
+    python cli.py --dataservice http://localhost:5000 --jobs 4 \\
+        --checkpoint backfill.jsonl
+"""
+import argparse
+import fcntl
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from dataservice import CLIENTS, DataserviceException, get_client
+from invoker import DbGapException, get_study, pack_sample, read_dbgap_xml
+from metrics import Metrics
+from service import (AclUpdater, Scheduler, event_records, process_records,
+                     send_dead_letters)
+
+# Number of requests a study sends to the dataservice at once, which is
+# about what the default fan-out of consent code functions sends together
+CLI_WORKERS = int(os.environ.get('CLI_WORKERS', 64))
+# Number of samples that are finished before they are saved to the
+# checkpoint
+CHECKPOINT_SIZE = int(os.environ.get('CHECKPOINT_SIZE', 1000))
+# Statuses of samples that are saved to the checkpoint. Samples that failed
+# or used up their attempts are not, so that resuming the run tries them
+# again
+FINISHED_STATUSES = ['updated', 'already_applied', 'skipped']
+# Seconds between progress reports
+PROGRESS_INTERVAL = float(os.environ.get('PROGRESS_INTERVAL', 5))
+
+
+class LocalContext:
+    """
+    Stands in for the lambda context, without a deadline
+    """
+
+    function_name = 'cli'
+
+    def get_remaining_time_in_millis(self):
+        return 15 * 60 * 1000
+
+
+class Checkpoint:
+    """
+    Keeps the samples of each study that are finished in a json lines file
+
+    A line of `{"study": ..., "samples": [...]}` is appended each time a
+    group of samples is finished and a line of `{"study": ..., "result":
+    {...}}` once the study is finished. Lines are appended under a lock so
+    that several processes can share the file.
+
+    :param path: The checkpoint file, or None to not keep a checkpoint
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def load(self):
+        """
+        Reads the checkpoint of an earlier run
+
+        :returns: A dict of study to the set of its finished samples and a
+            dict of study to its result, for the studies that were finished
+        """
+        samples = {}
+        results = {}
+        if not self.path or not os.path.exists(self.path):
+            return samples, results
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line is cut short if the run was killed
+                    # while writing it
+                    continue
+                if 'result' in entry:
+                    results[entry['study']] = entry['result']
+                else:
+                    samples.setdefault(entry['study'], set()).update(
+                        entry['samples'])
+        return samples, results
+
+    def append(self, entry):
+        """
+        Adds an entry to the checkpoint
+        """
+        if not self.path:
+            return
+        line = json.dumps(entry) + '\n'
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line)
+            f.flush()
+
+
+class Progress:
+    """
+    Prints the number of finished samples of a study and the rate they are
+    finished at, at most once every `interval` seconds
+    """
+
+    def __init__(self, study, total, interval=None, quiet=False):
+        self.study = study
+        self.total = total
+        self.interval = PROGRESS_INTERVAL if interval is None else interval
+        self.quiet = quiet
+        self.done = 0
+        self.start = time.monotonic()
+        self.printed = self.start
+
+    def update(self, count, force=False):
+        self.done += count
+        now = time.monotonic()
+        if self.quiet or not (force or now - self.printed >= self.interval):
+            return
+        self.printed = now
+        rate = self.done / max(now - self.start, 0.001)
+        print(f'{self.study}: {self.done}/{self.total} samples, '
+              f'{rate:.0f}/s', file=sys.stderr, flush=True)
+
+
+def run_study(study, api, done=(), workers=None, checkpoint=None,
+              quiet=False):
+    """
+    Updates every sample of a study that is not already done
+
+    The study's biospecimens and genomic files are loaded in bulk. The
+    updates of each group of samples are compared in memory, collected, and
+    then sent together, in bulk if the dataservice accepts bulk updates and
+    otherwise `workers` at a time.
+
+    Only the samples with one of the `FINISHED_STATUSES` are saved to the
+    checkpoint, and the study's result is only saved once none are left
+    that failed, so that resuming the run sends the others again.
+
+    :param study: The dbGaP study_id
+    :param api: The url of the dataservice api
+    :param done: The ids of samples that were finished by an earlier run
+    :param workers: The number of requests to send concurrently
+    :param checkpoint: The `Checkpoint` to save finished samples to
+    :param quiet: Do not print progress
+    :returns: A dict with the study's accession, the number of samples in
+        dbGaP and that were already done, the number of samples with each
+        status, the samples that were not updated and a summary of the
+        study's metrics
+    """
+    workers = workers or CLI_WORKERS
+    checkpoint = checkpoint or Checkpoint()
+    metrics = Metrics({'Handler': 'cli'})
+    kf_id, version = get_study(study, api)
+    accession = study+'.'+version
+    context = {
+        'dbgap_id': study,
+        'kf_id': kf_id,
+        'version': version,
+        'accession': accession
+    }
+    rows = list(read_dbgap_xml(accession, metrics=metrics))
+    samples = [pack_sample(row) for row in rows if row[1] not in done]
+    records = event_records({'study': context, 'samples': samples})
+
+    # The client is shared by the updater
+    get_client(api, pool_size=workers)
+    updater = AclUpdater(api, LocalContext(), prefetch=True, metrics=metrics,
+                         bulk=True)
+    res = {'study': study, 'accession': accession, 'samples': len(rows),
+           'resumed': len(rows) - len(samples), 'statuses': {},
+           'errors': [], 'unfinished': 0}
+    progress = Progress(study, len(records), quiet=quiet)
+    with metrics.timer('prefetch'):
+        updater.prefetch_study(kf_id)
+    # Without a deadline every record is finished before this returns
+    scheduler = Scheduler(LocalContext(), workers)
+    for i in range(0, len(records), CHECKPOINT_SIZE):
+        chunk = records[i:i+CHECKPOINT_SIZE]
+        processed = process_records(updater, chunk, scheduler,
+                                    workers=workers)
+        if processed['dead_letters']:
+            send_dead_letters(processed['dead_letters'])
+        results = processed['results']
+        for result in results:
+            status = result['status']
+            metrics.incr('records_'+status)
+            res['statuses'][status] = res['statuses'].get(status, 0) + 1
+            if status != 'updated':
+                res['errors'].append(result)
+        finished = [result['sample_id'] for result in results
+                    if result['status'] in FINISHED_STATUSES]
+        res['unfinished'] += len(results) - len(finished)
+        if finished:
+            checkpoint.append({'study': study, 'samples': finished})
+        progress.update(len(chunk))
+    progress.update(0, force=True)
+    res['metrics'] = metrics.summary()
+    if not res['unfinished']:
+        checkpoint.append({'study': study, 'result': {
+            k: v for k, v in res.items() if k != 'errors'}})
+    return res
+
+
+def list_studies(api):
+    """
+    Returns the external ids of every study in the dataservice
+    """
+    client = get_client(api)
+    return [study['external_id']
+            for study in client.paginate('/studies?limit=100')]
+
+
+def run(studies, api, jobs=1, workers=None, checkpoint=None, quiet=False):
+    """
+    Runs each study, up to `jobs` studies at once in separate processes
+
+    Studies that were finished by an earlier run with the same checkpoint
+    are not run again, and studies that were interrupted only update the
+    samples that were not finished.
+
+    :param studies: The dbGaP study_ids to run, or None for every study in
+        the dataservice
+    :param api: The url of the dataservice api
+    :param jobs: The number of studies to run at once
+    :param workers: The number of requests each study sends concurrently
+    :param checkpoint: The path of the checkpoint file
+    :param quiet: Do not print progress
+    :returns: A dict with the result of each study, the studies that could
+        not be run and a summary of the metrics of every study
+    """
+    checkpoint = Checkpoint(checkpoint)
+    done, finished = checkpoint.load()
+    # Studies run in this process share the client
+    get_client(api, pool_size=workers or CLI_WORKERS)
+    if not studies:
+        studies = list_studies(api)
+    metrics = Metrics({'Handler': 'cli'})
+    res = {'studies': [], 'failed': {}}
+    start = time.monotonic()
+
+    def finish(study, future):
+        try:
+            result = future.result()
+        except (DataserviceException, DbGapException) as err:
+            res['failed'][study] = str(err)
+            return
+        except Exception as err:
+            # Any other error, such as a lost connection, only fails this
+            # study
+            res['failed'][study] = repr(err)
+            return
+        metrics.add_summary(result['metrics'])
+        res['studies'].append(result)
+
+    todo = [s for s in studies if s not in finished]
+    for study in studies:
+        if study in finished:
+            res['studies'].append(dict(finished[study], previous_run=True))
+    if jobs > 1:
+        # Each process makes its own connections to the dataservice
+        pool = ProcessPoolExecutor(max_workers=jobs,
+                                   initializer=CLIENTS.clear)
+    else:
+        pool = ThreadPoolExecutor(max_workers=1)
+    with pool:
+        futures = [(study, pool.submit(run_study, study, api,
+                                       done.get(study, ()), workers,
+                                       checkpoint, quiet))
+                   for study in todo]
+        for study, future in futures:
+            finish(study, future)
+    res['seconds'] = round(time.monotonic() - start, 3)
+    res['metrics'] = metrics.summary()
+    return res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('studies', nargs='*',
+                        help='dbGaP study ids, every study if none are given')
+    parser.add_argument('--dataservice',
+                        default=os.environ.get('DATASERVICE'),
+                        help='url of the dataservice api')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of studies to run at once')
+    parser.add_argument('--workers', type=int, default=CLI_WORKERS,
+                        help='number of requests a study sends at once')
+    parser.add_argument('--checkpoint',
+                        help='file to save finished samples to, and to '
+                             'resume from')
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not print progress')
+    args = parser.parse_args(argv)
+    if not args.dataservice:
+        parser.error('no dataservice url set')
+
+    res = run(args.studies, args.dataservice, jobs=args.jobs,
+              workers=args.workers, checkpoint=args.checkpoint,
+              quiet=args.quiet)
+    print(json.dumps(res, indent=2))
+    return 1 if res['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
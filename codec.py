@@ -0,0 +1,80 @@
+import os
+import json
+import zlib
+from base64 import b64decode, b64encode
+
+# How payloads sent to the functions are encoded, `json` or `zlib`
+PAYLOAD_ENCODING = os.environ.get('PAYLOAD_ENCODING', 'json')
+# Name and version of the compressed envelope
+CODEC = 'zlib-dict'
+VERSION = 1
+
+
+class CodecException(Exception):
+    pass
+
+
+def encoded():
+    """
+    Whether payloads are sent compressed
+    """
+    return PAYLOAD_ENCODING == 'zlib'
+
+
+def encode_event(event, compress=None):
+    """
+    Encodes an event as the payload of an invocation
+
+    Compressed events are sent in an envelope of the form:
+    ```
+    {"codec": "zlib-dict", "version": 1, "data": "eJy..."}
+    ```
+    where `data` is the base64 of the zlib compressed json of the event. The
+    samples of a batch are dictionary encoded first: each distinct pair of
+    consent code and consent name is listed once under `consents` and each
+    sample refers to its pair by index, eg: `["sample_id", 0]`.
+
+    :param event: The event to send
+    :param compress: Whether to compress the event, by default if
+        `PAYLOAD_ENCODING` is `zlib`
+    :returns: The payload as bytes
+    """
+    if not (encoded() if compress is None else compress):
+        return str.encode(json.dumps(event))
+    if 'samples' in event:
+        consents = {}
+        samples = []
+        for sample in event['samples']:
+            index = consents.setdefault((sample[1], sample[2]),
+                                        len(consents))
+            samples.append([sample[0], index] + list(sample[3:]))
+        event = dict(event, samples=samples,
+                     consents=[list(pair) for pair in consents])
+    data = json.dumps(event, separators=(',', ':')).encode('utf-8')
+    return str.encode(json.dumps({
+        'codec': CODEC,
+        'version': VERSION,
+        'data': b64encode(zlib.compress(data, 9)).decode('ascii')
+    }))
+
+
+def is_encoded(event):
+    return isinstance(event, dict) and 'codec' in event and 'data' in event
+
+
+def decode_event(event):
+    """
+    Returns the event sent in a payload, decompressing it if it was encoded
+    by `encode_event`, otherwise the event as it is
+    """
+    if not is_encoded(event):
+        return event
+    if event['codec'] != CODEC or event.get('version') != VERSION:
+        raise CodecException('Unsupported payload encoding {} version {}'
+                             .format(event['codec'], event.get('version')))
+    decoded = json.loads(zlib.decompress(b64decode(event['data'])))
+    if 'consents' in decoded:
+        consents = decoded.pop('consents')
+        decoded['samples'] = [[s[0]] + consents[s[1]] + s[2:]
+                              for s in decoded['samples']]
+    return decoded
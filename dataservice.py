@@ -0,0 +1,548 @@
+import os
+import time
+import random
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+from botocore.vendored import requests
+from botocore.vendored.requests.exceptions import ConnectionError, Timeout
+
+from metrics import endpoint
+
+# Number of connections to keep open to the dataservice. The pool is never
+# made smaller than the number of threads that will be sharing it.
+POOL_SIZE = int(os.environ.get('DATASERVICE_POOL_SIZE', 10))
+
+# Number of seconds a study's kf_id and version are cached for, and the
+# maximum number of studies to keep
+STUDY_CACHE_TTL = int(os.environ.get('STUDY_CACHE_TTL', 3600))
+STUDY_CACHE_SIZE = int(os.environ.get('STUDY_CACHE_SIZE', 256))
+
+# Number of attempts made for each request, and the base and longest delay
+# in seconds between attempts
+RETRY_ATTEMPTS = int(os.environ.get('RETRY_ATTEMPTS', 3))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 0.5))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 10))
+
+# Longest and shortest timeout in seconds given to each attempt of a request
+# with a deadline. No attempt is started with less time left than the
+# shortest timeout.
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 30))
+MIN_REQUEST_TIMEOUT = 1
+
+# The circuit breaker opens once this fraction of the most recent
+# BREAKER_WINDOW requests failed, and stays open for BREAKER_COOLDOWN seconds
+BREAKER_THRESHOLD = float(os.environ.get('BREAKER_THRESHOLD', 0.5))
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', 20))
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', 30))
+
+# Maximum number of read and write requests per second a client may send to
+# the dataservice. A rate of 0 does not limit requests.
+READ_RATE = float(os.environ.get('DATASERVICE_READ_RATE', 0))
+WRITE_RATE = float(os.environ.get('DATASERVICE_WRITE_RATE', 0))
+
+# Number of entities sent in each bulk update. 0 sends every update as its
+# own request.
+BULK_CHUNK_SIZE = int(os.environ.get('DATASERVICE_BULK_CHUNK_SIZE', 100))
+# Responses to a bulk update that mean the dataservice does not support them
+BULK_UNSUPPORTED = [404, 405, 501]
+
+# Clients are kept for the life of the lambda container so that warm
+# invocations can reuse connections that are already open
+CLIENTS = {}
+
+
+class DataserviceException(Exception):
+    pass
+
+
+class NotSentException(Exception):
+    """
+    A request was not sent, or not retried, so whatever needed it was not
+    tried and can be tried again later
+    """
+
+
+class CircuitOpenException(NotSentException):
+    pass
+
+
+class DeadlineException(NotSentException):
+    pass
+
+
+def get_client(api, pool_size=None):
+    """
+    Returns the client for the given dataservice api, creating it if this
+    container has not talked to the api yet
+
+    :param api: The url of the dataservice api
+    :param pool_size: The number of threads that will share the client
+    """
+    if api not in CLIENTS:
+        CLIENTS[api] = DataserviceClient(api, pool_size=pool_size)
+    return CLIENTS[api]
+
+
+class StudyCache:
+    """
+    A least recently used cache of study kf_ids and versions by the study's
+    external id. Entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, ttl=None, size=None):
+        self.ttl = STUDY_CACHE_TTL if ttl is None else ttl
+        self.size = STUDY_CACHE_SIZE if size is None else size
+        self.studies = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, external_id):
+        """
+        Returns the cached (kf_id, version) of a study or None if the study
+        is not cached or has expired
+        """
+        with self.lock:
+            if external_id not in self.studies:
+                return None
+            kf_id, version, expires = self.studies[external_id]
+            if expires < time.time():
+                del self.studies[external_id]
+                return None
+            self.studies.move_to_end(external_id)
+            return kf_id, version
+
+    def set(self, external_id, kf_id, version):
+        """
+        Caches the kf_id and version of a study, evicting the least recently
+        used study if the cache is full
+        """
+        with self.lock:
+            self.studies[external_id] = (kf_id, version,
+                                         time.time() + self.ttl)
+            self.studies.move_to_end(external_id)
+            while len(self.studies) > self.size:
+                self.studies.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.studies.clear()
+
+
+# Studies are cached for the life of the lambda container so that warm
+# invocations do not need to look them up again
+STUDIES = StudyCache()
+
+
+class RetryPolicy:
+    """
+    Decides which requests are retried and how long to wait before each
+    attempt. Server errors, rate limiting and connection errors are retried
+    with exponential backoff and full jitter, unless the response has a
+    `Retry-After` header.
+    """
+
+    def __init__(self, attempts=None, base_delay=None, max_delay=None):
+        self.attempts = attempts or RETRY_ATTEMPTS
+        self.base_delay = (RETRY_BASE_DELAY if base_delay is None
+                           else base_delay)
+        self.max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+
+    def is_failure(self, resp=None, error=None):
+        """
+        Whether a response or error is worth retrying
+        """
+        if error is not None:
+            return True
+        return resp.status_code == 429 or 500 <= resp.status_code < 600
+
+    def delay(self, attempt, resp=None):
+        """
+        Returns the number of seconds to wait before the next attempt
+
+        :param attempt: The number of attempts made so far
+        :param resp: The response to the last attempt, if there was one
+        """
+        if resp is not None:
+            retry_after = resp.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return min(int(retry_after), self.max_delay)
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, backoff)
+
+
+class CircuitBreaker:
+    """
+    Stops requests from being sent once too many recent requests failed,
+    until the dataservice has had time to recover
+    """
+
+    def __init__(self, threshold=None, window=None, cooldown=None):
+        self.threshold = threshold or BREAKER_THRESHOLD
+        self.cooldown = BREAKER_COOLDOWN if cooldown is None else cooldown
+        self.results = deque(maxlen=window or BREAKER_WINDOW)
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def record(self, failed):
+        """
+        Records whether a request failed, opening the breaker if the error
+        rate is over the threshold
+        """
+        with self.lock:
+            self.results.append(failed)
+            # Wait for enough requests before judging the error rate
+            if len(self.results) < self.results.maxlen // 2:
+                return
+            if sum(self.results) / len(self.results) >= self.threshold:
+                if self.opened_at is None:
+                    print('dataservice error rate is over {}, stopping '
+                          'requests for {}s'.format(self.threshold,
+                                                    self.cooldown))
+                self.opened_at = time.time()
+                self.results.clear()
+
+    def remaining(self):
+        """
+        Returns the number of seconds until the breaker closes again
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            remaining = self.opened_at + self.cooldown - time.time()
+            if remaining <= 0:
+                # Let requests through again to see if the service recovered
+                self.opened_at = None
+                return 0
+            return remaining
+
+    def is_open(self):
+        return self.remaining() > 0
+
+    def check(self):
+        """
+        Raises an exception if requests should not be sent
+        """
+        if self.is_open():
+            raise CircuitOpenException('Too many dataservice requests have '
+                                       'failed, waiting for it to recover')
+
+
+class TokenBucket:
+    """
+    Limits how often an action can be taken to `rate` times per second, with
+    bursts of up to `burst` actions
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, waiting until one is available
+
+        :returns: The number of seconds spent waiting
+        """
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the token now so that waiting threads are served in
+            # the order they arrived
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class DataserviceClient:
+    """
+    Makes requests to the dataservice over a pooled keep-alive session
+    """
+
+    def __init__(self, api, pool_size=None, read_rate=None, write_rate=None):
+        self.api = api
+        self.pool_size = max(pool_size or 0, POOL_SIZE)
+        self.session = requests.Session()
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self.retry = RetryPolicy()
+        self.breaker = CircuitBreaker()
+        self.reads = TokenBucket(READ_RATE if read_rate is None else read_rate)
+        self.writes = TokenBucket(WRITE_RATE if write_rate is None
+                                  else write_rate)
+        # Whether the dataservice accepts bulk updates, or None until the
+        # first bulk update is tried
+        self.bulk_supported = None
+
+    def get(self, path, **kwargs):
+        """
+        Sends a GET request for a path on the dataservice
+        """
+        return self.request('get', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        """
+        Sends a PATCH request for a path on the dataservice
+        """
+        return self.request('patch', path, **kwargs)
+
+    def bulk_patch(self, entity, changes, chunk_size=None, max_workers=None,
+                   **kwargs):
+        """
+        Updates many entities of the same type
+
+        Updates are sent in bulk, `chunk_size` entities at a time, as a
+        PATCH to the entity's endpoint with a list of bodies that each have
+        the `kf_id` of the entity they update. The dataservice answers with
+        a 200 or 207 and lists the entities it could not update under
+        `errors`:
+        ```
+        {"errors": [{"kf_id": "GF_00000000", "message": "..."}]}
+        ```
+        If the dataservice does not support bulk updates, each entity is
+        sent its own PATCH instead, and the client remembers this for later
+        updates.
+
+        Entities whose update was not sent because the circuit breaker was
+        open or there was no time left, see `NotSentException`, are not
+        failures and are listed separately so they can be sent again later.
+
+        :param entity: The entity endpoint, eg: `genomic-files`
+        :param changes: A dict of the body to PATCH to each kf_id
+        :param chunk_size: The number of entities in each bulk update
+        :param max_workers: The number of requests sent at the same time
+        :returns: A dict of the error for each kf_id that was not updated,
+            and a list of the kf_ids that were not sent
+        """
+        chunk_size = BULK_CHUNK_SIZE if chunk_size is None else chunk_size
+        max_workers = max_workers or self.pool_size
+        items = list(changes.items())
+        errors = {}
+        single = []
+        if items and chunk_size > 0 and self.bulk_supported is not False:
+            chunks = [items[i:i+chunk_size]
+                      for i in range(0, len(items), chunk_size)]
+            with ThreadPoolExecutor(min(max_workers, len(chunks))) as pool:
+                results = pool.map(
+                    lambda chunk: self._bulk_chunk(entity, chunk, **kwargs),
+                    chunks)
+                for chunk, chunk_errors in zip(chunks, results):
+                    if chunk_errors is None:
+                        single.extend(chunk)
+                    else:
+                        errors.update(chunk_errors)
+        else:
+            single = items
+        if single:
+            with ThreadPoolExecutor(min(max_workers, len(single))) as pool:
+                results = pool.map(
+                    lambda item: self._patch_one(entity, *item, **kwargs),
+                    single)
+                for (kf_id, _), error in zip(single, results):
+                    if error:
+                        errors[kf_id] = error
+        # Entities that were not sent have the exception that stopped them
+        # as their error
+        unsent = [kf_id for kf_id, error in errors.items()
+                  if isinstance(error, NotSentException)]
+        for kf_id in unsent:
+            del errors[kf_id]
+        return errors, unsent
+
+    def _bulk_chunk(self, entity, chunk, **kwargs):
+        """
+        Sends one bulk update
+
+        :returns: A dict of the error for each kf_id that was not updated,
+            which is the `NotSentException` if the update was not sent, or
+            None if the dataservice does not support bulk updates
+        """
+        body = [dict(change, kf_id=kf_id) for kf_id, change in chunk]
+        try:
+            resp = self.patch(f'/{entity}', json=body, **kwargs)
+        except NotSentException as err:
+            return {kf_id: err for kf_id, _ in chunk}
+        except Exception as err:
+            return {kf_id: repr(err) for kf_id, _ in chunk}
+        if resp.status_code in BULK_UNSUPPORTED:
+            if self.bulk_supported is None:
+                print(f'dataservice does not support bulk updates to '
+                      f'{entity}, sending them one at a time')
+            self.bulk_supported = False
+            return None
+        self.bulk_supported = True
+        if resp.status_code not in [200, 207]:
+            error = f'{resp.status_code}: {resp.content}'
+            return {kf_id: error for kf_id, _ in chunk}
+        return {e['kf_id']: e.get('message', 'not updated')
+                for e in resp.json().get('errors', [])}
+
+    def _patch_one(self, entity, kf_id, change, **kwargs):
+        """
+        Sends a single update
+
+        :returns: The error if the entity was not updated, which is the
+            `NotSentException` if the update was not sent, otherwise None
+        """
+        try:
+            resp = self.patch(f'/{entity}/{kf_id}', json=change, **kwargs)
+        except NotSentException as err:
+            return err
+        except Exception as err:
+            return repr(err)
+        if resp.status_code != 200:
+            return f'{resp.status_code}: {resp.content}'
+        return None
+
+    def paginate(self, path, **kwargs):
+        """
+        Yields every result of a dataservice listing
+
+        :param path: The path of the first page of the listing
+        """
+        return iter_results(self.get, self.api+path, **kwargs)
+
+    def request(self, method, path, deadline=None, **kwargs):
+        """
+        Sends a request for a path on the dataservice using the pooled session
+
+        Failed requests are retried according to the retry policy. No
+        request is sent while the circuit breaker is open, and requests wait
+        for the read or write rate limit.
+
+        :param path: A path on the dataservice api, or a full url
+        :param deadline: The time on the `time.monotonic` clock by which
+            every attempt must have finished. Each attempt is given the time
+            left as its timeout, up to `timeout` or `REQUEST_TIMEOUT`.
+        :param metrics: The metrics of the current run, which record the
+            latency of each request by endpoint
+        :raises CircuitOpenException: If the circuit breaker is open
+        :raises DeadlineException: If less than `MIN_REQUEST_TIMEOUT` is
+            left before the deadline for the next attempt
+        :returns: The response to the last attempt
+        """
+        url = path if '://' in path else self.api+path
+        metrics = kwargs.pop('metrics', None)
+        timeout = kwargs.get('timeout') or REQUEST_TIMEOUT
+        limiter = self.reads if method == 'get' else self.writes
+        attempt = 0
+        while True:
+            self.breaker.check()
+            limiter.acquire()
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left < MIN_REQUEST_TIMEOUT:
+                    raise DeadlineException(f'No time left to request {url}')
+                kwargs['timeout'] = min(timeout, left)
+            attempt += 1
+            with self.lock:
+                self.request_count += 1
+            resp = None
+            error = None
+            start = time.monotonic()
+            try:
+                resp = getattr(self.session, method)(url, **kwargs)
+            except (ConnectionError, Timeout) as err:
+                error = err
+            failed = self.retry.is_failure(resp, error)
+            self.breaker.record(failed)
+            if metrics is not None:
+                metrics.timing(endpoint(method, url),
+                               (time.monotonic() - start) * 1000)
+                if failed:
+                    metrics.incr('dataservice_errors')
+            if not failed or attempt >= self.retry.attempts:
+                break
+            delay = self.retry.delay(attempt, resp)
+            if (deadline is not None and
+                    deadline - time.monotonic() - delay < MIN_REQUEST_TIMEOUT):
+                raise DeadlineException(f'No time left to retry {url}')
+            time.sleep(delay)
+        if error is not None:
+            raise error
+        return resp
+
+    def connection_stats(self):
+        """
+        Counts how many requests were able to reuse an open connection
+
+        :returns: A dict with the number of requests sent, the number of new
+            connections opened and the number of requests that reused one
+        """
+        pools = self.adapter.poolmanager.pools
+        opened = sum(pools[key].num_connections for key in pools.keys())
+        return {
+            'requests': self.request_count,
+            'new_connections': opened,
+            'reused_connections': max(self.request_count - opened, 0)
+        }
+
+
+def iter_pages(get, url, **kwargs):
+    """
+    Yields each page of a dataservice listing, following the `next` link of
+    every page. While a page is being consumed the next one is already being
+    requested in the background.
+
+    The listing ends when a page has no `next` link, when a page is empty, or
+    once `total` results have been returned.
+
+    :param get: A function used to request a url, eg: `requests.get`
+    :param url: The url of the first page of the listing
+    :param kwargs: Additional arguments for each request
+    """
+    def fetch(url):
+        resp = get(url, **kwargs)
+        if resp.status_code != 200:
+            raise DataserviceException(f'Problem requesting dataservice: '
+                                       f'{url}, {resp.content}')
+        return url, resp.json()
+
+    executor = None
+    try:
+        url, page = fetch(url)
+        seen = 0
+        while True:
+            seen += len(page['results'])
+            next_url = page.get('_links', {}).get('next')
+            done = (not next_url or not page['results'] or
+                    seen >= page.get('total', seen+1))
+            if not done:
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=1)
+                future = executor.submit(fetch, urljoin(url, next_url))
+            yield page
+            if done:
+                break
+            url, page = future.result()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def iter_results(get, url, **kwargs):
+    """
+    Yields every result of a dataservice listing, one page at a time
+
+    :param get: A function used to request a url, eg: `requests.get`
+    :param url: The url of the first page of the listing
+    :param kwargs: Additional arguments for each request
+    """
+    for page in iter_pages(get, url, **kwargs):
+        for result in page['results']:
+            yield result
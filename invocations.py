@@ -0,0 +1,98 @@
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from botocore.exceptions import ClientError
+
+from dataservice import TokenBucket
+from metrics import Metrics
+
+# Number of lambda invocations that may be in flight at once
+INVOKE_CONCURRENCY = int(os.environ.get('INVOKE_CONCURRENCY', 10))
+# Number of times a throttled invocation is retried, and the base delay in
+# seconds of the exponential backoff between attempts
+INVOKE_RETRIES = int(os.environ.get('INVOKE_RETRIES', 5))
+INVOKE_BACKOFF = float(os.environ.get('INVOKE_BACKOFF', 0.5))
+THROTTLE_CODES = ['TooManyRequestsException', 'ThrottlingException']
+# Maximum number of invocations to start per second, which paces the rate
+# of requests the consent code functions make together. 0 does not limit.
+DISPATCH_RATE = float(os.environ.get('DISPATCH_RATE', 0))
+
+
+def dispatch(lam, function_name, payloads, max_workers=None, rate=None,
+             metrics=None, on_result=None):
+    """
+    Asynchronously invokes a function once for each payload, running up to
+    `max_workers` invocations concurrently. Payloads are consumed lazily so
+    that no more than a few batches are held in memory at once.
+
+    :param lam: A boto lambda client used to invoke lamda functions
+    :param function_name: The name of the function to invoke
+    :param payloads: An iterable of encoded payloads
+    :param max_workers: The number of concurrent invocations
+    :param rate: The maximum number of invocations to start per second
+    :param metrics: The metrics of the current run
+    :param on_result: A function called with the index and result of each
+        invocation once it is done
+    :returns: A list with the result of each invocation, in payload order
+    """
+    max_workers = max_workers or INVOKE_CONCURRENCY
+    limiter = TokenBucket(DISPATCH_RATE if rate is None else rate)
+    metrics = metrics or Metrics()
+
+    def call(index, payload):
+        with metrics.timer('lambda_invoke'):
+            result = invoke_with_retry(lam, function_name, payload)
+        metrics.incr('invocations')
+        metrics.incr('invocations_throttled', result['attempts'] - 1)
+        if result['error']:
+            metrics.incr('invocations_failed')
+        if on_result is not None:
+            on_result(index, result)
+        return result
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = set()
+        for index, payload in enumerate(payloads):
+            if len(pending) >= max_workers * 2:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            limiter.acquire()
+            future = pool.submit(call, index, payload)
+            pending.add(future)
+            futures.append(future)
+    return [f.result() for f in futures]
+
+
+def invoke_with_retry(lam, function_name, payload):
+    """
+    Invokes a function, retrying with exponential backoff and jitter if the
+    invocation is throttled
+
+    :returns: A dict with the response status code, the number of attempts
+        made and the error if the invocation failed
+    """
+    result = {'status': None, 'attempts': 0, 'error': None}
+    while True:
+        result['attempts'] += 1
+        try:
+            response = lam.invoke(
+                FunctionName=function_name,
+                InvocationType='Event',
+                Payload=payload,
+            )
+            result['status'] = response.get('StatusCode')
+            result['error'] = None
+            return result
+        except ClientError as err:
+            result['error'] = str(err)
+            code = err.response.get('Error', {}).get('Code')
+            if (code not in THROTTLE_CODES or
+                    result['attempts'] > INVOKE_RETRIES):
+                return result
+        except Exception as err:
+            result['error'] = str(err)
+            return result
+        delay = INVOKE_BACKOFF * 2 ** (result['attempts'] - 1)
+        time.sleep(delay + random.uniform(0, delay))
@@ -1,17 +1,50 @@
-import copy
 import os
+import gzip
+import hashlib
 import json
-import xmltodict
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
 import boto3
 from base64 import b64decode
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from itertools import chain, count, islice
 
 from botocore.vendored import requests
 
-record_template = {
-    "study": {
-        "dbgap_id": "phs001247"
-    }
-}
+from codec import decode_event, encode_event, encoded
+from dataservice import DataserviceException, STUDIES, iter_pages
+from invocations import dispatch
+from metrics import Metrics
+from service import AclUpdater, event_records
+from store import get_store
+
+# Asynchronous lambda invocations are limited to a 256KB payload, leave some
+# headroom below that for the envelope
+BATCH_MAX_BYTES = int(os.environ.get('BATCH_MAX_BYTES', 250000))
+# Maximum number of records to send to a single consent code lambda
+BATCH_MAX_RECORDS = int(os.environ.get('BATCH_MAX_RECORDS', 500))
+# Maximum number of records in a compressed payload, see `codec`
+ENCODED_BATCH_MAX_RECORDS = int(os.environ.get('ENCODED_BATCH_MAX_RECORDS',
+                                               20000))
+# Number of batches that reach the consent code function between saves of a
+# study's checkpoint
+CHECKPOINT_BATCHES = int(os.environ.get('CHECKPOINT_BATCHES', 10))
+# Number of studies whose dbGaP xml is downloaded at once when every study is
+# run in a single function, see `map_studies_in_process`
+FETCH_CONCURRENCY = int(os.environ.get('FETCH_CONCURRENCY', 8))
+# Number of processes that parse the dbGaP xml of those studies
+PARSE_PROCESSES = int(os.environ.get('PARSE_PROCESSES', os.cpu_count() or 1))
+# Milliseconds left in the function below which no more studies are started,
+# so that the studies already started can be sent before it times out
+STUDY_RESERVE_MS = int(os.environ.get('STUDY_RESERVE_MS', 120000))
+# dbGaP's sample status service, which can be pointed at a local stand-in
+DBGAP_URL = os.environ.get(
+    'DBGAP_URL',
+    'https://www.ncbi.nlm.nih.gov/projects/gap/cgi-bin/GetSampleStatus.cgi')
 
 SLACK_TOKEN = os.environ.get('SLACK_TOKEN', None)
 SLACK_CHANNELS = os.environ.get('SLACK_CHANNEL', '').split(',')
@@ -27,28 +60,10 @@ class DbGapException(Exception):
     pass
 
 
-class DataserviceException(Exception):
+class PlanException(Exception):
     pass
 
 
-def dict_or_list(key, dictionary):
-    """
-    Flattens dictionary or list to list
-    """
-    if type(dictionary) != 'str':
-        for k, v in dictionary.items():
-            if k == key:
-                yield v
-            elif isinstance(v, dict):
-                for result in dict_or_list(key, v):
-                    yield result
-            elif isinstance(v, list):
-                for d in v:
-                    if isinstance(d, dict):
-                        for result in dict_or_list(key, d):
-                            yield result
-
-
 def handler(event, context):
     """
     Reads dbgap xml and invokes the consent code lambda for the dbgap study.
@@ -61,7 +76,26 @@ def handler(event, context):
         "study": "phs001247"
     }
     ```
+
+    Only samples that changed since the last run of a study are sent unless
+    `"full_sync": true` is given in the event.
+
+    With `"in_process": true` and no study, every study is sent from this
+    function instead of invoking it again for each study, see
+    `map_studies_in_process`.
+
+    With `"plan": true` the changes each study needs are worked out without
+    updating anything, see `plan_study`. With `"apply": true` the last plan
+    made for each study is applied, see `apply_plan`.
+
+    The returned dict includes a summary of the run's `metrics`, which are
+    also printed in the CloudWatch embedded metric format.
+
+    Events may be compressed, see `codec.decode_event`. Payloads sent to the
+    consent code function and to this function are compressed if
+    `PAYLOAD_ENCODING` is `zlib`.
     """
+    event = decode_event(event)
     DATASERVICE = os.environ.get('DATASERVICE', None)
 
     if DATASERVICE is None:
@@ -77,16 +111,44 @@ def handler(event, context):
     lam = boto3.client('lambda')
 
     study = event.get('study', None)
+    full_sync = event.get('full_sync', False)
+    plan = event.get('plan', False)
+    apply = event.get('apply', False)
+    metrics = Metrics({'Handler': 'invoker'})
     # If there is no study in the event, we should re-call this function for
     # each event in the dataservice
-    if study is None:
-        map_to_studies(lam, context.function_name, DATASERVICE)
+    if study is None and event.get('in_process') and not (plan or apply):
+        res = map_studies_in_process(lam, consentcode_func, DATASERVICE,
+                                     full_sync=full_sync, metrics=metrics,
+                                     context=context)
+        res['metrics'] = metrics.summary()
+        metrics.emit()
+        return res
+    elif study is None:
+        res = map_to_studies(lam, context.function_name, DATASERVICE,
+                             full_sync=full_sync, metrics=metrics,
+                             plan=plan, apply=apply)
+        res['metrics'] = metrics.summary()
+        metrics.emit()
+        return res
 
     # Call functions for each sample in the study
     elif study and consentcode_func:
         try:
-            map_one_study(study, lam, consentcode_func, DATASERVICE)
-        except (DataserviceException, DbGapException) as err:
+            if plan:
+                res = plan_study(study, context, DATASERVICE,
+                                 metrics=metrics)
+            elif apply:
+                res = apply_plan(study, lam, consentcode_func, DATASERVICE,
+                                 metrics=metrics)
+            else:
+                res = map_one_study(study, lam, consentcode_func,
+                                    DATASERVICE, full_sync=full_sync,
+                                    metrics=metrics)
+            res['metrics'] = metrics.summary()
+            metrics.emit()
+            return res
+        except (DataserviceException, DbGapException, PlanException) as err:
             # There was a problem trying to process the study, notify slack
             msg = f'Problem invoking for `{study}`: {err}'
             attachments = [{
@@ -97,18 +159,493 @@ def handler(event, context):
             send_slack(attachments=attachments)
 
 
-def map_one_study(study, lam, consentcode, dataservice_api):
+def map_one_study(study, lam, consentcode, dataservice_api, full_sync=False,
+                  metrics=None):
     """
     Attempt to load a dbGaP xml for a study and call a function for each
     sample to update
 
+    If a store is configured, the consent codes of the study are kept after
+    each run and only the samples that were added, changed or removed since
+    the previous run are sent, along with the samples that the consent code
+    function gave up on since, see `load_failures`. A run that is
+    interrupted, or that fails to send some batches, resumes from its
+    checkpoint the next time the study is run, see `StudyCheckpoint`.
+
     :param study: The dbGaP study_id
     :param lam: A boto lambda client used to invoke lamda functions
     :param consentcode: The name of the function that will be called for each
         sample to update it inside the dataservice
     :param dataservice_api: The url of the dataservice api
+    :param full_sync: Send every sample regardless of the previous run
+    :param metrics: The metrics of the current run
+    :returns: A dict with the number of batches, records and bytes sent,
+        and the number of records that an earlier run already sent
+    """
+    run = StudyRun(study, dataservice_api, full_sync=full_sync,
+                   metrics=metrics)
+    if not run.fetch():
+        return run.unchanged()
+
+    with run.xml:
+        dbgap_codes = run.metrics.timed('dbgap_parse',
+                                        parse_dbgap_xml(run.xml,
+                                                        run.accession))
+        stats = invoke(lam, consentcode, run.context, run.samples(dbgap_codes),
+                       metrics=run.metrics, checkpoint=run.checkpoint)
+    return run.finish(stats)
+
+
+class StudyRun:
+    """
+    The steps of sending the samples of a study that changed since its last
+    run, see `map_one_study`
+
+    The study is looked up in the dataservice and the state of its last run
+    is loaded from the store when the run is made.
+
+    :param study: The dbGaP study_id
+    :param dataservice_api: The url of the dataservice api
+    :param full_sync: Send every sample regardless of the previous run
+    :param metrics: The metrics of the current run
+    """
+
+    def __init__(self, study, dataservice_api, full_sync=False, metrics=None):
+        self.study = study
+        self.metrics = metrics or Metrics()
+        kf_id, version = get_study(study, dataservice_api)
+
+        # Need to now invoke new functions in batches to process each sample
+        self.accession = study+'.'+version
+        self.context = {
+            'dbgap_id': study,
+            'kf_id': kf_id,
+            'version': version,
+            'accession': self.accession
+        }
+        # A full sync is also sent past the consent code function's ledger
+        if full_sync:
+            self.context['full_sync'] = True
+
+        self.store = get_store()
+        self.full_sync = full_sync
+        self.previous = None
+        self.previous_fetch = None
+        # The keys of the failures that this run sends again, and a digest
+        # of their samples
+        self.failures = []
+        self.retried = None
+        failed = set()
+        if self.store is not None:
+            self.failures, failed = load_failures(self.store, self.accession)
+            # The snapshot is loaded for a full sync too, to find the samples
+            # that were removed from dbGaP, but the xml is always downloaded
+            self.previous = load_snapshot(self.store, self.accession)
+        if self.store is not None and not full_sync:
+            self.previous_fetch = load_fetch_state(self.store, self.accession)
+        if self.previous is not None and failed:
+            # The failed samples are sent as if they changed, even if the
+            # xml did not
+            for sample_id in failed:
+                self.previous[sample_id] = None
+            self.previous_fetch = None
+            self.retried = hashlib.sha1(json.dumps(sorted(failed)).encode(
+                'utf-8')).hexdigest()[:16]
+
+        self.xml = None
+        self.fetch_state = None
+        self.snapshot = {}
+        self.checkpoint = None
+        self.resumed = 0
+        # The stats of the study's payloads, the results of the batches sent
+        # so far, and the number of batches once they have all been sent,
+        # see `batch_done`
+        self.stats = {}
+        self.results = []
+        self.batches = None
+        self.lock = threading.Lock()
+
+    def fetch(self, named=False):
+        """
+        Downloads the study's xml
+
+        :param named: Download the xml to a file that can be opened by name
+        :returns: Whether the xml changed since the last run
+        """
+        with self.metrics.timer('dbgap_fetch'):
+            self.xml, self.fetch_state = fetch_dbgap_xml(
+                self.accession, self.previous_fetch, named=named)
+        self.metrics.incr('dbgap_bytes', self.fetch_state['bytes'])
+        if self.xml is None:
+            self.metrics.incr('dbgap_unchanged')
+        return self.xml is not None
+
+    def unchanged(self):
+        """
+        :returns: The stats of a run whose xml is the same as the last time
+            the study was run
+        """
+        return {'batches': 0, 'records': 0, 'bytes': 0, 'failed': [],
+                'throttled': 0, 'full_sync': False, 'unchanged': True,
+                'downloaded_bytes': self.fetch_state['bytes']}
+
+    def samples(self, dbgap_codes):
+        """
+        Returns the packed samples that need to be sent, see `diff_samples`,
+        without the ones that an interrupted run already sent
+
+        :param dbgap_codes: The tuples of (consent_code, sample_id,
+            consent_name) read from the xml
+        """
+        samples = diff_samples(self.previous, dbgap_codes, self.snapshot,
+                               full_sync=self.full_sync)
+        if self.store is not None:
+            self.checkpoint = StudyCheckpoint(self.store, self.accession,
+                                              self.fetch_state['sha256'],
+                                              self.sends_all(),
+                                              retried=self.retried)
+            self.resumed = self.checkpoint.load()
+            # Samples that were already sent are still added to the snapshot
+            samples = islice(samples, self.resumed, None)
+        return samples
+
+    def sends_all(self):
+        """
+        Whether every sample is sent, rather than only the ones that changed
+        """
+        return self.full_sync or self.previous is None
+
+    def batch_done(self, index, result):
+        """
+        Records the result of one of the study's batches
+
+        :returns: Whether every batch of the study has a result
+        """
+        if self.checkpoint is not None and not result['error']:
+            self.checkpoint.batch_sent(index)
+        with self.lock:
+            self.results.append(result)
+            return len(self.results) == self.batches
+
+    def all_sent(self, batches):
+        """
+        Records that every batch of the study was handed to the dispatcher
+
+        :returns: Whether every batch of the study has a result
+        """
+        with self.lock:
+            self.batches = batches
+            return len(self.results) == batches
+
+    def finish(self, stats):
+        """
+        Saves the state of the run once every batch has a result
+
+        :param stats: The stats returned by `invoke`
+        :returns: The stats with the number of records that an earlier run
+            already sent
+        """
+        stats['resumed'] = self.resumed
+        stats['full_sync'] = self.sends_all()
+        stats['unchanged'] = False
+        stats['downloaded_bytes'] = self.fetch_state['bytes']
+        self.metrics.incr('records_resumed', self.resumed)
+        # Only remember this run if every sample made it to the consent
+        # function
+        if self.store is not None and not stats['failed']:
+            save_snapshot(self.store, self.accession, self.snapshot)
+            save_fetch_state(self.store, self.accession, self.fetch_state)
+            clear_failures(self.store, self.failures)
+            self.checkpoint.clear()
+        elif self.checkpoint is not None:
+            self.checkpoint.save()
+        return stats
+
+
+class StudyCheckpoint:
     """
-    # Get dbgap released version from dataservice
+    Keeps how many of the samples being sent for a study reached the consent
+    code function, so that an interrupted run can resume instead of sending
+    the study again
+
+    The checkpoint is saved under `checkpoints/{accession}.json` with the
+    sha256 of the xml, whether every sample is being sent and the failed
+    samples being sent again. A later run only resumes from it if it sends
+    the same xml the same way, since the samples are then in the same
+    order. Only batches that were all sent in order count, so a failed batch
+    is sent again by the next run along with every batch after it.
+
+    :param store: The store to save the checkpoint to
+    :param accession: The study accession
+    :param sha256: The sha256 of the xml being sent
+    :param full_sync: Whether every sample is being sent
+    :param retried: A digest of the failed samples being sent again, if any
+    """
+
+    def __init__(self, store, accession, sha256, full_sync, every=None,
+                 retried=None):
+        self.store = store
+        self.key = f'checkpoints/{accession}.json'
+        self.state = {'sha256': sha256, 'full_sync': full_sync,
+                      'retried': retried}
+        self.every = every or CHECKPOINT_BATCHES
+        # The number of records in each batch, the batches that were sent
+        # but follow one that was not, and the records in the batches that
+        # were all sent in order
+        self.sizes = []
+        self.done = set()
+        self.next = 0
+        self.saved = 0
+        self.records = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        :returns: The number of records that were sent by the last run, or 0
+            if it sent a different xml
+        """
+        body = self.store.get(self.key)
+        if body is None:
+            return 0
+        state = json.loads(body.decode('utf-8'))
+        if any(state.get(k) != v for k, v in self.state.items()):
+            return 0
+        self.records = state['records']
+        return self.records
+
+    def add_batch(self, records):
+        """
+        Adds the next batch to be sent, before it is sent
+        """
+        with self.lock:
+            self.sizes.append(records)
+
+    def batch_sent(self, index):
+        """
+        Records that a batch reached the function, and saves the checkpoint
+        every `every` batches
+        """
+        with self.lock:
+            self.done.add(index)
+            while self.next in self.done:
+                self.done.remove(self.next)
+                self.records += self.sizes[self.next]
+                self.next += 1
+            if self.next - self.saved >= self.every:
+                self.saved = self.next
+                self.save()
+
+    def save(self):
+        body = json.dumps(dict(self.state, records=self.records))
+        self.store.put(self.key, body.encode('utf-8'))
+
+    def clear(self):
+        self.store.delete(self.key)
+
+
+def plan_study(study, context, dataservice_api, metrics=None):
+    """
+    Works out the updates that every sample of a study needs without making
+    them
+
+    The study's biospecimens and genomic files are loaded in bulk and each
+    sample in the dbGaP xml, and each sample removed since the last run, is
+    compared to them in the same way the consent code function would. If a
+    store is configured the plan is saved under `plans/{accession}.json.gz`
+    so it can be applied later, otherwise the changes are returned.
+
+    :param study: The dbGaP study_id
+    :param context: The lambda context
+    :param dataservice_api: The url of the dataservice api
+    :param metrics: The metrics of the current run
+    :returns: A dict with the number of samples that were planned, that
+        failed or were skipped, and of biospecimens and genomic files that
+        would be updated
+    """
+    metrics = metrics or Metrics()
+    kf_id, version = get_study(study, dataservice_api)
+    accession = study+'.'+version
+    study_context = {
+        'dbgap_id': study,
+        'kf_id': kf_id,
+        'version': version,
+        'accession': accession
+    }
+    store = get_store()
+    previous = load_snapshot(store, accession) if store else None
+
+    with metrics.timer('dbgap_fetch'):
+        xml, _ = fetch_dbgap_xml(accession)
+    with xml:
+        rows = metrics.timed('dbgap_parse', parse_dbgap_xml(xml, accession))
+        samples = [pack_sample(row) for row in rows]
+    seen = {sample[0] for sample in samples}
+    samples.extend([sample_id, None, None] for sample_id in previous or ()
+                   if sample_id not in seen)
+
+    updater = AclUpdater(dataservice_api, context, prefetch=True,
+                         metrics=metrics, plan=True)
+    failed = {}
+    skipped = {}
+    records = event_records({'study': study_context, 'samples': samples})
+    with metrics.timer('prefetch'):
+        updater.prefetch_study(kf_id)
+    with metrics.timer('plan'):
+        for record in records:
+            sample_id = record.sample_id
+            try:
+                status = updater.update_acl(record)
+            except DataserviceException as err:
+                failed[sample_id] = str(err)
+                continue
+            if status is not True:
+                skipped[sample_id] = status
+
+    changes = updater.changes
+    res = {
+        'study': study_context,
+        'samples': len(records),
+        'failed': len(failed),
+        'skipped': len(skipped),
+        'biospecimens': len(changes['biospecimens']),
+        'genomic_files': len(changes['genomic-files'])
+    }
+    plan = dict(res, errors={**failed, **skipped}, changes=changes)
+    if store is not None:
+        res['plan'] = f'plans/{accession}.json.gz'
+        store.put(res['plan'],
+                  gzip.compress(json.dumps(plan).encode('utf-8')))
+    else:
+        res['changes'] = changes
+    return res
+
+
+def apply_plan(study, lam, consentcode, dataservice_api, metrics=None):
+    """
+    Sends the changes of the last plan made for a study to the consent code
+    function, in batches of at most `BATCH_MAX_RECORDS` changes
+
+    :param study: The dbGaP study_id
+    :param lam: A boto lambda client used to invoke lamda functions
+    :param consentcode: The name of the consent code function
+    :param dataservice_api: The url of the dataservice api
+    :param metrics: The metrics of the current run
+    :returns: A dict with the number of batches and changes sent and the
+        invocations that failed
+    """
+    _, version = get_study(study, dataservice_api)
+    store = get_store()
+    key = f'plans/{study}.{version}.json.gz'
+    body = store.get(key) if store is not None else None
+    if body is None:
+        raise PlanException(f'No plan has been made for {study}')
+    plan = json.loads(gzip.decompress(body).decode('utf-8'))
+
+    changes = [(entity, kf_id, change)
+               for entity, entities in sorted(plan['changes'].items())
+               for kf_id, change in entities.items()]
+
+    def payloads():
+        for i in range(0, len(changes), BATCH_MAX_RECORDS):
+            batch = {}
+            for entity, kf_id, change in changes[i:i+BATCH_MAX_RECORDS]:
+                batch.setdefault(entity, {})[kf_id] = change
+            yield encode_event({'changes': batch})
+
+    results = dispatch(lam, consentcode, payloads(), metrics=metrics)
+    return {'plan': key, 'batches': len(results), 'changes': len(changes),
+            'failed': [r for r in results if r['error']]}
+
+
+def diff_samples(previous, dbgap_codes, snapshot, full_sync=False):
+    """
+    Compares the samples in dbgap to the samples of a previous run
+
+    Samples that were removed from dbgap are sent whether or not every
+    sample is, as long as there is a previous run to find them in. The
+    first run of a study can't know which samples were removed before it,
+    so they keep whatever access they had.
+
+    :param previous: The snapshot of the previous run, or None to send every
+        sample
+    :param dbgap_codes: The tuples of (consent_code, sample_id, consent_name)
+        read from dbgap
+    :param snapshot: A dict that is filled with the snapshot of this run
+    :param full_sync: Send every sample, even if it did not change
+    :returns: A generator of packed samples for each sample that was added
+        or changed, followed by samples that were removed from dbgap, which
+        have no consent code or consent name
+    """
+    send_all = full_sync or previous is None
+    for row in dbgap_codes:
+        snapshot[row[1]] = [row[0], row[2]]
+        if send_all or previous.get(row[1]) != [row[0], row[2]]:
+            yield pack_sample(row)
+    if previous is not None:
+        for sample_id in previous:
+            if sample_id not in snapshot:
+                yield [sample_id, None, None]
+
+
+def load_snapshot(store, accession):
+    """
+    Loads the samples sent in the last run of a study version
+
+    :returns: A dict of sample_id to [consent_code, consent_name], or None
+        if the study version has not been run before
+    """
+    body = store.get(f'snapshots/{accession}.json.gz')
+    if body is None:
+        return None
+    return json.loads(gzip.decompress(body).decode('utf-8'))
+
+
+def save_snapshot(store, accession, snapshot):
+    """
+    Saves the samples sent in this run of a study version
+    """
+    body = gzip.compress(json.dumps(snapshot).encode('utf-8'))
+    store.put(f'snapshots/{accession}.json.gz', body)
+
+
+def load_failures(store, accession):
+    """
+    Loads the samples of a study version that the consent code function
+    failed to update, see `service.save_failures`
+
+    :returns: A tuple of the keys the failures were loaded from and the set
+        of sample ids that failed
+    """
+    keys = store.keys(f'failures/{accession}/')
+    failed = set()
+    for key in keys:
+        body = store.get(key)
+        if body is not None:
+            failed.update(json.loads(body.decode('utf-8')))
+    return keys, failed
+
+
+def clear_failures(store, keys):
+    """
+    Deletes the failures that a run sent again
+    """
+    for key in keys:
+        store.delete(key)
+
+
+def get_study(study, dataservice_api):
+    """
+    Gets the kf_id and dbgap released version of a study from the dataservice,
+    or from the study cache if it was looked up recently
+
+    :param study: The dbGaP study_id
+    :param dataservice_api: The url of the dataservice api
+    :returns: A tuple of (kf_id, version)
+    """
+    cached = STUDIES.get(study)
+    if cached:
+        return cached
+
     url = f'{dataservice_api}/studies?external_id={study}'
     resp = requests.get(url)
 
@@ -123,72 +660,337 @@ def map_one_study(study, lam, consentcode, dataservice_api):
     if len(resp.json()['results']) == 0:
         raise DataserviceException(f'Could not find a study for {study}')
 
+    kf_id = resp.json()['results'][0]['kf_id']
     version = resp.json()['results'][0]['version']
     # The study has no version registered in the dataservice
     if not version:
         raise DataserviceException(f'{study} has no version in dataservice')
 
-    # Need to now invoke new functions in batches to process each sample
-    dbgap_codes = read_dbgap_xml(study+'.'+version)
-    events = []
-    for row in dbgap_codes:
-        events.append(event_generator(study, row))
-    if len(events) > 0:
-        invoke(lam, consentcode, events)
+    STUDIES.set(study, kf_id, version)
+    return kf_id, version
 
 
-def read_dbgap_xml(accession):
+def read_dbgap_xml(accession, metrics=None):
     """
     Reads db_gap xml file and fetches consent code and external sample id
     for a given study
-    :returns: A list of tuples (consent_code, sample_id, consent_name)
+    :param metrics: The metrics of the current run, which record the time
+        taken to download and parse the xml
+    :returns: A generator of tuples (consent_code, sample_id, consent_name)
         for each sample in the study.
     """
-    url = (f'https://www.ncbi.nlm.nih.gov/projects/gap/cgi-bin/' +
-           f'GetSampleStatus.cgi?study_id={accession}&rettype=xml')
-    data = requests.get(url)
+    metrics = metrics or Metrics()
+    with metrics.timer('dbgap_fetch'):
+        xml, _ = fetch_dbgap_xml(accession)
+    return metrics.timed('dbgap_parse', parse_dbgap_xml(xml, accession))
+
+
+def fetch_dbgap_xml(accession, previous=None, named=False):
+    """
+    Downloads the db_gap xml file for a study to a temporary file
+
+    If the state of a previous download is given, the request is made
+    conditional on the xml having changed since, and the xml is also
+    compared to the hash of the previous download.
+
+    :param accession: The study accession
+    :param previous: The state returned by a previous download, or None
+    :param named: Download to a file that other processes can open by name,
+        which is deleted when it is closed
+    :returns: A tuple of the temporary file, or None if the xml is unchanged,
+        and the state of this download
+    """
+    url = f'{DBGAP_URL}?study_id={accession}&rettype=xml'
+    headers = {}
+    if previous and previous.get('etag'):
+        headers['If-None-Match'] = previous['etag']
+    if previous and previous.get('last_modified'):
+        headers['If-Modified-Since'] = previous['last_modified']
+
+    data = requests.get(url, headers=headers, stream=True)
+    if data.status_code == 304:
+        return None, dict(previous, bytes=0)
     if data.status_code != 200:
         raise DbGapException(f'Request for study {accession} returned non-200 '
                              f'status code: {data.status_code}')
 
-    data = xmltodict.parse(data.content)
-    study_status = list(dict_or_list('@registration_status', data))
+    if named:
+        xml = tempfile.NamedTemporaryFile()
+    else:
+        xml = tempfile.TemporaryFile()
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in data.iter_content(chunk_size=64*1024):
+        xml.write(chunk)
+        digest.update(chunk)
+        size += len(chunk)
+    xml.seek(0)
+
+    state = {
+        'etag': data.headers.get('ETag'),
+        'last_modified': data.headers.get('Last-Modified'),
+        'sha256': digest.hexdigest(),
+        'bytes': size
+    }
+    if previous and previous.get('sha256') == state['sha256']:
+        xml.close()
+        return None, state
+    return xml, state
+
+
+def load_fetch_state(store, accession):
+    """
+    Loads the state of the last download of a study's xml that was sent
 
-    if study_status[0] in ['released']:
-        dbgap_codes = zip(dict_or_list('@consent_code', data),
-                          dict_or_list('@submitted_sample_id', data),
-                          dict_or_list('@consent_short_name', data))
-        return dbgap_codes
+    :returns: A dict with the etag, last modified date and sha256 of the
+        xml, or None if the study has not been downloaded before
+    """
+    body = store.get(f'dbgap/{accession}.json')
+    if body is None:
+        return None
+    return json.loads(body.decode('utf-8'))
+
+
+def save_fetch_state(store, accession, state):
+    """
+    Saves the state of the download of a study's xml
+    """
+    state = {k: v for k, v in state.items() if k != 'bytes'}
+    store.put(f'dbgap/{accession}.json', json.dumps(state).encode('utf-8'))
+
+
+def parse_dbgap_xml(source, accession):
+    """
+    Incrementally parses a GetSampleStatus xml document.
+
+    The registration status of the study is checked as soon as the `<Study>`
+    element is opened, so unreleased studies are rejected before any of the
+    samples are read.
+
+    :param source: A filename or file object containing the xml
+    :param accession: The study accession, used in error messages
+    :returns: A generator of tuples (consent_code, sample_id, consent_name)
+        for each sample in the study.
+    """
+    events = ET.iterparse(source, events=('start', 'end'))
+    for event, elem in events:
+        if event == 'start' and elem.tag == 'Study':
+            status = elem.get('registration_status')
+            break
     else:
+        raise DbGapException(f'No study found in dbgap xml for {accession}')
+
+    if status not in ['released']:
         raise DbGapException(f'study {accession} is not released by dbgap. '
-                             f'registration_status: {study_status[0]}')
+                             f'registration_status: {status}')
 
+    return _iter_samples(events, elem)
 
-def invoke(lam, consentcode, records):
+
+def _iter_samples(events, study):
+    """
+    Yields sample tuples from an in-progress iterparse, discarding each
+    `<Sample>` element once it has been read so that memory use does not
+    grow with the number of samples in the study.
     """
-    Invokes the lambda for given records
+    parents = [study]
+    for event, elem in events:
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem is study:
+            return
+        if elem.tag == 'Sample':
+            # Consent codes and names repeat across the samples of a study
+            code = elem.get('consent_code')
+            name = elem.get('consent_short_name')
+            yield (code and sys.intern(code),
+                   elem.get('submitted_sample_id'),
+                   name and sys.intern(name))
+            elem.clear()
+            parents[-1].remove(elem)
+
+
+def invoke(lam, consentcode, study, samples, max_bytes=None,
+           max_records=None, metrics=None, checkpoint=None):
     """
-    payload = {'Records': records}
-    response = lam.invoke(
-        FunctionName=consentcode,
-        InvocationType='Event',
-        Payload=str.encode(json.dumps(payload)),
-    )
+    Invokes the lambda for the samples of a study, splitting them into as
+    many invocations as needed to respect the payload size and record limits
 
+    If payloads are compressed, see `codec`, up to
+    `ENCODED_BATCH_MAX_RECORDS` records are sent in each invocation instead
+    of `BATCH_MAX_RECORDS`.
+
+    Each payload is a batch of the form:
+    ```
+    {
+        "study": {
+            "dbgap_id": "phs001247",
+            "kf_id": "SD_00000000",
+            "version": "v1.p1",
+            "accession": "phs001247.v1.p1"
+        },
+        "samples": [
+            ["sample_id", "consent_code", "consent_short_name"]
+        ]
+    }
+    ```
 
-def event_generator(study, row):
+    :param lam: A boto lambda client used to invoke lamda functions
+    :param consentcode: The name of the function to invoke
+    :param study: The study context shared by every sample in the batch
+    :param samples: An iterable of packed samples to send
+    :param max_bytes: The maximum size of a single payload in bytes
+    :param max_records: The maximum number of records in a single payload
+    :param metrics: The metrics of the current run
+    :param checkpoint: The `StudyCheckpoint` to record sent batches in
+    :returns: A dict with the number of batches, records and bytes sent,
+        the invocations that failed and the number of throttled attempts
     """
-    Generates events for each sample in dbgap
+    metrics = metrics or Metrics()
+    stats = {}
+    payloads = study_payloads(study, samples, stats, max_bytes, max_records,
+                              checkpoint)
+
+    def sent(index, result):
+        if checkpoint is not None and not result['error']:
+            checkpoint.batch_sent(index)
+
+    results = dispatch(lam, consentcode, payloads, metrics=metrics,
+                       on_result=sent)
+    return batch_stats(stats, results, metrics)
+
+
+def study_payloads(study, samples, stats, max_bytes=None, max_records=None,
+                   checkpoint=None):
+    """
+    Splits the samples of a study into the payloads sent by `invoke`
+
+    :param study: The study context shared by every sample in the batch
+    :param samples: An iterable of packed samples to send
+    :param stats: A dict that is filled with the number of batches, records
+        and bytes in the payloads
+    :param max_bytes: The maximum size of a single payload in bytes
+    :param max_records: The maximum number of records in a single payload
+    :param checkpoint: The `StudyCheckpoint` to add each batch to
+    :returns: A generator of encoded payloads
+    """
+    stats.update({'batches': 0, 'records': 0, 'bytes': 0})
+    prefix = '{"study": ' + json.dumps(study) + ', "samples": ['
+    suffix = ']}'
+    if encoded():
+        batches = encoded_batches(study, samples, max_bytes, max_records)
+    else:
+        batches = ((len(batch),
+                    str.encode(prefix + ', '.join(batch) + suffix))
+                   for batch in batch_events(
+                       samples, max_bytes, max_records,
+                       overhead=len(prefix)+len(suffix)))
+    for records, payload in batches:
+        stats['batches'] += 1
+        stats['records'] += records
+        stats['bytes'] += len(payload)
+        if checkpoint is not None:
+            checkpoint.add_batch(records)
+        yield payload
+
+
+def batch_stats(stats, results, metrics):
+    """
+    Adds the invocations that failed and the number of throttled attempts
+    to the stats of a study's payloads, see `study_payloads`
+    """
+    stats['failed'] = [r for r in results if r['error']]
+    stats['throttled'] = sum(r['attempts'] - 1 for r in results)
+    metrics.incr('records_sent', stats['records'])
+    metrics.incr('payload_bytes', stats['bytes'])
+    return stats
+
+
+def batch_events(records, max_bytes=None, max_records=None, overhead=0):
+    """
+    Groups records into batches that will fit in a single invocation
+
+    Each record is serialized once and the serialized records are yielded so
+    that the payload does not need to be encoded a second time. A record that
+    is larger than `max_bytes` by itself is yielded in its own batch.
+
+    :param records: An iterable of records to batch
+    :param max_bytes: The maximum size of a batch's payload in bytes
+    :param max_records: The maximum number of records in a batch
+    :param overhead: The size of the payload around the records in bytes
+    :returns: A generator of lists of json encoded records
     """
-    ev = copy.deepcopy(record_template)
-    ev["study"]["dbgap_id"] = study
-    ev["study"]["sample_id"] = row[1]
-    ev["study"]["consent_code"] = row[0]
-    ev["study"]["consent_short_name"] = row[2]
-    return ev
+    max_bytes = max_bytes or BATCH_MAX_BYTES
+    max_records = max_records or BATCH_MAX_RECORDS
+    batch = []
+    size = overhead
+    for record in records:
+        encoded = json.dumps(record)
+        # Each record after the first is also separated by a `, `
+        record_size = len(encoded.encode('utf-8')) + (2 if batch else 0)
+        if batch and (size + record_size > max_bytes or
+                      len(batch) >= max_records):
+            yield batch
+            batch = []
+            size = overhead
+            record_size -= 2
+        batch.append(encoded)
+        size += record_size
+    if batch:
+        yield batch
 
 
-def map_to_studies(lam, invoker_func, dataservice_api):
+def encoded_batches(study, samples, max_bytes=None, max_records=None):
+    """
+    Groups samples into compressed payloads, see `codec.encode_event`
+
+    Batches of up to `max_records` samples are compressed, and split in half
+    until each payload fits in `max_bytes`.
+
+    :param study: The study context shared by every sample in the batch
+    :param samples: An iterable of packed samples to send
+    :param max_bytes: The maximum size of a single payload in bytes
+    :param max_records: The maximum number of records in a single payload
+    :returns: A generator of tuples of the number of samples in a payload
+        and the payload
+    """
+    max_bytes = max_bytes or BATCH_MAX_BYTES
+    max_records = max_records or ENCODED_BATCH_MAX_RECORDS
+
+    def fit(batch):
+        payload = encode_event({'study': study, 'samples': batch},
+                               compress=True)
+        if len(payload) <= max_bytes or len(batch) == 1:
+            yield len(batch), payload
+        else:
+            half = len(batch) // 2
+            yield from fit(batch[:half])
+            yield from fit(batch[half:])
+
+    batch = []
+    for sample in samples:
+        batch.append(sample)
+        if len(batch) >= max_records:
+            yield from fit(batch)
+            batch = []
+    if batch:
+        yield from fit(batch)
+
+
+def pack_sample(row):
+    """
+    Packs a sample from dbgap into the list sent in a batch's samples
+
+    :param row: A tuple of (consent_code, sample_id, consent_name)
+    :returns: A list of [sample_id, consent_code, consent_name]
+    """
+    return [row[1], row[0], row[2]]
+
+
+def map_to_studies(lam, invoker_func, dataservice_api, full_sync=False,
+                   metrics=None, plan=False, apply=False):
     """
     Gets all studies in the dataservice and re-calls this lambda for each
     providing the study_id as a parameter in the event.
@@ -197,25 +999,28 @@ def map_to_studies(lam, invoker_func, dataservice_api):
     :param invoker_func: The name of the current function to call again to
         process a given study
     :param dataservice_api: The url of the dataservice api
+    :param full_sync: Have each study send every sample
+    :param metrics: The metrics of the current run
+    :param plan: Have each study plan its changes instead of making them
+    :param apply: Have each study apply its last plan
+    :returns: A dict with the number of studies invoked and any failures
     """
-    url = f'{dataservice_api}/studies?limit=100'
-    resp = requests.get(url)
-
-    if resp.status_code != 200:
-        raise DataserviceException(f'Problem requesting dataservice: '
-                                   f'{url}, {resp.content}')
-    if 'total' not in resp.json() or resp.json()['total'] == 0:
+    pages = iter_pages(requests.get, f'{dataservice_api}/studies?limit=100')
+    first = next(pages)
+    if 'total' not in first or first['total'] == 0:
         raise DataserviceException(f'Dataservice has no studies')
 
-    for r in resp.json()['results']:
-        payload = {'study': r['external_id']}
-        response = lam.invoke(
-            FunctionName=invoker_func,
-            InvocationType='Event',
-            Payload=str.encode(json.dumps(payload)),
-        )
+    # Following pages are only requested as the studies are dispatched
+    studies = chain(first['results'],
+                    (r for page in pages for r in page['results']))
+    payloads = (encode_event({'study': r['external_id'],
+                              'full_sync': full_sync,
+                              'plan': plan,
+                              'apply': apply})
+                for r in studies)
+    results = dispatch(lam, invoker_func, payloads, metrics=metrics)
 
-    total = resp.json()['total']
+    total = first['total']
     attachments = [
         {"fallback": "I'm about to update consent codes"
          " for `{}` studies,' hold tight...".format(total),
@@ -225,6 +1030,223 @@ def map_to_studies(lam, invoker_func, dataservice_api):
          }
     ]
     send_slack(attachments=attachments)
+    return {'studies': len(results),
+            'failed': [r for r in results if r['error']]}
+
+
+def map_studies_in_process(lam, consentcode, dataservice_api, full_sync=False,
+                           metrics=None, fetch_workers=None,
+                           parse_workers=None, context=None):
+    """
+    Sends the samples of every study in the dataservice from this function,
+    instead of invoking it again for each study
+
+    The xml of up to `fetch_workers` studies is downloaded at once and each
+    download is parsed on a pool of `parse_workers` processes, see
+    `parse_pool`. The samples of each study are sent to the consent code
+    function as soon as its xml is parsed, sharing a single dispatcher so
+    that the invocations of one study overlap with those of the next.
+    Studies are only downloaded a few ahead of the one being sent, so that
+    the xml and samples of every study are not held at once.
+
+    Each study is run as `map_one_study` runs it, including its snapshot and
+    checkpoint, and a study that fails does not stop the others. Once less
+    than `STUDY_RESERVE_MS` is left in the function no more studies are
+    started, and the studies that were not are returned so they can be run
+    again.
+
+    :param lam: A boto lambda client used to invoke lamda functions
+    :param consentcode: The name of the function that will be called for
+        each sample to update it inside the dataservice
+    :param dataservice_api: The url of the dataservice api
+    :param full_sync: Send every sample regardless of the previous run
+    :param metrics: The metrics of the current run
+    :param fetch_workers: The number of studies to download at once
+    :param parse_workers: The number of processes to parse xml on
+    :param context: The lambda context, to stop starting studies before the
+        function times out
+    :returns: A dict with the number of studies, the stats of each study
+        that was run, the error of each study that failed and the studies
+        that were not started
+    """
+    metrics = metrics or Metrics()
+    fetch_workers = fetch_workers or FETCH_CONCURRENCY
+    parse_workers = parse_workers or PARSE_PROCESSES
+    pages = iter_pages(requests.get, f'{dataservice_api}/studies?limit=100')
+    first = next(pages)
+    if 'total' not in first or first['total'] == 0:
+        raise DataserviceException('Dataservice has no studies')
+    studies = chain(first['results'],
+                    (r for page in pages for r in page['results']))
+    studies = (r['external_id'] for r in studies)
+
+    res = {'studies': first['total'], 'results': {}, 'failed': {}}
+    not_started = []
+
+    def out_of_time():
+        return (context is not None and
+                context.get_remaining_time_in_millis() < STUDY_RESERVE_MS)
+
+    def fail(study, err):
+        # Any error, such as a lost connection or a broken parse pool, only
+        # fails its own study
+        known = (DataserviceException, DbGapException, ET.ParseError)
+        if isinstance(err, known):
+            res['failed'][study] = str(err)
+        else:
+            res['failed'][study] = repr(err)
+
+    def fetch(study):
+        run = StudyRun(study, dataservice_api, full_sync=full_sync,
+                       metrics=metrics)
+        run.fetch(named=True)
+        return run
+
+    def parsed(fetch_pool, parsers):
+        """
+        Yields each study run with the samples in its xml, in the order
+        they are parsed
+        """
+        fetching = {}
+        parsing = {}
+        pending = set()
+
+        def start():
+            # Keep every worker busy, but no more studies than that
+            if out_of_time():
+                return
+            for study in islice(studies, 1):
+                future = fetch_pool.submit(fetch, study)
+                fetching[future] = study
+                pending.add(future)
+
+        for _ in range(fetch_workers + parse_workers):
+            start()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                if future in fetching:
+                    study = fetching.pop(future)
+                    try:
+                        run = future.result()
+                    except Exception as err:
+                        fail(study, err)
+                        start()
+                        continue
+                    if run.xml is None:
+                        res['results'][study] = run.unchanged()
+                        start()
+                        continue
+                    try:
+                        future = parsers.submit(parse_study_xml,
+                                                run.xml.name, run.accession)
+                    except Exception as err:
+                        run.xml.close()
+                        fail(study, err)
+                        start()
+                        continue
+                    parsing[future] = run
+                    pending.add(future)
+                    continue
+                run = parsing.pop(future)
+                run.xml.close()
+                try:
+                    dbgap_codes, seconds = future.result()
+                except Exception as err:
+                    fail(run.study, err)
+                else:
+                    metrics.timing('dbgap_parse', seconds * 1000)
+                    yield run, dbgap_codes
+                start()
+
+    def finish(run):
+        try:
+            stats = batch_stats(run.stats, run.results, metrics)
+            res['results'][run.study] = run.finish(stats)
+        except Exception as err:
+            fail(run.study, err)
+
+    # The study run and batch of each payload that is waiting for a result
+    owners = {}
+    dispatched = count()
+
+    def payloads(runs):
+        for run, dbgap_codes in runs:
+            if out_of_time():
+                not_started.append(run.study)
+                continue
+            try:
+                batches = study_payloads(run.context,
+                                         run.samples(dbgap_codes),
+                                         run.stats, checkpoint=run.checkpoint)
+                for index, payload in enumerate(batches):
+                    owners[next(dispatched)] = (run, index)
+                    yield payload
+            except Exception as err:
+                # The batches already sent are saved to the checkpoint
+                fail(run.study, err)
+                continue
+            if run.all_sent(run.stats['batches']):
+                finish(run)
+
+    def sent(index, result):
+        run, batch = owners.pop(index)
+        if run.batch_done(batch, result):
+            finish(run)
+
+    with ThreadPoolExecutor(max_workers=fetch_workers) as fetch_pool, \
+            parse_pool(parse_workers) as parsers:
+        runs = parsed(fetch_pool, parsers)
+        dispatch(lam, consentcode, payloads(runs), metrics=metrics,
+                 on_result=sent)
+
+    not_started.extend(studies)
+    if not_started:
+        res['not_started'] = sorted(not_started)
+        print(f'not able to start {len(not_started)} studies before the '
+              'function times out')
+
+    if res['failed']:
+        msg = 'Problem invoking for {} studies: {}'.format(
+            len(res['failed']),
+            ', '.join(f'`{s}`' for s in sorted(res['failed'])))
+        send_slack(attachments=[{
+            'fallback': msg,
+            'text': msg,
+            'color': 'danger'
+        }])
+    return res
+
+
+def parse_pool(workers=None):
+    """
+    Returns a pool of processes to parse xml on, or a pool of threads if
+    processes can't be started here
+
+    Lambda has no /dev/shm, which the process pool's queues need.
+
+    :param workers: The number of workers in the pool
+    """
+    workers = workers or PARSE_PROCESSES
+    try:
+        return ProcessPoolExecutor(max_workers=workers)
+    except (OSError, NotImplementedError):
+        return ThreadPoolExecutor(max_workers=workers)
+
+
+def parse_study_xml(path, accession):
+    """
+    Parses the xml of a study on a worker of the parse pool
+
+    :param path: The path of the study's xml
+    :param accession: The study accession
+    :returns: A tuple of a list of (consent_code, sample_id, consent_name)
+        for each sample in the study, and the seconds taken to parse them
+    """
+    start = time.monotonic()
+    dbgap_codes = list(parse_dbgap_xml(path, accession))
+    return dbgap_codes, time.monotonic() - start
 
 
 def send_slack(msg=None, attachments=None):
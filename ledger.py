@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+import boto3
+
+# Days that an applied record is remembered for. Changes made to the
+# dataservice by anything else, such as a biospecimen's visibility, are not
+# seen while a record is remembered, unless its study is fully synced.
+LEDGER_TTL_DAYS = float(os.environ.get('LEDGER_TTL_DAYS', 7))
+# Number of applied records that are written to the ledger at once
+LEDGER_BATCH_SIZE = int(os.environ.get('LEDGER_BATCH_SIZE', 100))
+
+
+def get_ledger():
+    """
+    Returns the ledger of records that were already applied, or None if no
+    ledger is configured.
+
+    The DynamoDB table `LEDGER_TABLE` is used if it is set, with a string
+    hash key named `key`. Otherwise the sqlite database at `LEDGER_PATH` is
+    used.
+    """
+    table = os.environ.get('LEDGER_TABLE', None)
+    if table:
+        return DynamoLedger(table)
+    path = os.environ.get('LEDGER_PATH', None)
+    if path:
+        return SqliteLedger(path)
+    return None
+
+
+def ledger_entry(record):
+    """
+    Returns the ledger key of a `service.Record` and the digest of the
+    consent code and acl it sets, or None if the record's study version is
+    not known
+
+    The key is the study accession and the sample id, eg:
+    `phs001247.v1.p1/SAMPLE-1`, so each sample has a single entry that is
+    replaced when its consent code changes.
+    """
+    study = record.study
+    if not study.get('version'):
+        return None
+    key = '{}.{}/{}'.format(study['dbgap_id'], study['version'],
+                            record.sample_id)
+    # The acl is made from the consent code and the study's ids
+    target = json.dumps([study.get('kf_id'), record.consent_code,
+                         record.consent_short_name])
+    return key, hashlib.sha1(target.encode('utf-8')).hexdigest()[:16]
+
+
+class SqliteLedger:
+    """
+    Keeps the ledger in a local sqlite database
+    """
+
+    def __init__(self, path, ttl_days=None):
+        self.ttl = (LEDGER_TTL_DAYS if ttl_days is None else ttl_days) * 86400
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS ledger ('
+                            'key TEXT PRIMARY KEY, digest TEXT, '
+                            'expires INTEGER) WITHOUT ROWID')
+            self.db.execute('DELETE FROM ledger WHERE expires < ?',
+                            (int(time.time()),))
+
+    def get_many(self, keys):
+        """
+        Returns a dict of the digest of each key that is in the ledger
+        """
+        found = {}
+        keys = list(keys)
+        now = int(time.time())
+        with self.lock:
+            # Stay below sqlite's limit on the number of parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                rows = self.db.execute(
+                    'SELECT key, digest FROM ledger WHERE expires >= ? AND '
+                    'key IN ({})'.format(','.join('?' * len(chunk))),
+                    [now] + chunk)
+                found.update(rows)
+        return found
+
+    def put_many(self, entries):
+        """
+        Records the (key, digest) of each record that was applied
+        """
+        expires = int(time.time() + self.ttl)
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO ledger VALUES (?, ?, ?)',
+                [(key, digest, expires) for key, digest in entries])
+
+
+class DynamoLedger:
+    """
+    Keeps the ledger in a DynamoDB table
+
+    Entries have an `expires` attribute so that the table's time to live can
+    delete them.
+    """
+
+    def __init__(self, table, ttl_days=None):
+        self.table = table
+        self.ttl = (LEDGER_TTL_DAYS if ttl_days is None else ttl_days) * 86400
+        self.dynamodb = boto3.client('dynamodb')
+
+    def get_many(self, keys):
+        """
+        Returns a dict of the digest of each key that is in the ledger
+        """
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        # Batches are limited to 100 keys
+        for i in range(0, len(keys), 100):
+            request = {self.table: {
+                'Keys': [{'key': {'S': key}} for key in keys[i:i+100]],
+                'ProjectionExpression': '#k, digest, expires',
+                'ExpressionAttributeNames': {'#k': 'key'}
+            }}
+            attempt = 0
+            while request:
+                if attempt:
+                    backoff(attempt)
+                resp = self.dynamodb.batch_get_item(RequestItems=request)
+                for item in resp['Responses'].get(self.table, []):
+                    # Expired items are only deleted eventually
+                    if float(item['expires']['N']) >= now:
+                        found[item['key']['S']] = item['digest']['S']
+                request = resp.get('UnprocessedKeys')
+                attempt += 1
+        return found
+
+    def put_many(self, entries):
+        """
+        Records the (key, digest) of each record that was applied
+        """
+        expires = str(int(time.time() + self.ttl))
+        entries = list(dict(entries).items())
+        # Batches are limited to 25 items
+        for i in range(0, len(entries), 25):
+            request = {self.table: [
+                {'PutRequest': {'Item': {'key': {'S': key},
+                                         'digest': {'S': digest},
+                                         'expires': {'N': expires}}}}
+                for key, digest in entries[i:i+25]]}
+            attempt = 0
+            while request:
+                if attempt:
+                    backoff(attempt)
+                resp = self.dynamodb.batch_write_item(RequestItems=request)
+                request = resp.get('UnprocessedItems')
+                attempt += 1
+
+
+def backoff(attempt):
+    """
+    Waits before sending the items DynamoDB did not process again
+    """
+    time.sleep(min(0.05 * 2 ** attempt, 2))
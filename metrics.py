@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# The CloudWatch namespace that metrics are published under
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'KfDbgapConsent')
+
+# Upper bounds in milliseconds of the latency histogram buckets
+BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+
+class Histogram:
+    """
+    Counts latencies in fixed buckets so that memory use does not grow with
+    the number of calls
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ms):
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def add_summary(self, summary):
+        """
+        Adds the latencies of a histogram's summary to this histogram
+        """
+        for bound, count in summary['buckets'].items():
+            i = len(BUCKETS) if bound == 'inf' else BUCKETS.index(int(bound))
+            self.counts[i] += count
+        self.count += summary['count']
+        self.total += summary['total_ms']
+        self.max = max(self.max, summary['max_ms'])
+
+    def percentile(self, p):
+        """
+        Returns the upper bound of the bucket holding the given percentile,
+        which is never more than the largest latency seen
+        """
+        if not self.count:
+            return None
+        rank = p * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                bound = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_ms': round(self.total, 3),
+            'mean_ms': round(self.total / self.count, 3),
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max, 3),
+            'buckets': {
+                (str(BUCKETS[i]) if i < len(BUCKETS) else 'inf'): count
+                for i, count in enumerate(self.counts) if count
+            }
+        }
+
+
+class Metrics:
+    """
+    Collects the counts and latencies of one run of a handler
+
+    Metrics can be recorded from several threads at once. At the end of a
+    run `emit` prints them in the CloudWatch embedded metric format so they
+    are published from the function's logs, and `summary` returns them to be
+    included in the handler's response.
+
+    :param dimensions: A dict of CloudWatch dimensions for the metrics
+    """
+
+    def __init__(self, dimensions=None):
+        self.dimensions = dimensions or {}
+        self.counts = {}
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        """
+        Adds to a count
+        """
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def timing(self, name, ms):
+        """
+        Records a latency in milliseconds
+        """
+        with self.lock:
+            if name not in self.latencies:
+                self.latencies[name] = Histogram()
+            self.latencies[name].add(ms)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Records the time taken by the body of a `with` block
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timing(name, (time.monotonic() - start) * 1000)
+
+    def timed(self, name, iterable):
+        """
+        Yields from an iterable, recording the total time spent producing
+        its items as a single latency
+        """
+        spent = 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.monotonic()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    spent += time.monotonic() - start
+                yield item
+        finally:
+            self.timing(name, spent * 1000)
+
+    def add_summary(self, summary):
+        """
+        Adds the counts and latencies of another run's summary, eg: to total
+        the metrics of every function that processed a study
+        """
+        with self.lock:
+            for name, value in summary['counts'].items():
+                self.counts[name] = self.counts.get(name, 0) + value
+            for name, other in summary['latency'].items():
+                if name not in self.latencies:
+                    self.latencies[name] = Histogram()
+                self.latencies[name].add_summary(other)
+
+    def summary(self):
+        """
+        Returns the counts and a summary of each latency histogram
+        """
+        with self.lock:
+            return {
+                'counts': dict(self.counts),
+                'latency': {name: hist.summary()
+                            for name, hist in self.latencies.items()}
+            }
+
+    def emit(self):
+        """
+        Prints the metrics as a CloudWatch embedded metric format document
+        """
+        with self.lock:
+            doc = dict(self.dimensions)
+            definitions = []
+            for name, value in self.counts.items():
+                doc[name] = value
+                definitions.append({'Name': name, 'Unit': 'Count'})
+            for name, hist in self.latencies.items():
+                for stat in ['p50', 'p99', 'max']:
+                    key = f'{name} {stat}'
+                    doc[key] = (hist.max if stat == 'max'
+                                else hist.percentile(int(stat[1:]) / 100))
+                    definitions.append({'Name': key, 'Unit': 'Milliseconds'})
+            doc['_aws'] = {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [list(self.dimensions)],
+                    'Metrics': definitions
+                }]
+            }
+        print(json.dumps(doc))
+        return doc
+
+
+def endpoint(method, url):
+    """
+    Names the dataservice endpoint of a request, eg: `PATCH biospecimens`,
+    leaving out the kf_ids of individual entities
+    """
+    parts = [p for p in urlparse(url).path.split('/') if p]
+    parts = [p for p in parts
+             if not (len(p) == 11 and p[2] == '_' and p[:2].isupper())]
+    return '{} {}'.format(method.upper(), parts[-1] if parts else '/')
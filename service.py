@@ -1,11 +1,50 @@
-from botocore.vendored import requests
 import os
+import sys
 import boto3
 import json
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+from codec import decode_event, encode_event, encoded, is_encoded
+from dataservice import (BULK_CHUNK_SIZE, MIN_REQUEST_TIMEOUT,
+                         DataserviceException, NotSentException, STUDIES,
+                         get_client)
+from invocations import dispatch
+from ledger import LEDGER_BATCH_SIZE, get_ledger, ledger_entry
+from metrics import Metrics
+from store import get_store
 
-class DataserviceException(Exception):
-    pass
+# Number of records that are processed concurrently
+WORKERS = int(os.environ.get('WORKERS', 8))
+# Batches with at least this many records may load every biospecimen in the
+# study up front instead of looking each sample up individually, if that is
+# expected to be quicker, see `worth_prefetching`
+PREFETCH_MIN_RECORDS = int(os.environ.get('PREFETCH_MIN_RECORDS', 50))
+# Requests made to look a record up on its own: its biospecimen and the
+# listing of its genomic files
+LOOKUP_REQUESTS = 2
+# Results in each page of the listings that are prefetched
+PAGE_SIZE = 100
+# Milliseconds kept in reserve at the end of an invocation to pass the
+# remaining records on to new functions
+RESERVE_MS = int(os.environ.get('RESERVE_MS', 5000))
+# Most new functions that the remaining records of an invocation are passed
+# on to, however slow the records were
+MAX_CONTINUATIONS = int(os.environ.get('MAX_CONTINUATIONS', 4))
+# Number of times a record is tried before it is sent to the dead letter
+# output, and the delay in seconds before each retry, multiplied by the
+# number of attempts so far
+MAX_ATTEMPTS = int(os.environ.get('MAX_ATTEMPTS', 3))
+RECORD_RETRY_DELAY = float(os.environ.get('RECORD_RETRY_DELAY', 1))
+# Returned by `AclUpdater.update_acl` for records the ledger shows were
+# already applied
+ALREADY_APPLIED = 'Already applied'
+# Statuses of records that were not updated, but may be if they are tried
+# again, which the next run of their study sends again, see `save_failures`
+RETRIED_STATUSES = ['dead_letter']
 
 
 class TimeoutException(Exception):
@@ -15,62 +54,784 @@ class TimeoutException(Exception):
 def handler(event, context):
     """
     Update dbgap_consent_code in biospecimen and acl's in genomic file
-    from a list of lambda events. If all events are not processed before
-    the lambda runs out of time, the remaining will be submitted to
-    a new function
+    from a batch of samples, or apply a change set, see `apply_changes`.
+    Records that are not finished before the lambda runs out of time are
+    passed on to a new function. The event formats are described in the
+    README.
     """
     DATASERVICE = os.environ.get('DATASERVICE', None)
 
     if DATASERVICE is None:
         return 'no dataservice url set'
-    updater = AclUpdater(DATASERVICE, context)
-    res = {}
-    while len(event['Records']) > 0:
-        if (hasattr(context, 'invoked_function_arn') and
-                context.get_remaining_time_in_millis() < 15000):
-            print('not able to complete {} records, '
-                  're-invoking the function'.format(len(event['Records'])))
-            lam = boto3.client('lambda')
-            # Invoke the lambda again with remaining records
-            response = lam.invoke(
-                FunctionName=context.invoked_function_arn,
-                InvocationType='Event',
-                Payload=str.encode(json.dumps(event))
-            )
-            # Stop processing and exit
-            break
+    compress = is_encoded(event) or encoded()
+    event = decode_event(event)
+    if 'changes' in event:
+        return apply_changes(event, context, DATASERVICE, compress=compress)
+    plan = event.get('plan', False)
+    records = event_records(event)
+    metrics = Metrics({'Handler': 'service'})
+    client = get_client(DATASERVICE, pool_size=WORKERS)
+    prefetch = plan or worth_prefetching(client, records, context, metrics)
+    bulk = (prefetch and not plan and BULK_CHUNK_SIZE > 0 and
+            client.bulk_supported is not False)
+    updater = AclUpdater(DATASERVICE, context, prefetch=prefetch,
+                         metrics=metrics, plan=plan, bulk=bulk,
+                         ledger=None if plan else get_ledger())
+    updater.load_ledger(records)
+    scheduler = Scheduler(context, WORKERS)
+    processed = process_records(updater, records, scheduler)
+    res = {'results': processed['results'], 'remaining': 0,
+           'continuations': 0}
+    if processed['circuit_open']:
+        res['circuit_open'] = True
+    offset = processed['offset']
+    dead_letters = processed['dead_letters']
+    updater.save_ledger()
+    if dead_letters:
+        send_dead_letters(dead_letters)
+        res['dead_letters'] = len(dead_letters)
+    if not plan:
+        save_failures(event, res['results'])
+    retried = processed['retried']
+    remaining = len(records) - offset + len(retried)
+    if remaining and plan:
+        # The change set of a new function would not be returned to the
+        # caller, so the records that were not planned are returned instead
+        res['remaining'] = remaining
+        res['unplanned'] = remaining_items(event, offset, retried)
+    elif remaining:
+        print('not able to complete {} records, '
+              're-invoking the function'.format(remaining))
+        events = continuation_events(event, offset, retried, scheduler)
+        failed = reinvoke(context, events, compress=compress,
+                          metrics=metrics)
+        res['remaining'] = remaining
+        res['continuations'] = len(events)
+        if failed:
+            res['continuations_failed'] = failed
+    res['latency_ms'] = scheduler.stats()
+    res['connections'] = updater.client.connection_stats()
+    if updater.duplicates:
+        res['duplicates'] = {study: sorted(ids)
+                             for study, ids in updater.duplicates.items()
+                             if ids}
+    if plan:
+        res['changes'] = updater.changes
+    for result in res['results']:
+        metrics.incr('records_'+result['status'])
+    metrics.incr('records_remaining', res['remaining'])
+    metrics.incr('continuations', res['continuations'])
+    res['metrics'] = metrics.summary()
+    metrics.emit()
+    return res
+
+
+def process_records(updater, records, scheduler, workers=None):
+    """
+    Updates records on a pool of threads until they are done or the
+    scheduler expects the function to run out of time
+
+    Records that fail with an unexpected error are retried after a delay
+    until they have been tried `MAX_ATTEMPTS` times, and records that were
+    not tried because the circuit breaker was open or the function ran out
+    of time are started again. When writing in bulk the collected updates
+    are sent before a record's result is returned, and records whose
+    updates were all made are added to the ledger.
+
+    :param updater: The `AclUpdater` to update the records with
+    :param records: A list of `Record`s
+    :param scheduler: The `Scheduler` that decides whether a record can be
+        started
+    :param workers: The number of records to update at once
+    :returns: A dict with the result of each record that was finished, the
+        dead letters of the records that used up their attempts, the
+        `offset` of the first record that was not started, the records that
+        were started but are `retried` later, and whether the circuit
+        breaker was open
+    """
+    workers = workers or WORKERS
+    metrics = updater.metrics
+    res = {'results': [], 'dead_letters': [], 'circuit_open': False}
+    # Records are started in order from `offset`, so the records that were
+    # not started are the end of the list. Records that were not tried
+    # because the circuit breaker was open are started again first.
+    offset = 0
+    requeued = []
+    # Records waiting to be retried, with the time they can next be started
+    retries = []
+    # Records whose updates were collected but not sent yet, with their
+    # results
+    pending = []
+
+    def waiting():
+        return offset < len(records) or requeued
+
+    def fail(record, error):
+        """
+        Retries a record later, or sends it to the dead letter output once
+        it has used up its attempts
+        """
+        record = record._replace(attempts=record.attempts + 1)
+        if record.attempts >= MAX_ATTEMPTS:
+            res['dead_letters'].append({'record': record.to_dict(),
+                                        'error': error})
+            res['results'].append(dict(record_summary(record),
+                                       status='dead_letter', error=error))
         else:
+            retries.append((time.time() +
+                            RECORD_RETRY_DELAY * record.attempts, record))
+
+    def flush():
+        """
+        Sends the collected updates and completes or retries their records
+        """
+        nonlocal pending
+        if not pending:
+            return
+        with metrics.timer('flush'):
+            failures, unsent = updater.flush()
+        for record, result in pending:
+            error = failures.get(record.sample_id)
+            if error is not None:
+                fail(record, error)
+            elif record.sample_id in unsent:
+                # The record was not tried, so it is not an attempt
+                requeued.append(record)
+            else:
+                res['results'].append(result)
+                updater.mark_applied(record)
+        pending = []
+
+    def collecting():
+        # Records are only started while their updates fit in the bulk
+        # update that is collected, so that each flush sends full chunks
+        if not updater.bulk:
+            return True
+        return len(pending) + len(in_flight) < BULK_CHUNK_SIZE
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = {}
+        breaker = updater.client.breaker
+        while waiting() or retries or in_flight or pending:
+            more = (waiting() and scheduler.can_start() and
+                    not breaker.is_open())
+            if (pending and not in_flight and
+                    (len(pending) >= BULK_CHUNK_SIZE or not more)):
+                flush()
+            now = time.time()
+            due = [r for r in retries if r[0] <= now]
+            if due and not waiting():
+                retries = [r for r in retries if r[0] > now]
+                requeued = [record for _, record in due]
+            while (waiting() and len(in_flight) < workers and
+                   collecting() and scheduler.can_start() and
+                   not breaker.is_open()):
+                if requeued:
+                    record = requeued.pop()
+                else:
+                    record = records[offset]
+                    offset += 1
+                future = pool.submit(updater.update_acl, record)
+                in_flight[future] = (record, time.time())
+            if not in_flight:
+                # Collected updates are sent before stopping, and records
+                # whose updates fail are passed on with the rest
+                if not scheduler.can_start():
+                    flush()
+                    break
+                # Wait for the dataservice to recover while there is time,
+                # otherwise pass the records on to a new function
+                if waiting() and breaker.is_open():
+                    res['circuit_open'] = True
+                    time.sleep(min(breaker.remaining(), 1))
+                    continue
+                if retries:
+                    wait_for = min(due for due, _ in retries) - time.time()
+                    time.sleep(min(max(wait_for, 0), 1))
+                    continue
+                if pending:
+                    flush()
+                    continue
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                record, started = in_flight.pop(future)
+                scheduler.record((time.time() - started) * 1000)
+                metrics.timing('record', (time.time() - started) * 1000)
+                result = record_result(record, future)
+                if result is not None:
+                    if updater.bulk and result['status'] == 'updated':
+                        pending.append((record, result))
+                    else:
+                        res['results'].append(result)
+                        if result['status'] == 'updated':
+                            updater.mark_applied(record)
+                elif isinstance(future.exception(), NotSentException):
+                    # The circuit breaker opened or the function ran out of
+                    # time before the record was tried, so it is not an
+                    # attempt
+                    requeued.append(record)
+                else:
+                    fail(record, repr(future.exception()))
+
+    res['offset'] = offset
+    # Records waiting to be retried are passed on with the rest
+    res['retried'] = requeued + [record for _, record in retries]
+    return res
+
+
+def reinvoke(context, events, compress=None, metrics=None):
+    """
+    Invokes the function again for each event, in parallel, retrying
+    invocations that are throttled, see `invocations.dispatch`
+
+    Events that still can't be invoked are sent to the dead letter output
+    rather than failing this function, which would have every event it
+    received delivered again.
+
+    :param compress: Whether to compress the events, see
+        `codec.encode_event`
+    :param metrics: The metrics of the current run
+    :returns: The number of events that could not be invoked
+    """
+    lam = boto3.client('lambda')
+    payloads = (encode_event(event, compress=compress) for event in events)
+    results = dispatch(lam, context.invoked_function_arn, payloads,
+                       max_workers=min(len(events), MAX_CONTINUATIONS),
+                       metrics=metrics)
+    failed = [{'event': event, 'error': result['error']}
+              for event, result in zip(events, results) if result['error']]
+    if failed:
+        send_dead_letters(failed)
+    return len(failed)
+
+
+def apply_changes(event, context, api, compress=None):
+    """
+    Applies a change set made in plan mode:
+    ```
+    {
+        "changes": {
+            "biospecimens": {"BS_00000000": {"dbgap_consent_code": ...,
+                                             "consent_type": ...}},
+            "genomic-files": {"GF_00000000": {"acl": [...]}}
+        }
+    }
+    ```
+
+    Each change is sent as is, so a change set can be applied more than
+    once. Changes are sent in bulk updates of `BULK_CHUNK_SIZE` entities if
+    the dataservice accepts them, otherwise one at a time. Changes that are
+    not sent before the function runs out of time, including changes that
+    wait for the dataservice circuit breaker to close, are passed on to a
+    new function.
+
+    Changes that fail are passed on to a new function of their own, with
+    the number of `"attempts"` made so far in the event, until they have
+    been tried `MAX_ATTEMPTS` times. They are then sent to the dead letter
+    output, see `send_dead_letters`.
+
+    :param compress: Whether to compress the events passed on, see
+        `codec.encode_event`
+    :returns: A dict with the outcome of each change, the number of changes
+        that were passed on and a summary of the run's metrics
+    """
+    client = get_client(api, pool_size=WORKERS)
+    metrics = Metrics({'Handler': 'service'})
+    scheduler = Scheduler(context, WORKERS)
+    size = max(BULK_CHUNK_SIZE, 1)
+    attempts = event.get('attempts', 0)
+    chunks = []
+    for entity, entities in sorted(event['changes'].items()):
+        items = list(entities.items())
+        chunks.extend((entity, dict(items[i:i+size]))
+                      for i in range(0, len(items), size))
+    res = {'results': [], 'remaining': 0, 'continuations': 0}
+    # The changes that failed, with their errors
+    failed = {}
+
+    def send(entity, chunk):
+        # Chunks are already sent concurrently
+        return client.bulk_patch(entity, chunk, max_workers=1,
+                                 deadline=request_deadline(context),
+                                 metrics=metrics)
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        in_flight = {}
+        breaker = client.breaker
+        while chunks or in_flight:
+            while (chunks and len(in_flight) < WORKERS and
+                   scheduler.can_start() and not breaker.is_open()):
+                chunk = chunks.pop()
+                in_flight[pool.submit(send, *chunk)] = (chunk, time.time())
+            if not in_flight:
+                if chunks and breaker.is_open() and scheduler.can_start():
+                    res['circuit_open'] = True
+                    time.sleep(min(breaker.remaining(), 1))
+                    continue
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                (entity, chunk), started = in_flight.pop(future)
+                scheduler.record((time.time() - started) * 1000)
+                errors, unsent = future.result()
+                if unsent:
+                    # Changes that were not sent are sent again later
+                    chunks.append((entity, {kf_id: chunk.pop(kf_id)
+                                            for kf_id in unsent}))
+                for kf_id, change in chunk.items():
+                    error = errors.get(kf_id)
+                    if not error:
+                        status = 'updated'
+                    elif attempts + 1 >= MAX_ATTEMPTS:
+                        status = 'dead_letter'
+                    else:
+                        status = 'failed'
+                    if error:
+                        failed.setdefault(entity, {})[kf_id] = (change, error)
+                    metrics.incr(f'{entity}_{status}')
+                    res['results'].append({'entity': entity, 'kf_id': kf_id,
+                                           'status': status, 'error': error})
+
+    events = []
+    if chunks:
+        for split in scheduler.split(chunks):
+            remaining = {}
+            for entity, chunk in split:
+                remaining.setdefault(entity, {}).update(chunk)
+            events.append({'changes': remaining})
+            if attempts:
+                events[-1]['attempts'] = attempts
+        res['remaining'] = sum(len(chunk) for _, chunk in chunks)
+    if failed and attempts + 1 >= MAX_ATTEMPTS:
+        dead_letters = [{'changes': {entity: {kf_id: change}},
+                         'attempts': attempts + 1, 'error': error}
+                        for entity, entities in failed.items()
+                        for kf_id, (change, error) in entities.items()]
+        send_dead_letters(dead_letters)
+        res['dead_letters'] = len(dead_letters)
+    elif failed:
+        # Only the changes that failed are tried again
+        events.append({'changes': {
+            entity: {kf_id: change for kf_id, (change, _) in entities.items()}
+            for entity, entities in failed.items()},
+            'attempts': attempts + 1})
+        res['retried'] = sum(len(entities) for entities in failed.values())
+    if events:
+        not_invoked = reinvoke(context, events, compress=compress,
+                               metrics=metrics)
+        res['continuations'] = len(events)
+        if not_invoked:
+            res['continuations_failed'] = not_invoked
+    res['metrics'] = metrics.summary()
+    metrics.emit()
+    return res
+
+
+def request_deadline(context):
+    """
+    Returns the time on the `time.monotonic` clock by which dataservice
+    requests must finish, to keep `RESERVE_MS` to pass on the remaining
+    records, see `DataserviceClient.request`
+    """
+    # Only lambda functions have a deadline, but requests are still given
+    # no more than the longest request timeout
+    if not hasattr(context, 'invoked_function_arn'):
+        return float('inf')
+    remaining = (context.get_remaining_time_in_millis() - RESERVE_MS) / 1000
+    return time.monotonic() + remaining
+
+
+class Scheduler:
+    """
+    Measures how long records take to process in order to decide whether
+    another record can be started before the function runs out of time, and
+    how many records a new function can be expected to finish.
+    """
+
+    # Weight given to the latest latency in the moving average
+    ALPHA = 0.2
+
+    def __init__(self, context, workers):
+        self.context = context
+        self.workers = workers
+        # Only lambda functions have a deadline
+        self.deadline = hasattr(context, 'invoked_function_arn')
+        self.budget = context.get_remaining_time_in_millis()
+        self.average = None
+        self.latencies = deque(maxlen=200)
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        """
+        Records the time in milliseconds it took to process a record
+        """
+        with self.lock:
+            self.latencies.append(latency)
+            if self.average is None:
+                self.average = latency
+            else:
+                self.average += self.ALPHA * (latency - self.average)
+
+    def percentile(self, p):
+        """
+        Returns a percentile of the recent latencies, or None if no record
+        has finished yet
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies)-1, int(len(latencies) * p))]
+
+    def can_start(self):
+        """
+        Whether a record started now is expected to finish before the time
+        reserved to pass on the remaining records, with at least the
+        shortest request timeout left
+        """
+        if not self.deadline:
+            return True
+        remaining = self.context.get_remaining_time_in_millis() - RESERVE_MS
+        expected = max(self.percentile(0.95) or 0, MIN_REQUEST_TIMEOUT * 1000)
+        return remaining > expected
+
+    def capacity(self):
+        """
+        Estimates the number of records a new function can process, or None
+        if no record has been measured yet
+        """
+        if not self.average:
+            return None
+        usable = self.budget - RESERVE_MS - (self.percentile(0.95) or 0)
+        return max(1, int(usable / self.average * self.workers))
+
+    def split(self, records):
+        """
+        Splits the remaining records into continuations that are each
+        expected to finish within one function, but into no more than
+        `MAX_CONTINUATIONS`, which pass on what they can't finish in turn
+        """
+        size = max(self.capacity() or len(records),
+                   -(-len(records) // MAX_CONTINUATIONS))
+        return [records[i:i+size] for i in range(0, len(records), size)]
+
+    def stats(self):
+        return {
+            'average': self.average,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95)
+        }
+
+
+class Record(namedtuple('Record', ['study', 'sample_id', 'consent_code',
+                                   'consent_short_name', 'attempts'])):
+    """
+    A sample to update
+
+    Records are tuples so that batches of tens of thousands of records stay
+    small. Every record of a batch shares the batch's study dict, with the
+    `dbgap_id`, `kf_id` and `version` of the study, and the consent codes
+    and names are interned. `attempts` is the number of times the record
+    was already tried.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, record):
+        """
+        Makes a record from an event's record of the form
+        `{"study": {"dbgap_id": ..., "sample_id": ..., ...}, "attempts": 1}`
+        """
+        study = record['study']
+        return cls({'dbgap_id': study['dbgap_id'],
+                    'kf_id': study.get('kf_id'),
+                    'version': study.get('version')},
+                   study['sample_id'], study['consent_code'],
+                   study['consent_short_name'], record.get('attempts', 0))
+
+    def to_dict(self):
+        """
+        Returns the record in the form of an event's record
+        """
+        record = {'study': {
+            'dbgap_id': self.study['dbgap_id'],
+            'kf_id': self.study.get('kf_id'),
+            'version': self.study.get('version'),
+            'sample_id': self.sample_id,
+            'consent_code': self.consent_code,
+            'consent_short_name': self.consent_short_name
+        }}
+        if self.attempts:
+            record['attempts'] = self.attempts
+        return record
+
+    def pack(self):
+        """
+        Packs the record into the list sent in a batch's samples, keeping
+        the number of attempts
+        """
+        sample = [self.sample_id, self.consent_code, self.consent_short_name]
+        if self.attempts:
+            sample.append(self.attempts)
+        return sample
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def event_records(event):
+    """
+    Returns the records of an event as a list of `Record`s
+
+    Events may list `Records` that each have their own study, or be a batch
+    of samples of one study, where samples that were already tried carry
+    the number of attempts as a fourth element.
+    """
+    if 'samples' not in event:
+        return [Record.from_dict(record) for record in event['Records']]
+    study = event['study']
+    return [Record(study, sample[0], _intern(sample[1]), _intern(sample[2]),
+                   sample[3] if len(sample) > 3 else 0)
+            for sample in event['samples']]
+
+
+def remaining_items(event, offset, retried):
+    """
+    Returns the remaining records in the format of the event's `Records` or
+    `samples`
+
+    The records that were not started are taken from the event as they were
+    received, from `offset` on, followed by the records that will be tried
+    again.
+    """
+    if 'samples' not in event:
+        return (event['Records'][offset:] +
+                [record.to_dict() for record in retried])
+    return (event['samples'][offset:] +
+            [record.pack() for record in retried])
+
+
+def continuation_events(event, offset, retried, scheduler):
+    """
+    Builds the events to pass the remaining records on to new functions,
+    using the same format as the event that was received
+
+    The remaining records, see `remaining_items`, are split between events
+    by `scheduler`.
+    """
+    events = []
+    for chunk in scheduler.split(remaining_items(event, offset, retried)):
+        if 'samples' not in event:
+            events.append({'Records': chunk})
+        else:
+            events.append({'study': event['study'], 'samples': chunk})
+    return events
+
+
+def worth_prefetching(client, records, context, metrics=None):
+    """
+    Whether loading the studies of the records in bulk is expected to be
+    quicker than looking each record up
+
+    Every batch of a study that is prefetched reads the whole study, so
+    only batches that are a large enough part of their study are. The pages
+    of a study's listings are read one after the other, while `WORKERS`
+    records are looked up at once, so the longest listing of each study is
+    compared to the lookups each worker would make. The size of each
+    listing is read from the `total` of a page with one result, and studies
+    whose size is not given are prefetched. Records whose study kf_id is
+    not known yet are looked up individually.
+    """
+    if len(records) < PREFETCH_MIN_RECORDS:
+        return False
+    studies = {record.study.get('kf_id') for record in records}
+    if None in studies:
+        return False
+    pages = 0
+    for kf_id in studies:
+        longest = 0
+        for listing in ['biospecimens', 'biospecimen-genomic-files',
+                        'genomic-files']:
             try:
-                record = event['Records'].pop()
-                updater.update_acl(record)
-                res["genomic_file"] = 'processed all records'
-            except DataserviceException:
-                pass
+                resp = client.get(f'/{listing}?study_id={kf_id}&limit=1',
+                                  deadline=request_deadline(context),
+                                  metrics=metrics)
             except Exception:
-                event['Records'].append(record)
-    return res
+                return False
+            if resp.status_code != 200:
+                return False
+            total = resp.json().get('total')
+            if total is None:
+                return True
+            longest = max(longest, -(-total // PAGE_SIZE))
+        pages += longest
+    return pages * WORKERS < LOOKUP_REQUESTS * len(records)
+
+
+def record_summary(record):
+    """
+    Returns the result of a record before it has been processed
+    """
+    return {
+        'dbgap_id': record.study['dbgap_id'],
+        'sample_id': record.sample_id,
+        'status': 'updated',
+        'error': None
+    }
+
+
+def record_result(record, future):
+    """
+    Builds the result of processing a record from its completed future
+
+    :returns: A dict with the sample, its status and any error message, or
+        None if the record failed unexpectedly and may be retried
+    """
+    result = record_summary(record)
+    try:
+        status = future.result()
+    except DataserviceException as err:
+        result['status'] = 'failed'
+        result['error'] = str(err)
+        return result
+    except Exception:
+        return None
+    if status is False:
+        result['status'] = 'failed'
+    elif status == ALREADY_APPLIED:
+        result['status'] = 'already_applied'
+    elif status is not True:
+        result['status'] = 'skipped'
+        result['error'] = status
+    return result
+
+
+def save_failures(event, results):
+    """
+    Saves the sample ids of a batch's records that used up their attempts,
+    so that the next run of the study sends them again, see
+    `invoker.load_failures`
+
+    Records that failed or were skipped for a reason that trying again
+    would not change, such as a sample with no biospecimen, are not saved.
+    Like every other sample they are in the study's snapshot, and are only
+    sent again once they change in dbGaP.
+
+    The sample ids are saved to the store, see `store.get_store`, as a json
+    list under `failures/{accession}/`, in an object of their own for each
+    function. Nothing is saved for events without a study accession.
+    """
+    accession = event.get('study', {}).get('accession')
+    failed = sorted({r['sample_id'] for r in results
+                     if r['status'] in RETRIED_STATUSES})
+    if not accession or not failed:
+        return
+    store = get_store()
+    if store is None:
+        return
+    store.put(f'failures/{accession}/{uuid.uuid4().hex}.json',
+              json.dumps(failed).encode('utf-8'))
+
+
+def send_dead_letters(dead_letters):
+    """
+    Sends records that failed too many times to the dead letter output so
+    that they can be inspected and replayed later
+
+    Each dead letter is a dict with the `record`, including the number of
+    `attempts`, and the last `error`. Continuations that could not be
+    invoked have the `event` that was not sent instead. They are sent to
+    the SQS queue at `DEAD_LETTER_QUEUE` if it is set, or appended as json
+    lines to the `DEAD_LETTER_FILE`. Otherwise they are only printed.
+    """
+    queue = os.environ.get('DEAD_LETTER_QUEUE', None)
+    path = os.environ.get('DEAD_LETTER_FILE', None)
+    print('sending {} records or events that could not be completed to the '
+          'dead letter output'.format(len(dead_letters)))
+    if queue:
+        sqs = boto3.client('sqs')
+        # SQS accepts at most 10 messages in a batch
+        for i in range(0, len(dead_letters), 10):
+            sqs.send_message_batch(QueueUrl=queue, Entries=[
+                {'Id': str(n), 'MessageBody': json.dumps(letter)}
+                for n, letter in enumerate(dead_letters[i:i+10])])
+    elif path:
+        with open(path, 'a') as f:
+            for letter in dead_letters:
+                f.write(json.dumps(letter) + '\n')
+    else:
+        for letter in dead_letters:
+            print(json.dumps(letter))
 
 
 class AclUpdater:
 
-    def __init__(self, api, context):
+    def __init__(self, api, context, prefetch=False, metrics=None,
+                 plan=False, bulk=False, ledger=None):
         self.api = api
         self.context = context
-        self.external_ids = {}
-        self.version = {}
+        self.client = get_client(api, pool_size=WORKERS)
+        self.metrics = metrics or Metrics()
+        # When planning, updates are added to the change set instead of
+        # being sent to the dataservice. When writing in bulk they are also
+        # collected, and sent by `flush`.
+        self.plan = plan
+        self.bulk = bulk
+        self.changes = {'biospecimens': {}, 'genomic-files': {}}
+        # The samples that each collected update came from, and how to undo
+        # the changes made to the prefetched indexes if an update fails
+        self.sources = {}
+        self.undo = {}
+        self.current = threading.local()
+        # When prefetching, biospecimens are indexed by their external id
+        # for each study the first time a record for the study is seen
+        self.prefetch = prefetch
+        self.biospecimens = {}
+        self.duplicates = {}
+        # Genomic files of prefetched studies, indexed by kf_id, and the
+        # kf_ids of the genomic files linked to each biospecimen
+        self.genomic_files = {}
+        self.biospecimen_gfs = {}
+        self.lock = threading.Lock()
+        self.gf_lock = threading.Lock()
+        # The digest of each record in the ledger, and the records that
+        # were applied but are not written to the ledger yet
+        self.ledger = ledger
+        self.applied = {}
+        self.unsaved = []
 
     def update_acl(self, record):
         """
         Gets the external sample id and consent code from dbgap and
         updates dbgap consent code of biospecimen and acl's of genomic files
         in dataservice
+
+        :param record: A `Record`, or a record dict from an event
         """
+        if isinstance(record, dict):
+            record = Record.from_dict(record)
+
+        entry = ledger_entry(record) if self.ledger is not None else None
+        if (entry and not record.study.get('full_sync') and
+                self.applied.get(entry[0]) == entry[1]):
+            self.metrics.incr('ledger_skipped')
+            return ALREADY_APPLIED
 
-        study = record['study']['dbgap_id']
-        external_id = record["study"]["sample_id"]
-        consent_code = record["study"]["consent_code"]
-        cons_short_name = record["study"]["consent_short_name"]
-        kf_id, version = self.get_study_kf_id(study_id=study)
+        study = record.study['dbgap_id']
+        external_id = record.sample_id
+        self.current.sample_id = external_id
+        consent_code = record.consent_code
+        cons_short_name = record.consent_short_name
+        # The invoker may have already resolved the study
+        if record.study.get('kf_id') and record.study.get('version'):
+            kf_id = record.study['kf_id']
+            version = record.study['version']
+            STUDIES.set(study, kf_id, version)
+        else:
+            kf_id, version = self.get_study_kf_id(study_id=study)
         (bs_id, dbgap_cons_code,
          consent_type, visible) = self.get_biospecimen_kf_id(
             external_sample_id=external_id,
@@ -80,7 +841,8 @@ class AclUpdater:
             return 'Biospecimen does not exist'
 
         gf = {"acl": []}
-        if not visible:
+        # Samples that were removed from dbgap have no consent code
+        if not visible or consent_code is None:
             consent_code = None
         else:
             consent_code = study+'.c' + consent_code
@@ -94,50 +856,102 @@ class AclUpdater:
                 consent_short_name=cons_short_name)
             if not status:
                 return False
-        status = self.update_acl_genomic_file(biospecimen_id=bs_id, gf=gf)
+            if self.prefetch:
+                index = self.biospecimens[kf_id]
+                previous = index[external_id]
+                index[external_id] = (bs_id, consent_code, cons_short_name,
+                                      visible)
+                self.undo[('biospecimens', bs_id)] = (
+                    lambda: index.__setitem__(external_id, previous))
+        else:
+            self.metrics.incr('biospecimen_patches_avoided')
+        status = self.update_acl_genomic_file(biospecimen_id=bs_id, gf=gf,
+                                              study_id=kf_id)
         if not status:
             return False
         return True
 
+    def load_ledger(self, records):
+        """
+        Reads the ledger entries of records before they are processed
+        """
+        if self.ledger is None:
+            return
+        # Records of a full sync are updated whatever the ledger holds
+        records = [r for r in records if not r.study.get('full_sync')]
+        keys = [entry[0] for entry in map(ledger_entry, records) if entry]
+        with self.metrics.timer('ledger_read'):
+            self.applied.update(self.ledger.get_many(keys))
+
+    def mark_applied(self, record):
+        """
+        Adds a record whose updates were all made to the ledger, writing the
+        ledger once `LEDGER_BATCH_SIZE` records are waiting
+        """
+        entry = ledger_entry(record) if self.ledger is not None else None
+        if entry is None:
+            return
+        with self.lock:
+            self.unsaved.append(entry)
+            if len(self.unsaved) < LEDGER_BATCH_SIZE:
+                return
+        self.save_ledger()
+
+    def save_ledger(self):
+        """
+        Writes the records that were applied since the ledger was last
+        written
+        """
+        with self.lock:
+            entries = self.unsaved
+            self.unsaved = []
+        if entries:
+            with self.metrics.timer('ledger_write'):
+                self.ledger.put_many(entries)
+
     def get_study_kf_id(self, study_id):
         """
         Gets and stores the study's kf_id and version based
         on external study id
         """
-        retry_count = 3
         if study_id is None:
             return
-        if study_id in self.external_ids:
-            return self.external_ids[study_id], self.version[study_id]
-        while retry_count > 1:
-            resp = requests.get(
-                self.api+'/studies?external_id='+study_id,
-                timeout=self.context.get_remaining_time_in_millis()-14000)
-            if resp.status_code != 500:
-                break
-            else:
-                retry_count = retry_count - 1
+        cached = STUDIES.get(study_id)
+        if cached:
+            return cached
+        resp = self.client.get(
+            '/studies?external_id='+study_id,
+            deadline=request_deadline(self.context),
+            metrics=self.metrics)
         if resp.status_code != 200:
             raise TimeoutException
         if len(resp.json()['results']) == 1:
-            self.external_ids[study_id] = resp.json()['results'][0]['kf_id']
-            self.version[study_id] = resp.json()['results'][0]['version']
-            return self.external_ids[study_id], self.version[study_id]
+            kf_id = resp.json()['results'][0]['kf_id']
+            version = resp.json()['results'][0]['version']
+            STUDIES.set(study_id, kf_id, version)
+            return kf_id, version
 
     def get_biospecimen_kf_id(self, external_sample_id, study_id):
         """
         Gets biospecimen kf_id based on external sample id and study kf_id
         """
-        retry_count = 3
-        while retry_count > 1:
-            resp = requests.get(
-                self.api+'/biospecimens?study_id='+study_id +
-                '&external_sample_id='+external_sample_id,
-                timeout=self.context.get_remaining_time_in_millis()-13000)
-            if resp.status_code != 500:
-                break
-            else:
-                retry_count = retry_count - 1
+        if self.prefetch:
+            index, duplicates = self.get_biospecimen_index(study_id)
+            if external_sample_id in duplicates:
+                raise DataserviceException(
+                    f'Multiple biospecimens found for external sample id '
+                    f'{external_sample_id}')
+            if external_sample_id not in index:
+                raise DataserviceException(
+                    f'No biospecimen found for external sample id '
+                    f'{external_sample_id}')
+            return index[external_sample_id]
+
+        resp = self.client.get(
+            '/biospecimens?study_id='+study_id +
+            '&external_sample_id='+external_sample_id,
+            deadline=request_deadline(self.context),
+            metrics=self.metrics)
         if resp.status_code != 200:
             raise TimeoutException
         elif len(resp.json()['results']) == 1:
@@ -146,77 +960,238 @@ class AclUpdater:
             consent_type = resp.json()['results'][0]['consent_type']
             visible = resp.json()['results'][0]['visible']
             return bs_id, dbgap_cons_code, consent_type, visible
+        elif len(resp.json()['results']) > 1:
+            raise DataserviceException(
+                f'Multiple biospecimens found for external sample id '
+                f'{external_sample_id}')
         else:
-            raise DataserviceException(f'No biospecimen found for '
-            f'external sample id {external_sample_id}')
+            raise DataserviceException(
+                f'No biospecimen found for external sample id '
+                f'{external_sample_id}')
+
+    def get_biospecimen_index(self, study_id):
+        """
+        Loads every biospecimen in a study once and indexes them by their
+        external sample id
+
+        :returns: A dict of external sample id to the tuple
+            (kf_id, dbgap_consent_code, consent_type, visible) and the set of
+            external sample ids that belong to more than one biospecimen
+        """
+        with self.lock:
+            if study_id not in self.biospecimens:
+                index = {}
+                duplicates = set()
+                biospecimens = self.client.paginate(
+                    '/biospecimens?study_id='+study_id+'&limit=100',
+                    deadline=request_deadline(self.context),
+                    metrics=self.metrics)
+                for bs in biospecimens:
+                    external_id = bs['external_sample_id']
+                    if external_id in index:
+                        duplicates.add(external_id)
+                    index[external_id] = (bs['kf_id'],
+                                          bs['dbgap_consent_code'],
+                                          bs['consent_type'],
+                                          bs['visible'])
+                if duplicates:
+                    print('{} external sample ids belong to more than one '
+                          'biospecimen in {}'.format(len(duplicates),
+                                                     study_id))
+                self.biospecimens[study_id] = index
+                self.duplicates[study_id] = duplicates
+        return self.biospecimens[study_id], self.duplicates[study_id]
 
     def update_dbgap_consent_code(self, biospecimen_id,
                                   consent_code, consent_short_name):
         """
         Updates dbgap consent code for biospecimen id
         """
-        retry_count = 3
         bs = {
             "dbgap_consent_code": consent_code,
             "consent_type": consent_short_name}
-        while retry_count > 1:
-            resp = requests.patch(
-                self.api+'/biospecimens/'+biospecimen_id,
-                json=bs,
-                timeout=self.context.get_remaining_time_in_millis()-12000)
-            if resp.status_code != 500:
-                break
-            else:
-                retry_count = retry_count - 1
+        if self.plan or self.bulk:
+            self.collect('biospecimens', biospecimen_id, bs)
+            return True
+        resp = self.client.patch(
+            '/biospecimens/'+biospecimen_id,
+            json=bs,
+            deadline=request_deadline(self.context),
+            metrics=self.metrics)
         if resp.status_code != 200:
             raise TimeoutException
         return True
 
     def get_gfs_from_biospecimen(self, biospecimen_id):
         """
-        Returns the links of biospecimen
+        Returns the genomic files of biospecimen, following every page of
+        the listing
         """
-        retry_count = 3
-        while retry_count > 1:
-            resp = requests.get(
-                self.api+'/genomic-files?biospecimen_id='+biospecimen_id +
+        try:
+            gfs = list(self.client.paginate(
+                '/genomic-files?biospecimen_id='+biospecimen_id +
                 '&limit=100',
-                timeout=self.context.get_remaining_time_in_millis()-11000)
-            if resp.status_code != 500:
-                break
-            else:
-                retry_count = retry_count - 1
-        if resp.status_code != 200:
+                deadline=request_deadline(self.context),
+                metrics=self.metrics))
+        except DataserviceException:
             raise TimeoutException
-        elif resp.status_code == 200 and len(resp.json()['results']) <= 0:
+        if len(gfs) <= 0:
             raise DataserviceException(
                 f'No associated genomic-files found for '
                 f'biospecimen {biospecimen_id}')
-        else:
-            return resp.json()
+        return gfs
+
+    def get_genomic_file_index(self, study_id):
+        """
+        Loads every genomic file in a study and the links between them and
+        the study's biospecimens so that acls can be compared in memory
 
-    def update_acl_genomic_file(self, gf, biospecimen_id):
+        :returns: A dict of genomic file kf_id to genomic file and a dict of
+            biospecimen kf_id to the kf_ids of its genomic files
+        """
+        with self.gf_lock:
+            if study_id not in self.biospecimen_gfs:
+                deadline = request_deadline(self.context)
+                links = {}
+                # Both listings are read at the same time
+                with ThreadPoolExecutor(max_workers=2) as pool:
+                    bs_gfs = pool.submit(list, self.client.paginate(
+                        '/biospecimen-genomic-files?study_id='+study_id +
+                        '&limit=100', deadline=deadline, metrics=self.metrics))
+                    gfs = pool.submit(list, self.client.paginate(
+                        '/genomic-files?study_id='+study_id+'&limit=100',
+                        deadline=deadline, metrics=self.metrics))
+                for link in bs_gfs.result():
+                    links.setdefault(link['biospecimen_id'], []).append(
+                        link['genomic_file_id'])
+                for gf in gfs.result():
+                    self.genomic_files[gf['kf_id']] = {
+                        'kf_id': gf['kf_id'],
+                        'acl': gf['acl'],
+                        'visible': gf['visible']
+                    }
+                self.biospecimen_gfs[study_id] = links
+        return self.genomic_files, self.biospecimen_gfs[study_id]
+
+    def prefetch_study(self, study_id):
+        """
+        Loads the biospecimens, genomic files and links of a study at the
+        same time
+        """
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [pool.submit(self.get_biospecimen_index, study_id),
+                       pool.submit(self.get_genomic_file_index, study_id)]
+        for future in futures:
+            future.result()
+
+    def update_acl_genomic_file(self, gf, biospecimen_id, study_id=None):
         """
         Updates acl's of genomic files that are associated with biospecimen
         """
-        # Get the links of genomic files for that biospecimen
-        retry_count = 3
-        response = self.get_gfs_from_biospecimen(biospecimen_id)
-        for r in response['results']:
-            acl = gf
-            if not r['visible']:
-                acl = {"acl": []}
-            # Do not update if acl's are as expected
-            if r['acl'] != acl['acl']:
-                while retry_count > 1:
-                    resp = requests.patch(
-                        self.api+'/genomic-files/'+r['kf_id'], json=acl,
-                        timeout=self.context
-                        .get_remaining_time_in_millis()-8000)
-                    if resp.status_code != 500:
-                        break
-                    else:
-                        retry_count = retry_count - 1
-                if resp.status_code != 200:
-                    raise TimeoutException
-        return
+        if self.prefetch and study_id:
+            index, links = self.get_genomic_file_index(study_id)
+            if not links.get(biospecimen_id):
+                raise DataserviceException(
+                    f'No associated genomic-files found for '
+                    f'biospecimen {biospecimen_id}')
+            genomic_files = [index[kf_id] for kf_id in links[biospecimen_id]
+                             if kf_id in index]
+        else:
+            # Get the links of genomic files for that biospecimen
+            genomic_files = self.get_gfs_from_biospecimen(biospecimen_id)
+
+        changes = acl_changes(genomic_files, gf['acl'])
+        self.metrics.incr('genomic_file_patches_avoided',
+                          len(genomic_files) - len(changes))
+        for kf_id, body in changes:
+            self.update_genomic_file(kf_id, body)
+            if kf_id in self.genomic_files:
+                genomic_file = self.genomic_files[kf_id]
+                previous = genomic_file['acl']
+                genomic_file['acl'] = body['acl']
+                # Bind this file's values, the names change with the loop
+                self.undo[('genomic-files', kf_id)] = (
+                    lambda genomic_file=genomic_file, previous=previous:
+                    genomic_file.__setitem__('acl', previous))
+        return True
+
+    def collect(self, entity, kf_id, body):
+        """
+        Adds an update to the change set instead of sending it
+        """
+        with self.lock:
+            self.changes[entity][kf_id] = body
+            self.sources.setdefault((entity, kf_id), []).append(
+                getattr(self.current, 'sample_id', None))
+
+    def flush(self):
+        """
+        Sends the updates collected while writing in bulk
+
+        The prefetched biospecimens and genomic files that were not updated
+        are restored so that they are compared again if their samples are
+        tried again.
+
+        :returns: A dict of the error for each sample that had an update
+            fail, and a set of the other samples that had an update that was
+            not sent, see `NotSentException`
+        """
+        with self.lock:
+            changes = self.changes
+            sources = self.sources
+            undo = self.undo
+            self.changes = {'biospecimens': {}, 'genomic-files': {}}
+            self.sources = {}
+            self.undo = {}
+        failed = {}
+        unsent = set()
+        for entity, entities in changes.items():
+            if not entities:
+                continue
+            errors, not_sent = self.client.bulk_patch(
+                entity, entities, deadline=request_deadline(self.context),
+                metrics=self.metrics)
+            for kf_id in list(errors) + not_sent:
+                if (entity, kf_id) in undo:
+                    undo[(entity, kf_id)]()
+            for kf_id, error in errors.items():
+                for sample_id in sources.get((entity, kf_id), []):
+                    failed.setdefault(sample_id, f'{kf_id}: {error}')
+            for kf_id in not_sent:
+                unsent.update(sources.get((entity, kf_id), []))
+        return failed, unsent - set(failed)
+
+    def update_genomic_file(self, genomic_file_id, body):
+        """
+        Updates the acl of a genomic file
+        """
+        if self.plan or self.bulk:
+            self.collect('genomic-files', genomic_file_id, body)
+            return True
+        resp = self.client.patch(
+            '/genomic-files/'+genomic_file_id, json=body,
+            deadline=request_deadline(self.context),
+            metrics=self.metrics)
+        if resp.status_code != 200:
+            raise TimeoutException
+        return True
+
+
+def acl_changes(genomic_files, acl):
+    """
+    Compares the current acl of each genomic file to the acl it should have
+
+    Genomic files that are not visible should have an empty acl. The order
+    of an acl is not significant, so acls with the same entries in a
+    different order are not changed.
+
+    :param genomic_files: Genomic files with `kf_id`, `acl` and `visible`
+    :param acl: The acl the visible genomic files should have
+    :returns: A list of (kf_id, body) for each genomic file to update
+    """
+    changes = []
+    for gf in genomic_files:
+        expected = acl if gf['visible'] else []
+        if sorted(gf['acl'] or []) != sorted(expected):
+            changes.append((gf['kf_id'], {'acl': list(expected)}))
+    return changes
@@ -0,0 +1,115 @@
+import os
+import boto3
+from botocore.exceptions import ClientError
+
+
+def get_store():
+    """
+    Returns the store used to keep state between runs, or None if no store
+    is configured.
+
+    An S3 bucket is used if `STATE_BUCKET` is set, with keys under
+    `STATE_PREFIX`. Otherwise files under the `STATE_DIR` directory are used.
+    """
+    bucket = os.environ.get('STATE_BUCKET', None)
+    if bucket:
+        return S3Store(bucket, os.environ.get('STATE_PREFIX', ''))
+    path = os.environ.get('STATE_DIR', None)
+    if path:
+        return LocalStore(path)
+    return None
+
+
+class LocalStore:
+    """
+    Stores objects as files in a local directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key):
+        """
+        Returns the contents of an object, or None if it does not exist
+        """
+        path = os.path.join(self.path, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def put(self, key, body):
+        """
+        Writes an object, replacing any existing object with the same key
+        """
+        path = os.path.join(self.path, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so a partial object is never read
+        with open(path+'.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(path+'.tmp', path)
+
+    def delete(self, key):
+        """
+        Deletes an object if it exists
+        """
+        path = os.path.join(self.path, key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def keys(self, prefix):
+        """
+        Returns the keys of the objects under a prefix that ends with a `/`
+        """
+        path = os.path.join(self.path, prefix)
+        if not os.path.isdir(path):
+            return []
+        return sorted(prefix+name for name in os.listdir(path)
+                      if not name.endswith('.tmp'))
+
+
+class S3Store:
+    """
+    Stores objects in an S3 bucket
+    """
+
+    def __init__(self, bucket, prefix=''):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = boto3.client('s3')
+
+    def get(self, key):
+        """
+        Returns the contents of an object, or None if it does not exist
+        """
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self.prefix+key)
+        except ClientError as err:
+            if err.response['Error']['Code'] in ['NoSuchKey', '404']:
+                return None
+            raise
+        return obj['Body'].read()
+
+    def put(self, key, body):
+        """
+        Writes an object, replacing any existing object with the same key
+        """
+        self.s3.put_object(Bucket=self.bucket, Key=self.prefix+key, Body=body)
+
+    def delete(self, key):
+        """
+        Deletes an object if it exists
+        """
+        self.s3.delete_object(Bucket=self.bucket, Key=self.prefix+key)
+
+    def keys(self, prefix):
+        """
+        Returns the keys of the objects under a prefix that ends with a `/`
+        """
+        keys = []
+        pages = self.s3.get_paginator('list_objects_v2').paginate(
+            Bucket=self.bucket, Prefix=self.prefix+prefix)
+        for page in pages:
+            keys.extend(obj['Key'][len(self.prefix):]
+                        for obj in page.get('Contents', []))
+        return sorted(keys)
@@ -2,6 +2,21 @@ import os
 import pytest
 import xml.etree.ElementTree as ET
 
+import dataservice
+
+
+@pytest.fixture(autouse=True)
+def dataservice_clients():
+    """
+    Discards dataservice clients and studies kept from previous tests so that
+    each test gets a session from its own mocked requests
+    """
+    dataservice.CLIENTS.clear()
+    dataservice.STUDIES.clear()
+    yield
+    dataservice.CLIENTS.clear()
+    dataservice.STUDIES.clear()
+
 
 @pytest.fixture
 def mock_dbgap():
@@ -11,9 +26,10 @@ def mock_dbgap():
 
     class MockdbGaP():
 
-        def __init__(self, status_code=200, released=True):
+        def __init__(self, status_code=200, released=True, headers=None):
             self.status_code = status_code
             self.released = released
+            self.headers = headers or {}
 
         @property
         def content(self):
@@ -32,6 +48,16 @@ def mock_dbgap():
                 study = ET.tostring(tree)
             return study
 
+        def iter_content(self, chunk_size=1):
+            """
+            Streams the xml in chunks of bytes
+            """
+            content = self.content
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            for i in range(0, len(content), chunk_size):
+                yield content[i:i+chunk_size]
+
     return MockdbGaP
 
 
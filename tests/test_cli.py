@@ -0,0 +1,162 @@
+import json
+from mock import patch, MagicMock
+import cli
+import dataservice
+import invoker
+
+
+def study_samples():
+    """ Returns the sample ids of the test study """
+    return [row[1] for row in invoker.parse_dbgap_xml('tests/test_study.xml',
+                                                      'phs001228')]
+
+
+def mock_apis(mock_dbgap, mock_dataservice, samples):
+    """
+    Returns functions that mock requests to dbGaP and the dataservice for a
+    study whose biospecimens and genomic files all need to be updated
+    """
+    def router(url, *args, **kwargs):
+        if url.startswith('http://ds'):
+            return mock_dataservice(url, *args, **kwargs)
+        return mock_dbgap()
+
+    def get(url, *args, **kwargs):
+        resp = MagicMock(status_code=200)
+        if '/biospecimens' in url:
+            resp.json.return_value = {'results': [
+                {'kf_id': f'BS_{s}', 'external_sample_id': s,
+                 'dbgap_consent_code': None, 'consent_type': None,
+                 'visible': True} for s in samples]}
+        elif '/biospecimen-genomic-files' in url:
+            resp.json.return_value = {'results': [
+                {'biospecimen_id': f'BS_{s}', 'genomic_file_id': f'GF_{s}'}
+                for s in samples]}
+        elif '/genomic-files' in url:
+            resp.json.return_value = {'results': [
+                {'kf_id': f'GF_{s}', 'acl': [], 'visible': True}
+                for s in samples]}
+        return resp
+
+    return router, get
+
+
+def test_run_study(mock_dbgap, mock_dataservice, tmpdir):
+    """ Test that every sample of a study is updated in bulk and saved to
+    the checkpoint """
+    samples = study_samples()
+    router, get = mock_apis(mock_dbgap, mock_dataservice, samples)
+    path = str(tmpdir.join('checkpoint.jsonl'))
+
+    with patch('invoker.requests') as req, \
+            patch('dataservice.requests') as ds:
+        req.get.side_effect = router
+        ds.Session().get.side_effect = get
+        ds.Session().patch.return_value = MagicMock(status_code=200)
+        res = cli.run(['phs001228'], 'http://ds', checkpoint=path,
+                      quiet=True)
+
+    assert res['failed'] == {}
+    study = res['studies'][0]
+    assert study['accession'] == 'phs001228.v1.p1'
+    assert study['samples'] == len(samples)
+    assert study['statuses'] == {'updated': len(samples)}
+    # Every update was sent in bulk
+    patches = ds.Session().patch.call_args_list
+    assert len(patches) == 2 * -(-len(samples) // dataservice.BULK_CHUNK_SIZE)
+    assert res['metrics']['counts']['records_updated'] == len(samples)
+
+    done, finished = cli.Checkpoint(path).load()
+    assert done['phs001228'] == set(samples)
+    assert finished['phs001228']['statuses'] == {'updated': len(samples)}
+
+
+def test_run_study_unfinished(mock_dbgap, mock_dataservice, tmpdir):
+    """ Test that samples that failed are not saved to the checkpoint, and
+    that the study is not saved as finished while they remain """
+    samples = study_samples()
+    router, get = mock_apis(mock_dbgap, mock_dataservice, samples)
+    path = str(tmpdir.join('checkpoint.jsonl'))
+
+    def bulk_patch(url, json=None, **kwargs):
+        resp = MagicMock(status_code=207)
+        resp.json.return_value = {'errors': [
+            {'kf_id': c['kf_id'], 'message': 'conflict'} for c in json
+            if c['kf_id'] == f'BS_{samples[0]}']}
+        return resp
+
+    with patch('invoker.requests') as req, \
+            patch('dataservice.requests') as ds, \
+            patch('service.RECORD_RETRY_DELAY', 0), \
+            patch.dict('os.environ', {
+                'DEAD_LETTER_FILE': str(tmpdir.join('dead.jsonl'))}):
+        req.get.side_effect = router
+        ds.Session().get.side_effect = get
+        ds.Session().patch.side_effect = bulk_patch
+        res = cli.run(['phs001228'], 'http://ds', checkpoint=path,
+                      quiet=True)
+
+    study = res['studies'][0]
+    assert study['statuses'] == {'updated': len(samples) - 1,
+                                 'dead_letter': 1}
+    assert study['unfinished'] == 1
+    done, finished = cli.Checkpoint(path).load()
+    assert done['phs001228'] == set(samples[1:])
+    assert finished == {}
+
+
+def test_resume(mock_dbgap, mock_dataservice, tmpdir):
+    """ Test that only the samples that were not finished are updated, and
+    that finished studies are not run again """
+    samples = study_samples()
+    router, get = mock_apis(mock_dbgap, mock_dataservice, samples)
+    path = tmpdir.join('checkpoint.jsonl')
+    path.write('\n'.join([
+        json.dumps({'study': 'phs001228', 'samples': samples[:1000]}),
+        json.dumps({'study': 'phs000001', 'result': {'statuses': {}}}),
+        '{"study": "phs0012'
+    ]))
+
+    with patch('invoker.requests') as req, \
+            patch('dataservice.requests') as ds:
+        req.get.side_effect = router
+        ds.Session().get.side_effect = get
+        ds.Session().patch.return_value = MagicMock(status_code=200)
+        res = cli.run(['phs000001', 'phs001228'], 'http://ds',
+                      checkpoint=str(path), quiet=True)
+
+    assert res['studies'][0]['previous_run']
+    study = res['studies'][1]
+    assert study['resumed'] == 1000
+    assert study['statuses'] == {'updated': len(samples) - 1000}
+    sent = [c['kf_id'] for call in ds.Session().patch.call_args_list
+            for c in call[1]['json']]
+    assert sorted(sent) == sorted(
+        [f'BS_{s}' for s in samples[1000:]] +
+        [f'GF_{s}' for s in samples[1000:]])
+
+
+def test_run_failed_study(mock_dataservice):
+    """ Test that a study that can't be found is reported and not saved """
+    with patch('invoker.requests') as req, patch('dataservice.requests'):
+        req.get.side_effect = mock_dataservice
+        res = cli.run(['phs999999'], 'http://ds', quiet=True)
+
+    assert res['studies'] == []
+    assert 'Could not find a study for phs999999' in res['failed'][
+        'phs999999']
+
+
+def test_run_study_error():
+    """ Test that an unexpected error in one study does not stop the others
+    """
+    def run_study(study, *args, **kwargs):
+        if study == 'phs000001':
+            raise ConnectionError('connection reset')
+        return {'study': study, 'metrics': cli.Metrics().summary()}
+
+    with patch('cli.run_study', side_effect=run_study):
+        res = cli.run(['phs000001', 'phs001228'], 'http://ds', quiet=True)
+
+    assert [r['study'] for r in res['studies']] == ['phs001228']
+    assert 'connection reset' in res['failed']['phs000001']
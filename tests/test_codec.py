@@ -0,0 +1,46 @@
+import json
+import pytest
+import codec
+
+
+def event():
+    return {
+        'study': {'dbgap_id': 'phs001168', 'kf_id': 'SD_9PYZAHHE',
+                  'version': 'v1.p1', 'accession': 'phs001168.v1.p1'},
+        'samples': [['PA2645', '1', 'IRB', 2], ['PA2646', '2', 'GRU'],
+                    ['PA2647', '1', 'IRB']]
+    }
+
+
+def test_round_trip():
+    """ Test that an encoded event is decoded to the same event """
+    payload = json.loads(codec.encode_event(event(), compress=True))
+    assert codec.is_encoded(payload)
+    assert payload['codec'] == codec.CODEC
+    assert codec.decode_event(payload) == event()
+
+
+def test_not_compressed():
+    """ Test that events are plain json unless compression is enabled """
+    payload = json.loads(codec.encode_event(event()))
+    assert payload == event()
+    assert not codec.is_encoded(payload)
+    assert codec.decode_event(payload) == payload
+
+
+def test_compressed_size():
+    """ Test that a large batch is much smaller when compressed """
+    samples = [[f'SAMPLE-{i:06}', str(i % 3), 'GRU'] for i in range(5000)]
+    batch = dict(event(), samples=samples)
+    plain = codec.encode_event(batch, compress=False)
+    compressed = codec.encode_event(batch, compress=True)
+    assert len(compressed) * 4 < len(plain)
+    assert codec.decode_event(json.loads(compressed)) == batch
+
+
+def test_unknown_version():
+    """ Test that payloads of an unknown codec or version are refused """
+    payload = json.loads(codec.encode_event(event(), compress=True))
+    payload['version'] = codec.VERSION + 1
+    with pytest.raises(codec.CodecException):
+        codec.decode_event(payload)
@@ -0,0 +1,373 @@
+import threading
+import pytest
+from mock import patch, MagicMock
+import dataservice
+
+
+def test_get_client_reused():
+    """ Test that a client is kept for each api between invocations """
+    with patch('dataservice.requests') as req:
+        client = dataservice.get_client('http://ds', pool_size=4)
+        assert dataservice.get_client('http://ds') is client
+        assert dataservice.get_client('http://other') is not client
+        assert req.Session.call_count == 2
+
+
+def test_pool_size():
+    """ Test that the pool is large enough for every worker """
+    with patch('dataservice.requests') as req:
+        client = dataservice.DataserviceClient('http://ds', pool_size=50)
+        assert client.pool_size == 50
+        _, kwargs = req.adapters.HTTPAdapter.call_args
+        assert kwargs['pool_maxsize'] == 50
+        assert req.Session().mount.call_count == 2
+
+        client = dataservice.DataserviceClient('http://ds', pool_size=1)
+        assert client.pool_size == dataservice.POOL_SIZE
+
+
+def test_connection_stats():
+    """ Test that requests over an open connection are counted as reused """
+    with patch('dataservice.requests') as req:
+        req.Session().get.return_value = MagicMock(status_code=200)
+        req.Session().patch.return_value = MagicMock(status_code=200)
+        client = dataservice.DataserviceClient('http://ds')
+        client.get('/studies', timeout=1)
+        client.patch('/biospecimens/BS_00000000', json={})
+        client.get('/genomic-files')
+
+    req.Session().get.assert_any_call('http://ds/studies', timeout=1)
+    req.Session().patch.assert_called_with(
+        'http://ds/biospecimens/BS_00000000', json={})
+    client.adapter.poolmanager.pools = {'ds': MagicMock(num_connections=1)}
+    assert client.connection_stats() == {
+        'requests': 3,
+        'new_connections': 1,
+        'reused_connections': 2
+    }
+
+
+def test_paginate():
+    """ Test that every page of a listing is followed """
+    pages = {
+        'http://ds/studies?limit=2': {
+            'results': [{'kf_id': 'SD_1'}, {'kf_id': 'SD_2'}],
+            '_links': {'next': '/studies?limit=2&after=2'}
+        },
+        'http://ds/studies?limit=2&after=2': {
+            'results': [{'kf_id': 'SD_3'}],
+            '_links': {'next': '/studies?limit=2&after=3'}
+        },
+        'http://ds/studies?limit=2&after=3': {
+            'results': [],
+            '_links': {'next': '/studies?limit=2&after=3'}
+        }
+    }
+
+    def get(url, **kwargs):
+        resp = MagicMock()
+        resp.status_code = 200
+        resp.json.return_value = pages[url]
+        return resp
+
+    with patch('dataservice.requests') as req:
+        req.Session().get.side_effect = get
+        client = dataservice.DataserviceClient('http://ds')
+        results = list(client.paginate('/studies?limit=2'))
+
+    assert [r['kf_id'] for r in results] == ['SD_1', 'SD_2', 'SD_3']
+    assert req.Session().get.call_count == 3
+
+
+def test_paginate_bad_response():
+    """ Test that an error is raised if a page can't be loaded """
+    with patch('dataservice.requests') as req:
+        req.Session().get.return_value = MagicMock(status_code=404,
+                                                   content='error')
+        client = dataservice.DataserviceClient('http://ds')
+        with pytest.raises(dataservice.DataserviceException) as err:
+            list(client.paginate('/studies'))
+
+    assert 'Problem requesting dataservice: http://ds/studies' in str(
+        err.value)
+
+
+def test_iter_pages_prefetch():
+    """ Test that the next page is requested before the current is used """
+    requested = []
+    second = threading.Event()
+
+    def get(url, **kwargs):
+        requested.append(url)
+        if url.endswith('page=2'):
+            second.set()
+        page = int(url.split('page=')[-1])
+        resp = MagicMock(status_code=200)
+        resp.json.return_value = {
+            'results': [page],
+            'total': 3,
+            '_links': {'next': f'/studies?page={page+1}'}
+        }
+        return resp
+
+    pages = dataservice.iter_pages(get, 'http://ds/studies?page=1')
+    assert next(pages)['results'] == [1]
+    # The second page is requested while the first is still being used
+    assert second.wait(1)
+    assert next(pages)['results'] == [2]
+    assert next(pages)['results'] == [3]
+    # Stops once the total has been reached
+    assert list(pages) == []
+    assert requested == ['http://ds/studies?page=1',
+                         'http://ds/studies?page=2',
+                         'http://ds/studies?page=3']
+
+
+def test_study_cache_lru():
+    """ Test that the least recently used study is evicted """
+    cache = dataservice.StudyCache(ttl=60, size=2)
+    cache.set('phs000001', 'SD_1', 'v1.p1')
+    cache.set('phs000002', 'SD_2', 'v1.p1')
+    assert cache.get('phs000001') == ('SD_1', 'v1.p1')
+    cache.set('phs000003', 'SD_3', 'v2.p1')
+
+    assert cache.get('phs000002') is None
+    assert cache.get('phs000001') == ('SD_1', 'v1.p1')
+    assert cache.get('phs000003') == ('SD_3', 'v2.p1')
+
+
+def test_study_cache_ttl():
+    """ Test that studies expire after the ttl """
+    cache = dataservice.StudyCache(ttl=60, size=2)
+    with patch('dataservice.time.time', return_value=1000):
+        cache.set('phs000001', 'SD_1', 'v1.p1')
+    with patch('dataservice.time.time', return_value=1059):
+        assert cache.get('phs000001') == ('SD_1', 'v1.p1')
+    with patch('dataservice.time.time', return_value=1061):
+        assert cache.get('phs000001') is None
+    assert len(cache.studies) == 0
+
+
+def response(status_code, headers=None):
+    resp = MagicMock(status_code=status_code)
+    resp.headers = headers or {}
+    return resp
+
+
+def test_retry_server_errors():
+    """ Test that server errors and rate limiting are retried """
+    with patch('dataservice.requests') as req, \
+            patch('dataservice.time.sleep') as sleep:
+        req.Session().get.side_effect = [response(503), response(429),
+                                         response(200)]
+        client = dataservice.DataserviceClient('http://ds')
+        resp = client.get('/studies')
+
+    assert resp.status_code == 200
+    assert req.Session().get.call_count == 3
+    assert sleep.call_count == 2
+    # Full jitter never waits longer than the exponential backoff
+    assert sleep.call_args_list[0][0][0] <= dataservice.RETRY_BASE_DELAY
+    assert sleep.call_args_list[1][0][0] <= dataservice.RETRY_BASE_DELAY * 2
+
+
+def test_retry_gives_up():
+    """ Test that the last response is returned once attempts run out """
+    with patch('dataservice.requests') as req, \
+            patch('dataservice.time.sleep'):
+        req.Session().get.return_value = response(500)
+        client = dataservice.DataserviceClient('http://ds')
+        resp = client.get('/studies')
+
+    assert resp.status_code == 500
+    assert req.Session().get.call_count == dataservice.RETRY_ATTEMPTS
+
+
+def test_retry_not_found():
+    """ Test that client errors are not retried """
+    with patch('dataservice.requests') as req:
+        req.Session().get.return_value = response(404)
+        client = dataservice.DataserviceClient('http://ds')
+        assert client.get('/studies').status_code == 404
+    assert req.Session().get.call_count == 1
+
+
+def test_retry_after():
+    """ Test that the Retry-After header is respected """
+    with patch('dataservice.requests') as req, \
+            patch('dataservice.time.sleep') as sleep:
+        req.Session().get.side_effect = [
+            response(429, {'Retry-After': '7'}), response(200)]
+        client = dataservice.DataserviceClient('http://ds')
+        client.get('/studies')
+
+    sleep.assert_called_once_with(7)
+
+
+def test_retry_connection_error():
+    """ Test that connection errors are retried and then raised """
+    with patch('dataservice.requests') as req, \
+            patch('dataservice.time.sleep'):
+        req.Session().get.side_effect = dataservice.ConnectionError('reset')
+        client = dataservice.DataserviceClient('http://ds')
+        with pytest.raises(dataservice.ConnectionError):
+            client.get('/studies')
+
+    assert req.Session().get.call_count == dataservice.RETRY_ATTEMPTS
+
+
+def test_request_deadline():
+    """ Test that each attempt is limited by the time left before the
+    deadline, and that no attempt is made without enough time left """
+    now = [0.0]
+    timeouts = []
+
+    def hang(url, timeout=None):
+        timeouts.append(timeout)
+        now[0] += timeout
+        raise dataservice.Timeout('hung')
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    with patch('dataservice.requests') as req, \
+            patch('dataservice.time.monotonic', side_effect=lambda: now[0]), \
+            patch('dataservice.time.sleep', side_effect=sleep):
+        req.Session().get.side_effect = hang
+        client = dataservice.DataserviceClient('http://ds')
+        with pytest.raises(dataservice.DeadlineException):
+            client.get('/studies', deadline=40)
+
+    assert len(timeouts) == 2
+    assert timeouts[0] == dataservice.REQUEST_TIMEOUT
+    # The second attempt was only given the time left after the backoff
+    assert timeouts[1] < 40 - dataservice.REQUEST_TIMEOUT
+    assert now[0] <= 40
+
+    with patch('dataservice.requests') as req, \
+            patch('dataservice.time.monotonic', return_value=39.5):
+        client = dataservice.DataserviceClient('http://ds')
+        with pytest.raises(dataservice.DeadlineException):
+            client.get('/studies', deadline=40)
+    assert req.Session().get.call_count == 0
+
+
+def test_circuit_breaker():
+    """ Test that requests stop once too many fail """
+    breaker = dataservice.CircuitBreaker(threshold=0.5, window=10,
+                                         cooldown=30)
+    with patch('dataservice.time.time', return_value=1000):
+        for failed in [False, True, False, True]:
+            breaker.record(failed)
+        # Not enough requests to judge the error rate yet
+        assert not breaker.is_open()
+        breaker.record(True)
+        assert breaker.is_open()
+        with pytest.raises(dataservice.CircuitOpenException):
+            breaker.check()
+
+    with patch('dataservice.time.time', return_value=1020):
+        assert breaker.remaining() == 10
+    with patch('dataservice.time.time', return_value=1031):
+        assert not breaker.is_open()
+        breaker.check()
+
+
+def test_client_circuit_breaker():
+    """ Test that the client stops sending requests to a failing service """
+    with patch('dataservice.requests') as req, \
+            patch('dataservice.time.sleep'):
+        req.Session().get.return_value = response(503)
+        client = dataservice.DataserviceClient('http://ds')
+        client.breaker = dataservice.CircuitBreaker(threshold=0.5, window=4,
+                                                    cooldown=30)
+        with pytest.raises(dataservice.CircuitOpenException):
+            client.get('/studies')
+
+    # Stopped after the failures filled half the window
+    assert req.Session().get.call_count == 2
+
+
+def test_token_bucket():
+    """ Test that actions wait for a token once the burst is used up """
+    now = [100.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    with patch('dataservice.time.monotonic', side_effect=lambda: now[0]), \
+            patch('dataservice.time.sleep', side_effect=sleep):
+        bucket = dataservice.TokenBucket(rate=10, burst=2)
+        waits = [bucket.acquire() for _ in range(6)]
+
+    assert waits[:2] == [0, 0]
+    assert waits[2:] == pytest.approx([0.1] * 4)
+    # 6 actions at 10 per second with a burst of 2 took 0.4 seconds
+    assert now[0] == pytest.approx(100.4)
+
+
+def test_token_bucket_unlimited():
+    """ Test that a rate of 0 never waits """
+    bucket = dataservice.TokenBucket(rate=0)
+    assert all(bucket.acquire() == 0 for _ in range(1000))
+
+
+def test_client_rate_limits():
+    """ Test that reads and writes are limited separately """
+    with patch('dataservice.requests') as req:
+        req.Session().get.return_value = response(200)
+        req.Session().patch.return_value = response(200)
+        client = dataservice.DataserviceClient('http://ds', read_rate=5,
+                                               write_rate=1)
+        with patch.object(client.reads, 'acquire') as reads, \
+                patch.object(client.writes, 'acquire') as writes:
+            client.get('/studies')
+            client.get('/studies')
+            client.patch('/biospecimens/BS_00000000', json={})
+
+    assert reads.call_count == 2
+    assert writes.call_count == 1
+
+
+def test_bulk_patch_fallback():
+    """ Test that entities are updated one at a time without bulk updates """
+    def mock_patch(url, **kwargs):
+        if url == 'http://ds/genomic-files':
+            return response(404)
+        return response(400 if url.endswith('GF_2') else 200)
+
+    with patch('dataservice.requests') as req, \
+            patch('dataservice.time.sleep'):
+        req.Session().patch.side_effect = mock_patch
+        client = dataservice.DataserviceClient('http://ds')
+        changes = {f'GF_{i}': {'acl': []} for i in range(4)}
+        errors, unsent = client.bulk_patch('genomic-files', changes,
+                                           chunk_size=2)
+        assert client.bulk_supported is False
+        assert unsent == []
+        assert list(errors) == ['GF_2']
+        assert errors['GF_2'].startswith('400')
+
+        # Bulk updates are not tried again
+        req.Session().patch.reset_mock()
+        client.bulk_patch('genomic-files', changes, chunk_size=2)
+        assert req.Session().patch.call_count == 4
+
+
+def test_bulk_patch_not_sent():
+    """ Test that entities that were not sent because the circuit breaker
+    opened are not reported as failures """
+    with patch('dataservice.requests') as req:
+        client = dataservice.DataserviceClient('http://ds')
+        client.breaker.opened_at = dataservice.time.time()
+        changes = {f'GF_{i}': {'acl': []} for i in range(4)}
+        errors, unsent = client.bulk_patch('genomic-files', changes,
+                                           chunk_size=2)
+        assert errors == {}
+        assert sorted(unsent) == list(changes)
+
+        client.bulk_supported = False
+        errors, unsent = client.bulk_patch('genomic-files', changes)
+        assert errors == {}
+        assert sorted(unsent) == list(changes)
+    assert req.Session().patch.call_count == 0
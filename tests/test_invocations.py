@@ -0,0 +1,83 @@
+import time
+import threading
+from botocore.exceptions import ClientError
+from mock import patch, MagicMock
+import invocations
+
+
+def test_dispatch_retries_throttled():
+    """ Test that throttled invocations are retried and results collected """
+    throttled = ClientError({'Error': {'Code': 'TooManyRequestsException'}},
+                            'Invoke')
+    denied = ClientError({'Error': {'Code': 'AccessDeniedException'}},
+                         'Invoke')
+
+    def invoke(FunctionName, InvocationType, Payload):
+        if Payload == b'throttled' and lam.invoke.call_count < 3:
+            raise throttled
+        if Payload == b'denied':
+            raise denied
+        return {'StatusCode': 202}
+
+    lam = MagicMock()
+    lam.invoke.side_effect = invoke
+    with patch('invocations.time.sleep') as sleep:
+        results = invocations.dispatch(lam, 'consent_func',
+                                       [b'throttled', b'denied'],
+                                       max_workers=1)
+
+    assert results[0]['status'] == 202
+    assert results[0]['error'] is None
+    assert results[0]['attempts'] == 3
+    assert sleep.call_count == 2
+    assert results[1]['status'] is None
+    assert results[1]['attempts'] == 1
+    assert 'AccessDeniedException' in results[1]['error']
+
+
+def test_dispatch_gives_up_after_retries():
+    """ Test that invocations stop being retried after INVOKE_RETRIES """
+    lam = MagicMock()
+    lam.invoke.side_effect = ClientError(
+        {'Error': {'Code': 'TooManyRequestsException'}}, 'Invoke')
+    with patch('invocations.time.sleep'):
+        results = invocations.dispatch(lam, 'consent_func', [b'{}'])
+
+    assert results[0]['attempts'] == invocations.INVOKE_RETRIES + 1
+    assert 'TooManyRequestsException' in results[0]['error']
+
+
+def test_dispatch_concurrency():
+    """ Test that no more than max_workers invocations run at once """
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def invoke(**kwargs):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+        return {'StatusCode': 202}
+
+    lam = MagicMock()
+    lam.invoke.side_effect = invoke
+    results = invocations.dispatch(lam, 'consent_func',
+                                   (b'{}' for _ in range(20)), max_workers=4)
+
+    assert len(results) == 20
+    assert lam.invoke.call_count == 20
+    assert max(peak) <= 4
+
+
+def test_dispatch_rate():
+    """ Test that invocations are paced by the dispatch rate """
+    lam = MagicMock()
+    lam.invoke.return_value = {'StatusCode': 202}
+    with patch('invocations.TokenBucket') as bucket:
+        invocations.dispatch(lam, 'consent_func', [b'{}'] * 5, rate=2)
+
+    bucket.assert_called_with(2)
+    assert bucket().acquire.call_count == 5
@@ -1,8 +1,11 @@
+import io
 import os
 import json
 import pytest
+from itertools import chain, repeat
 from mock import patch, MagicMock
 import invoker
+from store import LocalStore
 
 STUDY = None
 
@@ -19,6 +22,62 @@ def test_read_dbgap_xml(mock_dbgap):
     assert len(list(resp)) == 1113
 
 
+def test_parse_dbgap_xml():
+    """ Test that samples are streamed from the xml in document order """
+    with open('tests/test_study.xml', 'rb') as f:
+        samples = invoker.parse_dbgap_xml(f, 'phs001228')
+
+        first = next(samples)
+        assert first == ('1', 'H_UM-Schiffman-692-SS-695', 'GRU')
+        assert len(list(samples)) == 1112
+
+
+def test_parse_dbgap_xml_no_study():
+    """ Test that an error is thrown if the xml has no study """
+    with pytest.raises(invoker.DbGapException) as err:
+        invoker.parse_dbgap_xml(io.BytesIO(b'<DbGap></DbGap>'), 'phs001228')
+
+    assert 'No study found in dbgap xml for phs001228' in str(err.value)
+
+
+def test_fetch_dbgap_xml(mock_dbgap):
+    """ Test that the xml is downloaded to a file and hashed """
+    mock = patch('invoker.requests')
+    req = mock.start()
+    req.get.return_value = mock_dbgap(headers={'ETag': '"abc"'})
+
+    xml, state = invoker.fetch_dbgap_xml('phs001228.v1.p1')
+    with open('tests/test_study.xml', 'rb') as f:
+        content = f.read()
+    assert xml.read() == content
+    assert state['etag'] == '"abc"'
+    assert state['bytes'] == len(content)
+    assert req.get.call_args[1]['headers'] == {}
+    assert req.get.call_args[1]['stream']
+
+    # Same content as the previous download
+    xml, state = invoker.fetch_dbgap_xml('phs001228.v1.p1', state)
+    assert xml is None
+    assert req.get.call_args[1]['headers'] == {'If-None-Match': '"abc"'}
+    mock.stop()
+
+
+def test_fetch_dbgap_xml_not_modified(mock_dbgap):
+    """ Test that the xml is not read if dbgap says it is unchanged """
+    mock = patch('invoker.requests')
+    req = mock.start()
+    req.get.return_value = mock_dbgap(status_code=304)
+    previous = {'etag': None, 'last_modified': 'Wed, 21 Oct 2026 07:28:00 GMT',
+                'sha256': 'abc'}
+
+    xml, state = invoker.fetch_dbgap_xml('phs001228.v1.p1', previous)
+    assert xml is None
+    assert state['bytes'] == 0
+    assert req.get.call_args[1]['headers'] == {
+        'If-Modified-Since': 'Wed, 21 Oct 2026 07:28:00 GMT'}
+    mock.stop()
+
+
 def test_read_dbgap_xml_bad_resp(mock_dbgap):
     """ Test that error is thrown if there is trouble with requesting dbgap """
     mock = patch('invoker.requests')
@@ -60,22 +119,73 @@ def test_map_one_study(mock_dbgap, mock_dataservice):
     req.get.side_effect = router
 
     lam = MagicMock()
-    invoker.map_one_study('phs001228', lam, 'consent_func', 'http://ds')
+    stats = invoker.map_one_study('phs001228', lam, 'consent_func',
+                                  'http://ds')
 
-    # Calling entire study in one batch
-    assert lam.invoke.call_count == 1
+    # Study is split into batches of at most BATCH_MAX_RECORDS
+    assert lam.invoke.call_count == 3
+    assert stats['batches'] == 3
+    assert stats['records'] == 1113
     # Check one of the calls to lambda were made with the right payload
     call = lam.invoke.call_args_list[0]
     assert call[1]['FunctionName'] == 'consent_func'
     assert call[1]['InvocationType'] == 'Event'
     payload = json.loads(call[1]['Payload'])
-    assert 'Records' in payload
-    assert len(payload['Records']) == 1113
-    assert 'study' in payload['Records'][0]
-    assert payload['Records'][0]['study']['consent_code'] == '1'
-    assert payload['Records'][0]['study']['consent_short_name'] == 'GRU'
-    assert payload['Records'][0]['study']['dbgap_id'] == 'phs001228'
-    assert 'sample_id' in payload['Records'][0]['study']
+    assert payload['study'] == {
+        'dbgap_id': 'phs001228',
+        'kf_id': 'SD_00000000',
+        'version': 'v1.p1',
+        'accession': 'phs001228.v1.p1'
+    }
+    assert len(payload['samples']) == 500
+    assert payload['samples'][0] == ['H_UM-Schiffman-692-SS-695', '1', 'GRU']
+    sizes = [len(c[1]['Payload']) for c in lam.invoke.call_args_list]
+    assert stats['bytes'] == sum(sizes)
+
+
+def test_map_one_study_metrics(mock_dbgap, mock_dataservice):
+    """ Test that the xml and invocations are measured """
+    def router(r, *args, **kwargs):
+        if r.startswith('http://ds'):
+            return mock_dataservice(r, *args, **kwargs)
+        return mock_dbgap()
+
+    metrics = invoker.Metrics()
+    with patch('invoker.requests') as req:
+        req.get.side_effect = router
+        invoker.map_one_study('phs001228', MagicMock(), 'consent_func',
+                              'http://ds', metrics=metrics)
+
+    summary = metrics.summary()
+    assert summary['counts']['invocations'] == 3
+    assert summary['counts']['records_sent'] == 1113
+    assert summary['counts'].get('invocations_failed', 0) == 0
+    assert summary['latency']['dbgap_parse']['count'] == 1
+    assert summary['latency']['dbgap_fetch']['count'] == 1
+    assert summary['latency']['lambda_invoke']['count'] == 3
+
+
+def test_batch_events():
+    """ Test that batches are limited by both size and number of records """
+    records = [{'study': {'sample_id': str(i)}} for i in range(10)]
+    # Every record is 29 bytes, the envelope 15 and separators 2
+    batches = list(invoker.batch_events(records, max_bytes=15+29*3+2*2,
+                                        max_records=100, overhead=15))
+    assert [len(b) for b in batches] == [3, 3, 3, 1]
+    payload = '{"Records": [' + ', '.join(batches[0]) + ']}'
+    assert len(payload) == 15+29*3+2*2
+    assert json.loads(payload)['Records'] == records[:3]
+
+    batches = list(invoker.batch_events(records, max_bytes=10000,
+                                        max_records=4, overhead=15))
+    assert [len(b) for b in batches] == [4, 4, 2]
+
+
+def test_batch_events_oversized_record():
+    """ Test that a record bigger than the limit is sent by itself """
+    records = [{'a': 'x'}, {'a': 'x' * 100}, {'a': 'x'}]
+    batches = list(invoker.batch_events(records, max_bytes=50, overhead=15))
+    assert [len(b) for b in batches] == [1, 1, 1]
 
 
 def test_map_one_study_bad_ds_resp(mock_dbgap, mock_dataservice):
@@ -216,3 +326,500 @@ def test_map_to_studies_no_results(mock_dbgap, mock_dataservice):
     assert req.get.call_count == 1
     assert 'Dataservice has no studies' in str(err.value)
     assert lam.invoke.call_count == 0
+
+
+def test_map_to_studies_pages():
+    """ Test that studies on every page of the listing are invoked """
+    mock_req = patch('invoker.requests')
+    req = mock_req.start()
+
+    def router(url, *args, **kwargs):
+        resp = MagicMock()
+        resp.status_code = 200
+        after = int(url.split('after=')[-1]) if 'after=' in url else 0
+        studies = [{'external_id': f'phs{i:06}'}
+                   for i in range(after, min(after+100, 250))]
+        resp.json.return_value = {
+            'results': studies,
+            'total': 250,
+            '_links': {'next': f'/studies?limit=100&after={after+100}'}
+        }
+        return resp
+
+    req.get.side_effect = router
+
+    lam = MagicMock()
+    res = invoker.map_to_studies(lam, 'invoker_func', 'http://ds')
+    assert req.get.call_count == 3
+    assert lam.invoke.call_count == 250
+    assert res['studies'] == 250
+    invoked = {json.loads(c[1]['Payload'])['study']
+               for c in lam.invoke.call_args_list}
+    assert len(invoked) == 250
+    mock_req.stop()
+
+
+def test_map_one_study_cached(mock_dbgap, mock_dataservice):
+    """ Test that a study is only looked up once while it is cached """
+    mock_req = patch('invoker.requests')
+    req = mock_req.start()
+
+    def router(r, *args, **kwargs):
+        if r.startswith('http://ds'):
+            return mock_dataservice(r, *args, **kwargs)
+        else:
+            return mock_dbgap()
+
+    req.get.side_effect = router
+
+    lam = MagicMock()
+    invoker.map_one_study('phs001228', lam, 'consent_func', 'http://ds')
+    invoker.map_one_study('phs001228', lam, 'consent_func', 'http://ds')
+
+    studies = [c for c in req.get.call_args_list if 'studies' in c[0][0]]
+    assert len(studies) == 1
+    assert invoker.STUDIES.get('phs001228') == ('SD_00000000', 'v1.p1')
+    mock_req.stop()
+
+
+def test_diff_samples():
+    """ Test that only added, changed and removed samples are returned """
+    previous = {
+        'S1': ['1', 'GRU'],
+        'S2': ['1', 'GRU'],
+        'S3': ['2', 'HMB'],
+    }
+    rows = [('1', 'S1', 'GRU'), ('2', 'S2', 'HMB'), ('1', 'S4', 'GRU')]
+    snapshot = {}
+    samples = list(invoker.diff_samples(previous, rows, snapshot))
+
+    assert samples == [['S2', '2', 'HMB'], ['S4', '1', 'GRU'],
+                       ['S3', None, None]]
+    assert snapshot == {
+        'S1': ['1', 'GRU'],
+        'S2': ['2', 'HMB'],
+        'S4': ['1', 'GRU'],
+    }
+    assert len(list(invoker.diff_samples(None, rows, {}))) == 3
+    # A full sync sends every sample, and still revokes removed ones
+    samples = list(invoker.diff_samples(previous, rows, {}, full_sync=True))
+    assert samples == [['S1', '1', 'GRU'], ['S2', '2', 'HMB'],
+                       ['S4', '1', 'GRU'], ['S3', None, None]]
+
+
+def test_map_one_study_incremental(mock_dbgap, mock_dataservice,
+                                   monkeypatch, tmpdir):
+    """ Test that only samples changed since the last run are sent """
+    monkeypatch.setenv('STATE_DIR', str(tmpdir))
+    mock_req = patch('invoker.requests')
+    req = mock_req.start()
+
+    def router(r, *args, **kwargs):
+        if r.startswith('http://ds'):
+            return mock_dataservice(r, *args, **kwargs)
+        else:
+            return mock_dbgap()
+
+    req.get.side_effect = router
+
+    lam = MagicMock()
+    stats = invoker.map_one_study('phs001228', lam, 'consent_func',
+                                  'http://ds')
+    assert stats['records'] == 1113
+    assert stats['full_sync']
+
+    # Nothing has changed in dbgap
+    lam = MagicMock()
+    stats = invoker.map_one_study('phs001228', lam, 'consent_func',
+                                  'http://ds')
+    assert stats['records'] == 0
+    assert stats['unchanged']
+    assert lam.invoke.call_count == 0
+
+    # Forget the xml from the last run so that it's compared by sample
+    tmpdir.join('dbgap', 'phs001228.v1.p1.json').remove()
+    stats = invoker.map_one_study('phs001228', lam, 'consent_func',
+                                  'http://ds')
+    assert stats['records'] == 0
+    assert not stats['unchanged']
+    assert not stats['full_sync']
+    assert lam.invoke.call_count == 0
+
+    # One sample changed consent since the last run
+    tmpdir.join('dbgap', 'phs001228.v1.p1.json').remove()
+    store = invoker.get_store()
+    snapshot = invoker.load_snapshot(store, 'phs001228.v1.p1')
+    snapshot['H_UM-Schiffman-692-SS-695'] = ['2', 'HMB']
+    invoker.save_snapshot(store, 'phs001228.v1.p1', snapshot)
+    stats = invoker.map_one_study('phs001228', lam, 'consent_func',
+                                  'http://ds')
+    assert stats['records'] == 1
+    payload = json.loads(lam.invoke.call_args[1]['Payload'])
+    assert payload['samples'] == [['H_UM-Schiffman-692-SS-695', '1', 'GRU']]
+
+    # A sample was removed from dbgap since the last run
+    snapshot = invoker.load_snapshot(store, 'phs001228.v1.p1')
+    snapshot['REMOVED-1'] = ['1', 'GRU']
+    invoker.save_snapshot(store, 'phs001228.v1.p1', snapshot)
+    stats = invoker.map_one_study('phs001228', lam, 'consent_func',
+                                  'http://ds', full_sync=True)
+    assert stats['records'] == 1114
+    assert stats['full_sync']
+    # The consent code function does not skip samples in its ledger
+    payload = json.loads(lam.invoke.call_args[1]['Payload'])
+    assert payload['study']['full_sync']
+    assert payload['samples'][-1] == ['REMOVED-1', None, None]
+    mock_req.stop()
+
+
+def test_map_one_study_failures(mock_dbgap, mock_dataservice, monkeypatch,
+                                tmpdir):
+    """ Test that samples the consent code function failed to update are
+    sent again by the next run, even if the xml did not change """
+    monkeypatch.setenv('STATE_DIR', str(tmpdir))
+    mock_req = patch('invoker.requests')
+    req = mock_req.start()
+    req.get.side_effect = lambda r, *args, **kwargs: (
+        mock_dataservice(r, *args, **kwargs) if r.startswith('http://ds')
+        else mock_dbgap())
+
+    lam = MagicMock()
+    invoker.map_one_study('phs001228', lam, 'consent_func', 'http://ds')
+    store = invoker.get_store()
+    store.put('failures/phs001228.v1.p1/a.json',
+              json.dumps(['H_UM-Schiffman-692-SS-695']).encode('utf-8'))
+
+    lam = MagicMock()
+    stats = invoker.map_one_study('phs001228', lam, 'consent_func',
+                                  'http://ds')
+    assert stats['records'] == 1
+    payload = json.loads(lam.invoke.call_args[1]['Payload'])
+    assert payload['samples'] == [['H_UM-Schiffman-692-SS-695', '1', 'GRU']]
+    assert store.keys('failures/phs001228.v1.p1/') == []
+
+    # Once they were sent the failures are not sent again
+    lam = MagicMock()
+    stats = invoker.map_one_study('phs001228', lam, 'consent_func',
+                                  'http://ds')
+    assert stats['unchanged']
+    mock_req.stop()
+
+
+def test_plan_and_apply(mock_dbgap, mock_dataservice, monkeypatch, tmpdir):
+    """ Test that a study's changes are planned without updates and can be
+    applied later """
+    monkeypatch.setenv('STATE_DIR', str(tmpdir))
+
+    def router(r, *args, **kwargs):
+        if r.startswith('http://ds'):
+            return mock_dataservice(r, *args, **kwargs)
+        return mock_dbgap()
+
+    def update_acl(updater, record):
+        sample_id = record.sample_id
+        if sample_id == 'H_UM-Schiffman-692-SS-695':
+            raise invoker.DataserviceException('No biospecimen found')
+        kf_id = 'BS_{:08}'.format(len(updater.changes['biospecimens']))
+        updater.changes['biospecimens'][kf_id] = {
+            'dbgap_consent_code': record.consent_code,
+            'consent_type': record.consent_short_name}
+        return True
+
+    with patch('invoker.requests') as req, patch('dataservice.requests'), \
+            patch.object(invoker.AclUpdater, 'prefetch_study') as prefetch, \
+            patch.object(invoker.AclUpdater, 'update_acl', autospec=True,
+                         side_effect=update_acl) as upd:
+        req.get.side_effect = router
+        res = invoker.plan_study('phs001228', MagicMock(), 'http://ds')
+
+        updater = upd.call_args[0][0]
+        assert updater.plan and updater.prefetch
+        prefetch.assert_called_once_with('SD_00000000')
+        assert res['samples'] == 1113
+        assert res['failed'] == 1
+        assert res['biospecimens'] == 1112
+        assert res['plan'] == 'plans/phs001228.v1.p1.json.gz'
+        assert tmpdir.join('plans', 'phs001228.v1.p1.json.gz').exists()
+
+        lam = MagicMock()
+        lam.invoke.return_value = {'StatusCode': 202}
+        res = invoker.apply_plan('phs001228', lam, 'consent_func',
+                                 'http://ds')
+
+    assert res['changes'] == 1112
+    assert res['batches'] == 3
+    payloads = [json.loads(c[1]['Payload'])
+                for c in lam.invoke.call_args_list]
+    assert sum(len(p['changes']['biospecimens']) for p in payloads) == 1112
+
+
+def test_apply_without_plan(mock_dataservice, monkeypatch, tmpdir):
+    """ Test that a study can't be applied before it was planned """
+    monkeypatch.setenv('STATE_DIR', str(tmpdir))
+    with patch('invoker.requests') as req:
+        req.get.side_effect = mock_dataservice
+        with pytest.raises(invoker.PlanException) as err:
+            invoker.apply_plan('phs001228', MagicMock(), 'consent_func',
+                               'http://ds')
+    assert 'No plan has been made for phs001228' in str(err.value)
+
+
+def test_map_one_study_resume(mock_dbgap, mock_dataservice, monkeypatch,
+                              tmpdir):
+    """ Test that a run that failed to send a batch resumes from the last
+    batch that was sent in order """
+    monkeypatch.setenv('STATE_DIR', str(tmpdir))
+
+    def router(r, *args, **kwargs):
+        if r.startswith('http://ds'):
+            return mock_dataservice(r, *args, **kwargs)
+        return mock_dbgap()
+
+    def invoke(FunctionName, InvocationType, Payload):
+        if json.loads(Payload)['samples'][0][0] == second:
+            raise Exception('function died')
+        return {'StatusCode': 202}
+
+    rows = invoker.parse_dbgap_xml('tests/test_study.xml', 'phs001228')
+    second = [row[1] for row in rows][invoker.BATCH_MAX_RECORDS]
+    checkpoint = tmpdir.join('checkpoints', 'phs001228.v1.p1.json')
+    with patch('invoker.requests') as req, \
+            patch('invoker.CHECKPOINT_BATCHES', 1):
+        req.get.side_effect = router
+        lam = MagicMock()
+        lam.invoke.side_effect = invoke
+        stats = invoker.map_one_study('phs001228', lam, 'consent_func',
+                                      'http://ds')
+        assert len(stats['failed']) == 1
+        # The batch after the failed one was sent but does not count
+        assert json.loads(checkpoint.read())['records'] == 500
+        assert not tmpdir.join('snapshots').check()
+
+        lam = MagicMock()
+        lam.invoke.return_value = {'StatusCode': 202}
+        stats = invoker.map_one_study('phs001228', lam, 'consent_func',
+                                      'http://ds')
+
+    assert stats['resumed'] == 500
+    assert stats['records'] == 613
+    payload = json.loads(lam.invoke.call_args_list[0][1]['Payload'])
+    assert payload['samples'][0][0] == second
+    assert not checkpoint.check()
+    # Every sample is in the snapshot, including the ones sent before
+    snapshot = invoker.load_snapshot(invoker.get_store(), 'phs001228.v1.p1')
+    assert len(snapshot) == 1113
+
+
+def test_map_one_study_encoded(mock_dbgap, mock_dataservice):
+    """ Test that compressed payloads carry more samples each """
+    def router(r, *args, **kwargs):
+        if r.startswith('http://ds'):
+            return mock_dataservice(r, *args, **kwargs)
+        return mock_dbgap()
+
+    with patch('invoker.requests') as req, \
+            patch('codec.PAYLOAD_ENCODING', 'zlib'):
+        req.get.side_effect = router
+        lam = MagicMock()
+        lam.invoke.return_value = {'StatusCode': 202}
+        stats = invoker.map_one_study('phs001228', lam, 'consent_func',
+                                      'http://ds')
+
+    assert stats['records'] == 1113
+    assert lam.invoke.call_count == 1
+    payload = json.loads(lam.invoke.call_args[1]['Payload'])
+    event = invoker.decode_event(payload)
+    assert event['study']['accession'] == 'phs001228.v1.p1'
+    assert len(event['samples']) == 1113
+
+
+def test_encoded_batches_split():
+    """ Test that compressed batches are split until they fit """
+    samples = [[f'SAMPLE-{i:06}', '1', 'GRU'] for i in range(1000)]
+    batches = list(invoker.encoded_batches({'dbgap_id': 'phs001228'},
+                                           iter(samples), max_bytes=2000,
+                                           max_records=600))
+    assert sum(count for count, _ in batches) == 1000
+    assert all(len(payload) <= 2000 for _, payload in batches)
+    decoded = [s for _, payload in batches
+               for s in invoker.decode_event(json.loads(payload))['samples']]
+    assert decoded == samples
+
+
+def test_study_checkpoint_other_xml(tmpdir):
+    """ Test that a checkpoint is not used for a different xml """
+    store = LocalStore(str(tmpdir))
+    checkpoint = invoker.StudyCheckpoint(store, 'phs001228.v1.p1', 'abc',
+                                         False, every=1)
+    checkpoint.add_batch(10)
+    checkpoint.batch_sent(0)
+    assert invoker.StudyCheckpoint(store, 'phs001228.v1.p1', 'abc',
+                                   False).load() == 10
+    assert invoker.StudyCheckpoint(store, 'phs001228.v1.p1', 'def',
+                                   False).load() == 0
+    assert invoker.StudyCheckpoint(store, 'phs001228.v1.p1', 'abc',
+                                   True).load() == 0
+
+
+@pytest.mark.parametrize('processes', [True, False])
+def test_map_studies_in_process(mock_dbgap, mock_dataservice, monkeypatch,
+                                tmpdir, processes):
+    """ Test that every study is sent from one function, parsing on threads
+    when processes can't be started """
+    monkeypatch.setenv('STATE_DIR', str(tmpdir))
+
+    def router(r, *args, **kwargs):
+        if r.endswith('/studies?limit=100'):
+            resp = MagicMock(status_code=200)
+            resp.json.return_value = {
+                'results': [{'external_id': 'phs001228'},
+                            {'external_id': 'phs999999'}],
+                'total': 2
+            }
+            return resp
+        if r.startswith('http://ds'):
+            return mock_dataservice(r, *args, **kwargs)
+        return mock_dbgap()
+
+    pool = patch('invoker.ProcessPoolExecutor',
+                 side_effect=OSError(38, 'Function not implemented'))
+    with patch('invoker.requests') as req:
+        if not processes:
+            pool.start()
+        req.get.side_effect = router
+        lam = MagicMock()
+        lam.invoke.return_value = {'StatusCode': 202}
+        res = invoker.map_studies_in_process(lam, 'consent_func',
+                                             'http://ds', parse_workers=2)
+        if not processes:
+            pool.stop()
+
+    assert res['studies'] == 2
+    assert 'Could not find a study' in res['failed']['phs999999']
+    stats = res['results']['phs001228']
+    assert stats['records'] == 1113
+    assert stats['failed'] == []
+    assert lam.invoke.call_count == stats['batches'] == 3
+    sent = {s[0] for c in lam.invoke.call_args_list
+            for s in json.loads(c[1]['Payload'])['samples']}
+    assert len(sent) == 1113
+    # The study is remembered as if it were run on its own
+    snapshot = invoker.load_snapshot(invoker.get_store(), 'phs001228.v1.p1')
+    assert len(snapshot) == 1113
+
+
+def test_map_studies_in_process_errors(mock_dbgap, mock_dataservice,
+                                       monkeypatch, tmpdir):
+    """ Test that an unexpected error in one study does not stop the others
+    """
+    monkeypatch.setenv('STATE_DIR', str(tmpdir))
+    studies = ['phs000001', 'phs000002', 'phs000003', 'phs001228']
+
+    def router(r, *args, **kwargs):
+        resp = MagicMock(status_code=200)
+        if r.endswith('/studies?limit=100'):
+            resp.json.return_value = {
+                'results': [{'external_id': s} for s in studies],
+                'total': len(studies)
+            }
+            return resp
+        if '/studies?external_id=phs00000' in r:
+            resp.json.return_value = {'results': [
+                {'kf_id': 'SD_00000001', 'version': 'v1.p1'}]}
+            return resp
+        if r.startswith('http://ds'):
+            return mock_dataservice(r, *args, **kwargs)
+        if 'phs000001' in r:
+            raise ConnectionError('connection reset')
+        return mock_dbgap()
+
+    parse = invoker.parse_study_xml
+
+    def parse_study_xml(path, accession):
+        if accession.startswith('phs000002'):
+            raise RuntimeError('A process in the pool was terminated')
+        return parse(path, accession)
+
+    samples = invoker.StudyRun.samples
+
+    def study_samples(run, dbgap_codes):
+        if run.study == 'phs000003':
+            raise KeyError('consent_code')
+        return samples(run, dbgap_codes)
+
+    with patch('invoker.requests') as req, \
+            patch('invoker.ProcessPoolExecutor', side_effect=OSError), \
+            patch('invoker.parse_study_xml', side_effect=parse_study_xml), \
+            patch('invoker.StudyRun.samples', autospec=True,
+                  side_effect=study_samples):
+        req.get.side_effect = router
+        lam = MagicMock()
+        lam.invoke.return_value = {'StatusCode': 202}
+        res = invoker.map_studies_in_process(lam, 'consent_func',
+                                             'http://ds', parse_workers=1)
+
+    assert 'connection reset' in res['failed']['phs000001']
+    assert 'terminated' in res['failed']['phs000002']
+    assert 'consent_code' in res['failed']['phs000003']
+    assert res['results']['phs001228']['records'] == 1113
+
+
+def test_map_studies_in_process_deadline(mock_dbgap, mock_dataservice,
+                                         monkeypatch, tmpdir):
+    """ Test that no studies are started once the function is running out
+    of time, and that the studies that were not are returned """
+    monkeypatch.setenv('STATE_DIR', str(tmpdir))
+    studies = ['phs001228', 'phs000001', 'phs000002']
+
+    def router(r, *args, **kwargs):
+        resp = MagicMock(status_code=200)
+        if r.endswith('/studies?limit=100'):
+            resp.json.return_value = {
+                'results': [{'external_id': s} for s in studies],
+                'total': len(studies)
+            }
+            return resp
+        if '/studies?external_id=phs00000' in r:
+            resp.json.return_value = {'results': [
+                {'kf_id': 'SD_00000001', 'version': 'v1.p1'}]}
+            return resp
+        if r.startswith('http://ds'):
+            return mock_dataservice(r, *args, **kwargs)
+        return mock_dbgap()
+
+    # Two studies are downloaded at once, and the first one parsed is sent
+    # before the function runs out of time
+    context = MagicMock()
+    context.get_remaining_time_in_millis.side_effect = chain(
+        [invoker.STUDY_RESERVE_MS * 2] * 3, repeat(0))
+    with patch('invoker.requests') as req, \
+            patch('invoker.ProcessPoolExecutor', side_effect=OSError):
+        req.get.side_effect = router
+        lam = MagicMock()
+        lam.invoke.return_value = {'StatusCode': 202}
+        res = invoker.map_studies_in_process(lam, 'consent_func',
+                                             'http://ds', fetch_workers=1,
+                                             parse_workers=1,
+                                             context=context)
+
+    assert len(res['results']) == 1
+    assert res['failed'] == {}
+    assert len(res['not_started']) == 2
+    assert set(res['results']) | set(res['not_started']) == set(studies)
+    assert lam.invoke.call_count == 3
+
+
+def test_handler_in_process(monkeypatch):
+    """ Test that the in process mode is used when asked for """
+    monkeypatch.setenv('DATASERVICE', 'http://ds')
+    monkeypatch.setenv('FUNCTION', 'consent_func')
+    with patch('invoker.boto3'), \
+            patch('invoker.map_to_studies') as fan_out, \
+            patch('invoker.map_studies_in_process',
+                  return_value={'studies': 1}) as in_process:
+        context = MagicMock()
+        res = invoker.handler({'in_process': True}, context)
+
+    assert res['studies'] == 1
+    assert in_process.call_args[1]['context'] is context
+    assert fan_out.call_count == 0
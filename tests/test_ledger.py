@@ -0,0 +1,83 @@
+from mock import patch
+import ledger
+from service import Record
+
+
+def record(sample_id, consent_code='1', version='v1.p1'):
+    study = {'dbgap_id': 'phs001168', 'kf_id': 'SD_1', 'version': version}
+    return Record(study, sample_id, consent_code, 'GRU', 0)
+
+
+def test_get_ledger(monkeypatch, tmpdir):
+    """ Test that the configured ledger is returned """
+    monkeypatch.delenv('LEDGER_TABLE', raising=False)
+    monkeypatch.delenv('LEDGER_PATH', raising=False)
+    assert ledger.get_ledger() is None
+
+    monkeypatch.setenv('LEDGER_PATH', str(tmpdir.join('ledger.db')))
+    assert isinstance(ledger.get_ledger(), ledger.SqliteLedger)
+
+    monkeypatch.setenv('LEDGER_TABLE', 'kf-consent-ledger')
+    with patch('ledger.boto3'):
+        assert isinstance(ledger.get_ledger(), ledger.DynamoLedger)
+
+
+def test_ledger_entry():
+    """ Test that an entry changes with the consent code it sets """
+    key, digest = ledger.ledger_entry(record('S1'))
+    assert key == 'phs001168.v1.p1/S1'
+    assert ledger.ledger_entry(record('S1')) == (key, digest)
+    assert ledger.ledger_entry(record('S1', '2'))[1] != digest
+    assert ledger.ledger_entry(record('S1', None))[1] != digest
+    assert ledger.ledger_entry(record('S1', version=None)) is None
+
+
+def test_sqlite_ledger(tmpdir):
+    """ Test that entries are replaced and expire """
+    path = str(tmpdir.join('ledger.db'))
+    entries = [ledger.ledger_entry(record(f'S{i}')) for i in range(1000)]
+    keys = [key for key, _ in entries]
+
+    db = ledger.SqliteLedger(path)
+    assert db.get_many(keys) == {}
+    db.put_many(entries)
+    db.put_many([ledger.ledger_entry(record('S1', '2'))])
+    found = ledger.SqliteLedger(path).get_many(keys + ['phs001168.v1.p1/S'])
+    assert len(found) == 1000
+    assert found[keys[0]] == entries[0][1]
+    assert found[keys[1]] == ledger.ledger_entry(record('S1', '2'))[1]
+
+    later = ledger.time.time() + 8 * 86400
+    with patch('ledger.time.time', return_value=later):
+        assert db.get_many(keys) == {}
+
+
+def test_dynamo_ledger():
+    """ Test that items DynamoDB did not process are sent again """
+    entries = [ledger.ledger_entry(record(f'S{i}')) for i in range(30)]
+    with patch('ledger.boto3') as boto3, patch('ledger.time.sleep'):
+        dynamodb = boto3.client()
+        db = ledger.DynamoLedger('kf-consent-ledger')
+        dynamodb.batch_write_item.side_effect = [
+            {'UnprocessedItems': {'kf-consent-ledger': ['...']}},
+            {'UnprocessedItems': {}},
+            {}
+        ]
+        db.put_many(entries)
+        requests = [c[1]['RequestItems']
+                    for c in dynamodb.batch_write_item.call_args_list]
+        assert len(requests[0]['kf-consent-ledger']) == 25
+        assert requests[1] == {'kf-consent-ledger': ['...']}
+        assert len(requests[2]['kf-consent-ledger']) == 5
+
+        dynamodb.batch_get_item.return_value = {'Responses': {
+            'kf-consent-ledger': [
+                {'key': {'S': entries[0][0]}, 'digest': {'S': entries[0][1]},
+                 'expires': {'N': str(ledger.time.time() + 60)}},
+                {'key': {'S': entries[1][0]}, 'digest': {'S': entries[1][1]},
+                 'expires': {'N': str(ledger.time.time() - 60)}}
+            ]}}
+        found = db.get_many([key for key, _ in entries])
+
+    # Expired items are ignored
+    assert found == {entries[0][0]: entries[0][1]}
@@ -0,0 +1,87 @@
+import json
+from mock import patch
+import metrics
+
+
+def test_histogram():
+    """ Test that percentiles are estimated from the buckets """
+    hist = metrics.Histogram()
+    for ms in [1, 2, 3, 20, 40, 60, 80, 90, 95, 700]:
+        hist.add(ms)
+
+    assert hist.count == 10
+    assert hist.percentile(0.3) == 5
+    assert hist.percentile(0.5) == 50
+    assert hist.percentile(0.9) == 100
+    # Never more than the slowest call
+    assert hist.percentile(0.99) == 700
+    assert hist.summary()['buckets'] == {'5': 3, '25': 1, '50': 1,
+                                         '100': 4, '1000': 1}
+
+
+def test_timed():
+    """ Test that time spent producing items is recorded once """
+    now = [0.0]
+
+    def items():
+        for i in range(3):
+            now[0] += 0.01
+            yield i
+
+    m = metrics.Metrics()
+    with patch('metrics.time.monotonic', side_effect=lambda: now[0]):
+        for item in m.timed('parse', items()):
+            # Time spent using the items is not counted
+            now[0] += 1
+
+    parse = m.summary()['latency']['parse']
+    assert parse['count'] == 1
+    assert round(parse['total_ms']) == 30
+
+
+def test_emit(capsys):
+    """ Test that metrics are printed in the embedded metric format """
+    m = metrics.Metrics({'Handler': 'service'})
+    m.incr('records_updated', 2)
+    m.timing('GET studies', 12)
+
+    m.emit()
+    doc = json.loads(capsys.readouterr().out)
+    assert doc['Handler'] == 'service'
+    assert doc['records_updated'] == 2
+    assert doc['GET studies p99'] == 12
+    definition = doc['_aws']['CloudWatchMetrics'][0]
+    assert definition['Dimensions'] == [['Handler']]
+    assert {'Name': 'records_updated', 'Unit': 'Count'} in \
+        definition['Metrics']
+
+
+def test_endpoint():
+    """ Test that requests are named by endpoint without kf_ids """
+    assert metrics.endpoint('patch', 'http://ds/biospecimens/BS_HFY3Y3XM') \
+        == 'PATCH biospecimens'
+    assert metrics.endpoint(
+        'get', 'http://ds/genomic-files?biospecimen_id=BS_HFY3Y3XM') \
+        == 'GET genomic-files'
+
+
+def test_add_summary():
+    """ Test that the metrics of several runs can be totalled """
+    runs = []
+    for latencies in [[1, 20], [40, 700]]:
+        m = metrics.Metrics()
+        m.incr('records_updated', len(latencies))
+        for ms in latencies:
+            m.timing('record', ms)
+        runs.append(m.summary())
+
+    total = metrics.Metrics()
+    for run in runs:
+        total.add_summary(run)
+
+    summary = total.summary()
+    assert summary['counts'] == {'records_updated': 4}
+    assert summary['latency']['record']['count'] == 4
+    assert summary['latency']['record']['max_ms'] == 700
+    assert summary['latency']['record']['buckets'] == {'5': 1, '25': 1,
+                                                       '50': 1, '1000': 1}
@@ -2,8 +2,10 @@ import service
 import os
 import pytest
 from moto import mock_s3
-from mock import patch, MagicMock
+from mock import patch, MagicMock, ANY
+from dataservice import CircuitOpenException, DeadlineException
 import json
+import time
 
 STUDY = None
 
@@ -24,8 +26,8 @@ def event():
 def test_create(event):
     """ Test that the lamba calls the dataservice """
     os.environ['DATASERVICE'] = 'http://api.com/'
-    mock = patch('service.requests')
-    req = mock.start()
+    mock = patch('dataservice.requests')
+    req = mock.start().Session()
 
     class Context:
         def get_remaining_time_in_millis(self):
@@ -111,14 +113,21 @@ def test_create(event):
     req.patch.return_value = mock_resp
     res = service.handler(event, Context())
 
-    assert len(res) == 1
+    assert res['remaining'] == 0
+    assert len(res['results']) == 1
+    assert res['results'][0]['sample_id'] == 'PA2645'
+    assert res['results'][0]['status'] == 'updated'
+    metrics = res['metrics']
+    assert metrics['counts']['records_updated'] == 1
+    assert metrics['latency']['GET studies']['count'] == 1
+    assert metrics['latency']['PATCH biospecimens']['count'] == 1
 
 @mock_s3
 def test_out_of_time(event):
     """ Test that a function is re-invoked when records remain """
     os.environ['DATASERVICE_API'] = 'http://api.com/'
-    mock_r = patch('service.requests')
-    req = mock_r.start()
+    mock_r = patch('dataservice.requests')
+    req = mock_r.start().Session()
 
     class Context:
         def __init__(self):
@@ -147,15 +156,15 @@ def test_get_biospecimen_id(event):
     """ Test that the consent code is upadted for biospecimen """
     os.environ['DATASERVICE_API'] = 'http://api.com/'
 
-    mock = patch('service.requests')
-    req = mock.start()
+    mock = patch('dataservice.requests')
+    req = mock.start().Session()
 
     class Context:
         def __init__(self):
             self.invoked_function_arn = 'arn:aws:lambda:::function:kf-lambda'
 
         def get_remaining_time_in_millis(self):
-            return 300
+            return 300000
 
     def mock_get(url, *args, **kwargs):
         if '/biospecimens' in url:
@@ -191,15 +200,15 @@ def test_update_consent_code(event):
     """ Test that the consent code is upadted for biospecimen """
     os.environ['DATASERVICE_API'] = 'http://api.com/'
 
-    mock = patch('service.requests')
-    req = mock.start()
+    mock = patch('dataservice.requests')
+    req = mock.start().Session()
 
     class Context:
         def __init__(self):
             self.invoked_function_arn = 'arn:aws:lambda:::function:kf-lambda'
 
         def get_remaining_time_in_millis(self):
-            return 300
+            return 300000
 
     def mock_get(url, *args, **kwargs):
         if '/biospecimens/' in url:
@@ -234,3 +243,1079 @@ def test_update_consent_code(event):
     # Should patch biospecimen once
     assert req.patch.call_count == 1
     mock.stop()
+
+
+def test_concurrent_records(event):
+    """ Test that every record gets its own result when run concurrently """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+
+    class Context:
+        def get_remaining_time_in_millis(self):
+            return 300000
+
+    event['Records'] = [{'study': {'dbgap_id': 'phs001168',
+                                   'sample_id': str(i),
+                                   'consent_code': '1',
+                                   'consent_short_name': 'IRB'}}
+                        for i in range(20)]
+
+    def update_acl(record):
+        sample = int(record.sample_id)
+        if sample % 5 == 0:
+            raise service.DataserviceException(f'missing {sample}')
+        return sample % 2 == 0
+
+    with patch('service.AclUpdater.update_acl', side_effect=update_acl):
+        res = service.handler(event, Context())
+
+    assert res['remaining'] == 0
+    results = {r['sample_id']: r for r in res['results']}
+    assert len(results) == 20
+    assert results['2']['status'] == 'updated'
+    assert results['3']['status'] == 'failed'
+    assert results['5']['status'] == 'failed'
+    assert results['5']['error'] == 'missing 5'
+
+
+def test_prefetch_biospecimens():
+    """ Test that a study's biospecimens are loaded once for a batch """
+    mock = patch('dataservice.requests')
+    req = mock.start().Session()
+
+    class Context:
+        def get_remaining_time_in_millis(self):
+            return 300000
+
+    def bs(i, external_id):
+        return {'kf_id': f'BS_{i}', 'external_sample_id': external_id,
+                'dbgap_consent_code': None, 'consent_type': None,
+                'visible': True}
+
+    def mock_get(url, *args, **kwargs):
+        resp = MagicMock()
+        resp.status_code = 200
+        if '/biospecimens' in url and 'after' not in url:
+            resp.json.return_value = {
+                'results': [bs(1, 'S1'), bs(2, 'S2')],
+                '_links': {'next': '/biospecimens?study_id=SD_1&after=2'}}
+        elif '/biospecimens' in url:
+            resp.json.return_value = {
+                'results': [bs(3, 'S3'), bs(4, 'S2')],
+                '_links': {}}
+        return resp
+
+    req.get.side_effect = mock_get
+
+    updater = service.AclUpdater('http://api.com', Context(), prefetch=True)
+    assert updater.get_biospecimen_kf_id('S1', 'SD_1') == ('BS_1', None,
+                                                           None, True)
+    assert updater.get_biospecimen_kf_id('S3', 'SD_1')[0] == 'BS_3'
+    with pytest.raises(service.DataserviceException) as err:
+        updater.get_biospecimen_kf_id('S2', 'SD_1')
+    assert 'Multiple biospecimens found' in str(err.value)
+    with pytest.raises(service.DataserviceException) as err:
+        updater.get_biospecimen_kf_id('S4', 'SD_1')
+    assert 'No biospecimen found' in str(err.value)
+
+    # Both pages were only requested once
+    assert req.get.call_count == 2
+    assert updater.duplicates == {'SD_1': {'S2'}}
+    mock.stop()
+
+
+def test_acl_changes():
+    """ Test that only genomic files with a different acl are changed """
+    acl = ['phs001168.c1', 'phs001168', 'SD_9PYZAHHE']
+    gfs = [
+        {'kf_id': 'GF_1', 'visible': True, 'acl': list(acl)},
+        {'kf_id': 'GF_2', 'visible': True, 'acl': list(reversed(acl))},
+        {'kf_id': 'GF_3', 'visible': True, 'acl': []},
+        {'kf_id': 'GF_4', 'visible': False, 'acl': list(acl)},
+        {'kf_id': 'GF_5', 'visible': False, 'acl': []},
+        {'kf_id': 'GF_6', 'visible': True, 'acl': None},
+    ]
+    assert service.acl_changes(gfs, acl) == [
+        ('GF_3', {'acl': acl}),
+        ('GF_4', {'acl': []}),
+        ('GF_6', {'acl': acl}),
+    ]
+
+
+def test_prefetch_genomic_files():
+    """ Test that acls are compared against a study's prefetched files """
+    mock = patch('dataservice.requests')
+    req = mock.start().Session()
+
+    class Context:
+        def get_remaining_time_in_millis(self):
+            return 300000
+
+    acl = ['phs001168.c1', 'phs001168', 'SD_1']
+
+    def mock_get(url, *args, **kwargs):
+        resp = MagicMock()
+        resp.status_code = 200
+        if '/biospecimen-genomic-files' in url:
+            resp.json.return_value = {'results': [
+                {'biospecimen_id': 'BS_1', 'genomic_file_id': 'GF_1'},
+                {'biospecimen_id': 'BS_1', 'genomic_file_id': 'GF_2'},
+                {'biospecimen_id': 'BS_2', 'genomic_file_id': 'GF_2'},
+                {'biospecimen_id': 'BS_2', 'genomic_file_id': 'GF_3'}]}
+        elif '/genomic-files' in url:
+            resp.json.return_value = {'results': [
+                {'kf_id': 'GF_1', 'acl': acl, 'visible': True},
+                {'kf_id': 'GF_2', 'acl': [], 'visible': True},
+                {'kf_id': 'GF_3', 'acl': acl, 'visible': True}]}
+        return resp
+
+    req.get.side_effect = mock_get
+    req.patch.return_value = MagicMock(status_code=200)
+
+    updater = service.AclUpdater('http://api.com', Context(), prefetch=True)
+    assert updater.update_acl_genomic_file({'acl': acl}, 'BS_1', 'SD_1')
+    assert updater.update_acl_genomic_file({'acl': acl}, 'BS_2', 'SD_1')
+
+    # GF_2 was the only file with a different acl and is shared by both
+    assert req.patch.call_count == 1
+    req.patch.assert_called_with('http://api.com/genomic-files/GF_2',
+                                 json={'acl': acl}, timeout=ANY)
+    assert req.get.call_count == 2
+    counts = updater.metrics.summary()['counts']
+    assert counts['genomic_file_patches_avoided'] == 3
+
+    with pytest.raises(service.DataserviceException) as err:
+        updater.update_acl_genomic_file({'acl': acl}, 'BS_3', 'SD_1')
+    assert 'No associated genomic-files found' in str(err.value)
+    mock.stop()
+
+
+def test_worth_prefetching():
+    """ Test that studies are only prefetched if that is expected to be
+    quicker than looking up each record """
+    study = {'dbgap_id': 'phs001168', 'kf_id': 'SD_1', 'version': 'v1.p1'}
+    records = [service.Record(study, f'S{i}', '1', 'GRU', 0)
+               for i in range(100)]
+    client = service.get_client('http://api.com')
+
+    def worth(biospecimens):
+        # Each biospecimen has two genomic files
+        def mock_get(url, **kwargs):
+            total = biospecimens * (1 if '/biospecimens' in url else 2)
+            resp = MagicMock(status_code=200)
+            resp.json.return_value = {'results': [], 'total': total}
+            return resp
+
+        with patch.object(client, 'get', side_effect=mock_get) as get, \
+                patch('service.WORKERS', 8):
+            worth = service.worth_prefetching(client, records,
+                                              DeadlineContext(300000))
+        assert get.call_count == 3
+        get.assert_any_call('/biospecimens?study_id=SD_1&limit=1',
+                            deadline=ANY, metrics=None)
+        return worth
+
+    # 100 records are looked up in 25 requests by each of 8 workers, and the
+    # longest listing is the genomic files
+    assert worth(100)
+    assert worth(1200)
+    assert not worth(1250)
+    # Small batches and records without a study kf_id are never prefetched
+    assert not service.worth_prefetching(
+        client, records[:service.PREFETCH_MIN_RECORDS-1], None)
+    records[0] = records[0]._replace(study={'dbgap_id': 'phs001168'})
+    assert not service.worth_prefetching(client, records, None)
+
+
+def test_study_from_event(event):
+    """ Test that a study resolved by the invoker is not looked up again """
+    class Context:
+        def get_remaining_time_in_millis(self):
+            return 300000
+
+    record = event['Records'][0]
+    record['study']['kf_id'] = 'SD_9PYZAHHE'
+    record['study']['version'] = 'v1.p1'
+    updater = service.AclUpdater('http://api.com', Context())
+    with patch.object(updater, 'get_study_kf_id') as get_study, \
+            patch.object(updater, 'get_biospecimen_kf_id',
+                         return_value=(None, None, None, None)) as get_bs:
+        updater.update_acl(record)
+
+    assert get_study.call_count == 0
+    get_bs.assert_called_with(external_sample_id='PA2645',
+                              study_id='SD_9PYZAHHE')
+    assert service.STUDIES.get('phs001168') == ('SD_9PYZAHHE', 'v1.p1')
+
+
+def test_batch_event():
+    """ Test that a batch of samples from one study is processed """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+
+    class Context:
+        def get_remaining_time_in_millis(self):
+            return 300000
+
+    batch = {
+        'study': {'dbgap_id': 'phs001168', 'kf_id': 'SD_9PYZAHHE',
+                  'version': 'v1.p1', 'accession': 'phs001168.v1.p1'},
+        'samples': [['PA2645', '1', 'IRB'], ['PA2646', '2', 'GRU']]
+    }
+
+    with patch('service.AclUpdater.update_acl', return_value=True) as upd:
+        res = service.handler(batch, Context())
+
+    assert sorted(r['sample_id'] for r in res['results']) == ['PA2645',
+                                                              'PA2646']
+    records = [c[0][0] for c in upd.call_args_list]
+    assert service.Record(batch['study'], 'PA2646', '2', 'GRU',
+                          0) in records
+
+
+def test_batch_event_out_of_time():
+    """ Test that remaining samples of a batch are sent as a batch """
+    class Context:
+        def __init__(self):
+            self.invoked_function_arn = 'arn:aws:lambda:::function:kf-lambda'
+
+        def get_remaining_time_in_millis(self):
+            return 300
+
+    batch = {
+        'study': {'dbgap_id': 'phs001168', 'kf_id': 'SD_9PYZAHHE',
+                  'version': 'v1.p1', 'accession': 'phs001168.v1.p1'},
+        'samples': [['PA2645', '1', 'IRB'], ['PA2646', '2', 'GRU']]
+    }
+
+    with patch('service.boto3.client') as mock:
+        res = service.handler(batch, Context())
+
+    assert res['remaining'] == 2
+    _, args = mock().invoke.call_args_list[0]
+    payload = json.loads(args['Payload'].decode('utf-8'))
+    assert payload['study'] == batch['study']
+    assert sorted(payload['samples']) == batch['samples']
+
+
+def test_removed_sample(event):
+    """ Test that a sample removed from dbgap loses its consent and acls """
+    class Context:
+        def get_remaining_time_in_millis(self):
+            return 300000
+
+    record = event['Records'][0]
+    record['study'].update({'kf_id': 'SD_9PYZAHHE', 'version': 'v1.p1',
+                            'consent_code': None,
+                            'consent_short_name': None})
+    updater = service.AclUpdater('http://api.com', Context())
+    bs = ('BS_HFY3Y3XM', 'phs001168.c1', 'GRU', True)
+    with patch.object(updater, 'get_biospecimen_kf_id', return_value=bs), \
+            patch.object(updater, 'update_dbgap_consent_code') as upd_bs, \
+            patch.object(updater, 'update_acl_genomic_file') as upd_gf:
+        assert updater.update_acl(record)
+
+    upd_bs.assert_called_with(biospecimen_id='BS_HFY3Y3XM',
+                              consent_code=None, consent_short_name=None)
+    upd_gf.assert_called_with(biospecimen_id='BS_HFY3Y3XM', gf={'acl': []},
+                              study_id='SD_9PYZAHHE')
+
+
+class DeadlineContext:
+    """ A lambda context with a set amount of time remaining """
+
+    def __init__(self, remaining):
+        self.invoked_function_arn = 'arn:aws:lambda:::function:kf-lambda'
+        self.remaining = remaining
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining
+
+
+def test_request_deadline():
+    """ Test that requests must finish before the reserved time """
+    with patch('service.time.monotonic', return_value=100):
+        assert service.request_deadline(DeadlineContext(300000)) == 395
+        assert service.request_deadline(DeadlineContext(15000)) == 110
+        assert service.request_deadline(DeadlineContext(300)) == 95.3
+
+
+def test_scheduler():
+    """ Test that records are only started if they are expected to finish """
+    context = DeadlineContext(60000)
+    scheduler = service.Scheduler(context, 4)
+    assert scheduler.can_start()
+    assert scheduler.split(list(range(10))) == [list(range(10))]
+
+    for latency in [1000] * 10:
+        scheduler.record(latency)
+    assert scheduler.average == 1000
+    assert scheduler.percentile(0.95) == 1000
+
+    # 54 seconds are usable after the reserve and one record's latency,
+    # enough for 54 records on each of 4 workers
+    assert scheduler.capacity() == 216
+    chunks = scheduler.split(list(range(500)))
+    assert [len(c) for c in chunks] == [216, 216, 68]
+
+    context.remaining = 7000
+    assert scheduler.can_start()
+    context.remaining = 5500
+    assert not scheduler.can_start()
+
+    # Slow records are still split into no more than MAX_CONTINUATIONS
+    for latency in [60000] * 10:
+        scheduler.record(latency)
+    assert scheduler.capacity() == 1
+    with patch('service.MAX_CONTINUATIONS', 4):
+        chunks = scheduler.split(list(range(10)))
+    assert [len(c) for c in chunks] == [3, 3, 3, 1]
+
+
+def test_out_of_time_split(event):
+    """ Test that remaining records are split between new functions """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    context = DeadlineContext(300000)
+    event['Records'] = [{'study': {'dbgap_id': 'phs001168',
+                                   'sample_id': str(i),
+                                   'consent_code': '1',
+                                   'consent_short_name': 'IRB'}}
+                        for i in range(100)]
+
+    def update_acl(record):
+        # Run out of time once a few records have been processed
+        context.remaining -= 60000
+        return True
+
+    with patch('service.WORKERS', 1), \
+            patch('service.AclUpdater.update_acl', side_effect=update_acl), \
+            patch('service.time.time', side_effect=range(0, 1000, 10)), \
+            patch('service.boto3.client') as mock:
+        res = service.handler(event, context)
+
+    assert len(res['results']) == 5
+    assert res['remaining'] == 95
+    # Each record took 10 seconds so a new function can finish 28 records
+    # in its 300 second budget
+    assert res['continuations'] == 4
+    assert mock().invoke.call_count == 4
+    sizes = [len(json.loads(c[1]['Payload'])['Records'])
+             for c in mock().invoke.call_args_list]
+    assert sorted(sizes) == [11, 28, 28, 28]
+
+
+def test_circuit_open(event):
+    """ Test that records are passed on if the dataservice does not recover """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    context = DeadlineContext(300000)
+    event['Records'] = [{'study': {'dbgap_id': 'phs001168',
+                                   'sample_id': str(i),
+                                   'consent_code': '1',
+                                   'consent_short_name': 'IRB'}}
+                        for i in range(10)]
+
+    def update_acl(record):
+        client = service.get_client('http://api.com/')
+        client.breaker.opened_at = time.time()
+        raise CircuitOpenException('open')
+
+    def sleep(seconds):
+        context.remaining -= 100000
+
+    with patch('service.WORKERS', 1), \
+            patch('service.AclUpdater.update_acl', side_effect=update_acl), \
+            patch('service.time.sleep', side_effect=sleep), \
+            patch('service.boto3.client') as mock:
+        res = service.handler(event, context)
+
+    assert res['circuit_open']
+    assert res['results'] == []
+    assert res['remaining'] == 10
+    payload = json.loads(mock().invoke.call_args[1]['Payload'])
+    assert len(payload['Records']) == 10
+    # Records that were never tried do not use up an attempt
+    assert all('attempts' not in r for r in payload['Records'])
+
+
+def test_request_deadline_passed_on(event):
+    """ Test that records whose requests run out of time are passed on
+    without using up an attempt """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    context = DeadlineContext(300000)
+    event['Records'] = failing_records(3)
+
+    def update_acl(record):
+        if record.sample_id == '0':
+            return True
+        # The dataservice hangs until the function is about to time out
+        context.remaining = 5500
+        raise DeadlineException('no time left')
+
+    with patch('service.WORKERS', 1), \
+            patch('service.AclUpdater.update_acl', side_effect=update_acl), \
+            patch('service.boto3.client') as mock:
+        res = service.handler(event, context)
+
+    assert [r['sample_id'] for r in res['results']] == ['0']
+    assert res['remaining'] == 2
+    payload = json.loads(mock().invoke.call_args[1]['Payload'])
+    assert sorted(r['study']['sample_id'] for r in payload['Records']) == [
+        '1', '2']
+    assert all('attempts' not in r for r in payload['Records'])
+
+
+def failing_records(n):
+    return [{'study': {'dbgap_id': 'phs001168', 'sample_id': str(i),
+                       'consent_code': '1', 'consent_short_name': 'IRB'}}
+            for i in range(n)]
+
+
+def test_record_retried(event):
+    """ Test that a record is retried after an unexpected error """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    event['Records'] = failing_records(5)
+    failed = set()
+
+    def update_acl(record):
+        sample = record.sample_id
+        if sample == '2' and sample not in failed:
+            failed.add(sample)
+            raise service.TimeoutException()
+        return True
+
+    with patch('service.RECORD_RETRY_DELAY', 0), \
+            patch('service.AclUpdater.update_acl',
+                  side_effect=update_acl) as upd:
+        res = service.handler(event, DeadlineContext(300000))
+
+    assert upd.call_count == 6
+    assert all(r['status'] == 'updated' for r in res['results'])
+    assert len(res['results']) == 5
+    assert 'dead_letters' not in res
+
+
+def test_dead_letter_file(event, tmpdir):
+    """ Test that a record is sent to the dead letter file once it has failed
+    too many times """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    path = str(tmpdir.join('dead_letters.jsonl'))
+    event['Records'] = failing_records(5)
+    calls = []
+
+    def update_acl(record):
+        calls.append(record.sample_id)
+        if record.sample_id == '3':
+            raise ValueError('bad record')
+        return True
+
+    with patch.dict(os.environ, {'DEAD_LETTER_FILE': path}), \
+            patch('service.RECORD_RETRY_DELAY', 0), \
+            patch('service.AclUpdater.update_acl', side_effect=update_acl):
+        res = service.handler(event, DeadlineContext(300000))
+
+    assert calls.count('3') == service.MAX_ATTEMPTS
+    # The failing record was retried after the others were tried
+    assert calls[1-service.MAX_ATTEMPTS:] == ['3'] * (service.MAX_ATTEMPTS-1)
+    results = {r['sample_id']: r for r in res['results']}
+    assert results['3']['status'] == 'dead_letter'
+    assert results['3']['error'] == "ValueError('bad record')"
+    assert results['0']['status'] == 'updated'
+    assert res['dead_letters'] == 1
+    with open(path) as f:
+        letters = [json.loads(line) for line in f]
+    assert len(letters) == 1
+    assert letters[0]['record']['study']['sample_id'] == '3'
+    assert letters[0]['record']['attempts'] == service.MAX_ATTEMPTS
+
+
+def test_reinvoke_throttled(tmpdir):
+    """ Test that throttled continuations are retried and continuations that
+    can't be invoked are sent to the dead letter output """
+    from botocore.exceptions import ClientError
+    throttled = ClientError({'Error': {'Code': 'TooManyRequestsException'}},
+                            'Invoke')
+    events = [{'Records': [{'n': 1}]}, {'Records': [{'n': 2}]}]
+    path = str(tmpdir.join('dead_letters.jsonl'))
+
+    def invoke(FunctionName, InvocationType, Payload):
+        if json.loads(Payload) == events[0] and lam.invoke.call_count < 3:
+            raise throttled
+        if json.loads(Payload) == events[1]:
+            raise ValueError('denied')
+        return {'StatusCode': 202}
+
+    with patch.dict(os.environ, {'DEAD_LETTER_FILE': path}), \
+            patch('service.boto3.client') as mock, \
+            patch('invocations.time.sleep'):
+        lam = mock()
+        lam.invoke.side_effect = invoke
+        failed = service.reinvoke(DeadlineContext(300000), events)
+
+    assert failed == 1
+    assert lam.invoke.call_count == 4
+    with open(path) as f:
+        letters = [json.loads(line) for line in f]
+    assert letters == [{'event': events[1], 'error': 'denied'}]
+
+
+def test_dead_letter_queue():
+    """ Test that dead letters are sent to SQS in batches of 10 """
+    letters = [{'record': r, 'error': 'error'} for r in failing_records(15)]
+    with patch.dict(os.environ, {'DEAD_LETTER_QUEUE': 'https://sqs/dlq'}), \
+            patch('service.boto3.client') as mock:
+        service.send_dead_letters(letters)
+
+    calls = mock().send_message_batch.call_args_list
+    assert [len(c[1]['Entries']) for c in calls] == [10, 5]
+    assert calls[0][1]['QueueUrl'] == 'https://sqs/dlq'
+    assert json.loads(calls[1][1]['Entries'][0]['MessageBody']) == letters[10]
+
+
+def test_attempts_carried():
+    """ Test that attempts are passed on to new functions with the samples """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    context = DeadlineContext(300000)
+    batch = {
+        'study': {'dbgap_id': 'phs001168', 'kf_id': 'SD_9PYZAHHE',
+                  'version': 'v1.p1', 'accession': 'phs001168.v1.p1'},
+        'samples': [['PA2645', '1', 'IRB', 1], ['PA2646', '2', 'GRU']]
+    }
+    records = service.event_records(batch)
+    assert records[0].attempts == 1
+    assert records[1].attempts == 0
+
+    def update_acl(record):
+        # Runs out of time after the first record fails
+        context.remaining = 1000
+        raise service.TimeoutException()
+
+    with patch('service.WORKERS', 1), \
+            patch('service.AclUpdater.update_acl', side_effect=update_acl), \
+            patch('service.boto3.client') as mock:
+        res = service.handler(batch, context)
+
+    assert res['remaining'] == 2
+    payload = json.loads(mock().invoke.call_args[1]['Payload'])
+    # Only the first sample was tried before running out of time
+    assert sorted(payload['samples']) == [['PA2645', '1', 'IRB', 2],
+                                          ['PA2646', '2', 'GRU']]
+
+
+def test_encoded_event():
+    """ Test that a compressed batch is decoded and that its remaining
+    samples are passed on compressed """
+    batch = {
+        'study': {'dbgap_id': 'phs001168', 'kf_id': 'SD_9PYZAHHE',
+                  'version': 'v1.p1', 'accession': 'phs001168.v1.p1'},
+        'samples': [['PA2645', '1', 'IRB'], ['PA2646', '2', 'GRU']]
+    }
+    event = json.loads(service.encode_event(batch, compress=True))
+
+    with patch('service.AclUpdater.update_acl', return_value=True):
+        res = service.handler(event, DeadlineContext(300000))
+    assert sorted(r['sample_id'] for r in res['results']) == ['PA2645',
+                                                              'PA2646']
+
+    with patch('service.boto3.client') as mock:
+        res = service.handler(event, DeadlineContext(300))
+    assert res['remaining'] == 2
+    payload = json.loads(mock().invoke.call_args[1]['Payload'])
+    assert service.is_encoded(payload)
+    payload = service.decode_event(payload)
+    assert payload['study'] == batch['study']
+    assert sorted(payload['samples']) == batch['samples']
+
+
+def test_plan(event):
+    """ Test that changes are planned from bulk reads without updates """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    batch = {
+        'study': {'dbgap_id': 'phs001168', 'kf_id': 'SD_1',
+                  'version': 'v1.p1', 'accession': 'phs001168.v1.p1'},
+        'samples': [['S1', '1', 'GRU'], ['S2', '1', 'GRU'],
+                    ['S3', '1', 'GRU']],
+        'plan': True
+    }
+    acl = ['phs001168.c1', 'phs001168', 'SD_1']
+
+    def mock_get(url, *args, **kwargs):
+        resp = MagicMock(status_code=200)
+        if '/biospecimens' in url:
+            resp.json.return_value = {'results': [
+                {'kf_id': 'BS_1', 'external_sample_id': 'S1',
+                 'dbgap_consent_code': 'phs001168.c1', 'consent_type': 'GRU',
+                 'visible': True},
+                {'kf_id': 'BS_2', 'external_sample_id': 'S2',
+                 'dbgap_consent_code': None, 'consent_type': None,
+                 'visible': True}]}
+        elif '/biospecimen-genomic-files' in url:
+            resp.json.return_value = {'results': [
+                {'biospecimen_id': 'BS_1', 'genomic_file_id': 'GF_1'},
+                {'biospecimen_id': 'BS_2', 'genomic_file_id': 'GF_2'}]}
+        elif '/genomic-files' in url:
+            resp.json.return_value = {'results': [
+                {'kf_id': 'GF_1', 'acl': acl, 'visible': True},
+                {'kf_id': 'GF_2', 'acl': [], 'visible': True}]}
+        return resp
+
+    with patch('dataservice.requests') as req:
+        req.Session().get.side_effect = mock_get
+        res = service.handler(batch, DeadlineContext(300000))
+
+    assert req.Session().patch.call_count == 0
+    assert res['changes'] == {
+        'biospecimens': {'BS_2': {'dbgap_consent_code': 'phs001168.c1',
+                                  'consent_type': 'GRU'}},
+        'genomic-files': {'GF_2': {'acl': acl}}
+    }
+    results = {r['sample_id']: r['status'] for r in res['results']}
+    assert results == {'S1': 'updated', 'S2': 'updated', 'S3': 'failed'}
+
+
+def test_plan_out_of_time():
+    """ Test that samples that were not planned are returned instead of
+    being planned by new functions """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    batch = {
+        'study': {'dbgap_id': 'phs001168', 'kf_id': 'SD_1',
+                  'version': 'v1.p1', 'accession': 'phs001168.v1.p1'},
+        'samples': [['S1', '1', 'GRU'], ['S2', '1', 'GRU']],
+        'plan': True
+    }
+
+    with patch('service.boto3.client') as mock, \
+            patch('dataservice.requests'):
+        res = service.handler(batch, DeadlineContext(300))
+
+    assert mock().invoke.call_count == 0
+    assert res['remaining'] == 2
+    assert res['continuations'] == 0
+    assert res['unplanned'] == batch['samples']
+    assert res['changes'] == {'biospecimens': {}, 'genomic-files': {}}
+
+
+def test_apply_changes():
+    """ Test that a planned change set is applied """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    changes = {
+        'biospecimens': {'BS_2': {'dbgap_consent_code': 'phs001168.c1',
+                                  'consent_type': 'GRU'}},
+        'genomic-files': {'GF_2': {'acl': ['phs001168']},
+                          'GF_3': {'acl': []}}
+    }
+
+    def mock_patch(url, *args, **kwargs):
+        # No bulk updates
+        if url.endswith('biospecimens') or url.endswith('genomic-files'):
+            return MagicMock(status_code=405)
+        return MagicMock(status_code=404 if url.endswith('GF_3') else 200,
+                         content='not found')
+
+    with patch('dataservice.requests') as req, \
+            patch('service.boto3.client') as mock:
+        req.Session().patch.side_effect = mock_patch
+        res = service.handler({'changes': changes}, DeadlineContext(300000))
+
+    req.Session().patch.assert_any_call(
+        'http://api.com//biospecimens/BS_2',
+        json=changes['biospecimens']['BS_2'], timeout=ANY)
+    results = {r['kf_id']: r for r in res['results']}
+    assert results['BS_2']['status'] == 'updated'
+    assert results['GF_2']['status'] == 'updated'
+    assert results['GF_3']['status'] == 'failed'
+    assert results['GF_3']['error'] == '404: not found'
+    assert res['remaining'] == 0
+    # Only the change that failed is tried again by a new function
+    assert res['retried'] == 1
+    payload = json.loads(mock().invoke.call_args[1]['Payload'])
+    assert payload == {'changes': {'genomic-files': {'GF_3': {'acl': []}}},
+                       'attempts': 1}
+
+
+def test_apply_changes_dead_letter(tmpdir):
+    """ Test that changes that failed too many times are sent to the dead
+    letter output """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    path = str(tmpdir.join('dead_letters.jsonl'))
+    changes = {'genomic-files': {'GF_1': {'acl': []}, 'GF_2': {'acl': []}}}
+
+    def mock_patch(url, json=None, **kwargs):
+        resp = MagicMock(status_code=207)
+        resp.json.return_value = {'errors': [
+            {'kf_id': 'GF_2', 'message': 'invalid acl'}]}
+        return resp
+
+    with patch.dict(os.environ, {'DEAD_LETTER_FILE': path}), \
+            patch('dataservice.requests') as req, \
+            patch('service.boto3.client') as mock:
+        req.Session().patch.side_effect = mock_patch
+        res = service.handler({'changes': changes,
+                               'attempts': service.MAX_ATTEMPTS - 1},
+                              DeadlineContext(300000))
+
+    assert mock().invoke.call_count == 0
+    results = {r['kf_id']: r['status'] for r in res['results']}
+    assert results == {'GF_1': 'updated', 'GF_2': 'dead_letter'}
+    assert res['dead_letters'] == 1
+    with open(path) as f:
+        letters = [json.loads(line) for line in f]
+    assert letters == [{
+        'changes': {'genomic-files': {'GF_2': {'acl': []}}},
+        'attempts': service.MAX_ATTEMPTS, 'error': 'invalid acl'}]
+
+
+def test_apply_changes_out_of_time():
+    """ Test that changes that were not started are passed on """
+    changes = {'genomic-files': {'GF_1': {'acl': []}, 'GF_2': {'acl': []}}}
+    with patch('service.boto3.client') as mock:
+        res = service.apply_changes({'changes': changes},
+                                    DeadlineContext(300), 'http://api.com')
+
+    assert res['remaining'] == 2
+    payload = json.loads(mock().invoke.call_args[1]['Payload'])
+    assert payload == {'changes': changes}
+
+
+def test_apply_changes_bulk():
+    """ Test that changes are sent in bulk and failures are per entity """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    changes = {'genomic-files': {f'GF_{i}': {'acl': []} for i in range(5)}}
+
+    def mock_patch(url, json=None, **kwargs):
+        resp = MagicMock(status_code=207)
+        resp.json.return_value = {'errors': [
+            {'kf_id': 'GF_3', 'message': 'invalid acl'}]} \
+            if 'GF_3' in [c['kf_id'] for c in json] else {}
+        return resp
+
+    with patch('service.BULK_CHUNK_SIZE', 2), \
+            patch('dataservice.requests') as req, \
+            patch('service.boto3.client'):
+        req.Session().patch.side_effect = mock_patch
+        res = service.handler({'changes': changes}, DeadlineContext(300000))
+
+    assert req.Session().patch.call_count == 3
+    req.Session().patch.assert_any_call(
+        'http://api.com//genomic-files',
+        json=[{'acl': [], 'kf_id': 'GF_0'}, {'acl': [], 'kf_id': 'GF_1'}],
+        timeout=ANY)
+    results = {r['kf_id']: r for r in res['results']}
+    assert len(results) == 5
+    assert results['GF_3'] == {'entity': 'genomic-files', 'kf_id': 'GF_3',
+                               'status': 'failed', 'error': 'invalid acl'}
+    assert results['GF_2']['status'] == 'updated'
+
+
+def bulk_batch():
+    """ Returns a batch of samples that is large enough to be sent in bulk,
+    and a mock dataservice GET for the study of the batch """
+    samples = [[f'S{i}', '1', 'GRU'] for i in range(service.BULK_CHUNK_SIZE)]
+    batch = {
+        'study': {'dbgap_id': 'phs001168', 'kf_id': 'SD_1',
+                  'version': 'v1.p1', 'accession': 'phs001168.v1.p1'},
+        'samples': samples
+    }
+
+    def mock_get(url, *args, **kwargs):
+        resp = MagicMock(status_code=200)
+        if '/biospecimens' in url:
+            resp.json.return_value = {'results': [
+                {'kf_id': f'BS_{s[0]}', 'external_sample_id': s[0],
+                 'dbgap_consent_code': None, 'consent_type': None,
+                 'visible': True} for s in samples]}
+        elif '/biospecimen-genomic-files' in url:
+            resp.json.return_value = {'results': [
+                {'biospecimen_id': f'BS_{s[0]}',
+                 'genomic_file_id': f'GF_{s[0]}'}
+                for s in samples]}
+        elif '/genomic-files' in url:
+            resp.json.return_value = {'results': [
+                {'kf_id': f'GF_{s[0]}', 'acl': [], 'visible': True}
+                for s in samples]}
+        return resp
+
+    return batch, mock_get
+
+
+def test_apply_changes_circuit_open():
+    """ Test that changes that were not sent because the circuit breaker
+    opened are sent once it closes """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    changes = {'genomic-files': {'GF_1': {'acl': []}, 'GF_2': {'acl': []}}}
+    sent = []
+    sleeps = []
+
+    def mock_patch(url, json=None, **kwargs):
+        sent.append(url)
+        if len(sent) == 1:
+            client.breaker.opened_at = time.time()
+            return MagicMock(status_code=503)
+        resp = MagicMock(status_code=200)
+        resp.json.return_value = {}
+        return resp
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) > 1:
+            client.breaker.opened_at = None
+
+    with patch('service.time.sleep', side_effect=sleep), \
+            patch('dataservice.requests') as req:
+        req.Session().patch.side_effect = mock_patch
+        client = service.get_client('http://api.com/')
+        res = service.handler({'changes': changes}, DeadlineContext(300000))
+
+    assert res['circuit_open']
+    assert len(sent) == 2
+    assert sorted(r['kf_id'] for r in res['results']) == ['GF_1', 'GF_2']
+    assert all(r['status'] == 'updated' for r in res['results'])
+    assert res['remaining'] == 0
+
+
+def test_bulk_records():
+    """ Test that the updates of a batch are sent together and only the
+    samples with failed updates are retried """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    batch, mock_get = bulk_batch()
+    samples = batch['samples']
+    sent = []
+
+    def mock_patch(url, json=None, **kwargs):
+        sent.append((url, [c['kf_id'] for c in json]))
+        resp = MagicMock(status_code=200)
+        # GF_S7 fails the first time it is sent
+        if 'GF_S7' in [c['kf_id'] for c in json] and len(sent) < 3:
+            resp.json.return_value = {'errors': [{'kf_id': 'GF_S7'}]}
+        else:
+            resp.json.return_value = {}
+        return resp
+
+    with patch('service.RECORD_RETRY_DELAY', 0), \
+            patch('dataservice.requests') as req:
+        req.Session().get.side_effect = mock_get
+        req.Session().patch.side_effect = mock_patch
+        res = service.handler(batch, DeadlineContext(300000))
+
+    assert [url for url, _ in sent[:2]] == ['http://api.com//biospecimens',
+                                            'http://api.com//genomic-files']
+    assert len(sent[0][1]) == len(samples)
+    # Only the file that failed is sent again
+    assert sent[2:] == [('http://api.com//genomic-files', ['GF_S7'])]
+    statuses = {r['sample_id']: r['status'] for r in res['results']}
+    assert len(statuses) == len(samples)
+    assert set(statuses.values()) == {'updated'}
+
+
+def test_bulk_records_circuit_open():
+    """ Test that records whose updates were not sent because the circuit
+    breaker opened are sent again without using up an attempt """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    batch, mock_get = bulk_batch()
+    sent = []
+    sleeps = []
+
+    def mock_patch(url, json=None, **kwargs):
+        sent.append(url)
+        if len(sent) == 1:
+            # The breaker opens while the first update is being sent
+            client.breaker.opened_at = time.time()
+            return MagicMock(status_code=503)
+        resp = MagicMock(status_code=200)
+        resp.json.return_value = {}
+        return resp
+
+    def sleep(seconds):
+        # The dataservice recovers after the retry of the first update
+        sleeps.append(seconds)
+        if len(sleeps) > 1:
+            client.breaker.opened_at = None
+
+    with patch('service.MAX_ATTEMPTS', 1), \
+            patch('service.time.sleep', side_effect=sleep), \
+            patch('dataservice.requests') as req:
+        req.Session().get.side_effect = mock_get
+        req.Session().patch.side_effect = mock_patch
+        client = service.get_client('http://api.com/')
+        res = service.handler(batch, DeadlineContext(300000))
+
+    assert res['circuit_open']
+    assert sent == ['http://api.com//biospecimens',
+                    'http://api.com//biospecimens',
+                    'http://api.com//genomic-files']
+    statuses = {r['sample_id']: r['status'] for r in res['results']}
+    assert len(statuses) == len(batch['samples'])
+    assert set(statuses.values()) == {'updated'}
+    assert 'dead_letters' not in res
+
+
+def test_flush_undo():
+    """ Test that only the prefetched genomic files whose update failed are
+    restored """
+    acl = ['phs001168.c1', 'phs001168', 'SD_1']
+    updater = service.AclUpdater('http://api.com', DeadlineContext(300000),
+                                 prefetch=True, bulk=True)
+    updater.genomic_files = {
+        'GF_AAAAAAAA': {'kf_id': 'GF_AAAAAAAA', 'acl': [], 'visible': True},
+        'GF_BBBBBBBB': {'kf_id': 'GF_BBBBBBBB', 'acl': [], 'visible': True}
+    }
+    updater.biospecimen_gfs['SD_1'] = {'BS_1': ['GF_AAAAAAAA',
+                                                'GF_BBBBBBBB']}
+    updater.current.sample_id = 'S1'
+    assert updater.update_acl_genomic_file({'acl': acl}, 'BS_1', 'SD_1')
+
+    with patch.object(updater.client, 'bulk_patch',
+                      return_value=({'GF_AAAAAAAA': 'invalid acl'}, [])):
+        failures, unsent = updater.flush()
+
+    assert failures == {'S1': 'GF_AAAAAAAA: invalid acl'}
+    assert unsent == set()
+    assert updater.genomic_files['GF_AAAAAAAA']['acl'] == []
+    assert updater.genomic_files['GF_BBBBBBBB']['acl'] == acl
+
+
+def test_flush_before_stopping(event):
+    """ Test that collected updates are sent when the function stops
+    starting records """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    event['Records'] = failing_records(10)
+
+    # Time runs out once the first record is done
+    with patch('service.WORKERS', 1), \
+            patch('service.worth_prefetching', return_value=True), \
+            patch('service.Scheduler.can_start',
+                  side_effect=[True] * 3 + [False] * 10), \
+            patch('service.AclUpdater.update_acl', return_value=True), \
+            patch('service.AclUpdater.flush',
+                  return_value=({}, set())) as flush, \
+            patch('service.boto3.client') as mock:
+        res = service.handler(event, DeadlineContext(300000))
+
+    assert flush.call_count == 1
+    assert [r['sample_id'] for r in res['results']] == ['0']
+    assert res['remaining'] == 9
+    payload = json.loads(mock().invoke.call_args[1]['Payload'])
+    assert len(payload['Records']) == 9
+
+
+def test_ledger(monkeypatch, tmpdir):
+    """ Test that records that were already applied are not looked up or
+    updated again """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    monkeypatch.setenv('LEDGER_PATH', str(tmpdir.join('ledger.db')))
+    batch = {
+        'study': {'dbgap_id': 'phs001168', 'kf_id': 'SD_1',
+                  'version': 'v1.p1', 'accession': 'phs001168.v1.p1'},
+        'samples': [['PA2645', '1', 'IRB'], ['PA2646', '2', 'GRU']]
+    }
+
+    def mock_get(url, *args, **kwargs):
+        resp = MagicMock(status_code=200)
+        if '/biospecimens' in url:
+            sample_id = url.split('external_sample_id=')[-1]
+            resp.json.return_value = {'results': [
+                {'kf_id': f'BS_{sample_id}', 'dbgap_consent_code': None,
+                 'consent_type': None, 'visible': True}]}
+        else:
+            resp.json.return_value = {'results': [
+                {'kf_id': 'GF_1', 'acl': [], 'visible': True}]}
+        return resp
+
+    with patch('dataservice.requests') as req:
+        req.Session().get.side_effect = mock_get
+        req.Session().patch.return_value = MagicMock(status_code=200)
+        res = service.handler(batch, DeadlineContext(300000))
+        assert {r['status'] for r in res['results']} == {'updated'}
+        requests = (req.Session().get.call_count +
+                    req.Session().patch.call_count)
+        assert requests == 8
+
+        # The same batch is delivered again
+        res = service.handler(batch, DeadlineContext(300000))
+        assert {r['status'] for r in res['results']} == {'already_applied'}
+        assert res['metrics']['counts']['ledger_skipped'] == 2
+        assert (req.Session().get.call_count +
+                req.Session().patch.call_count) == requests
+
+        # A sample's consent code changed since it was applied
+        batch['samples'][0][1] = '2'
+        res = service.handler(batch, DeadlineContext(300000))
+
+    statuses = {r['sample_id']: r['status'] for r in res['results']}
+    assert statuses == {'PA2645': 'updated', 'PA2646': 'already_applied'}
+
+    # A full sync updates every sample whatever the ledger holds
+    batch['study']['full_sync'] = True
+    with patch('dataservice.requests') as req:
+        req.Session().get.side_effect = mock_get
+        req.Session().patch.return_value = MagicMock(status_code=200)
+        res = service.handler(batch, DeadlineContext(300000))
+
+    assert {r['status'] for r in res['results']} == {'updated'}
+
+
+def test_save_failures(monkeypatch, tmpdir):
+    """ Test that the samples of a batch that used up their attempts are
+    saved so that the invoker sends them again, but not the samples that
+    would fail again """
+    os.environ['DATASERVICE'] = 'http://api.com/'
+    monkeypatch.setenv('STATE_DIR', str(tmpdir))
+    batch = {
+        'study': {'dbgap_id': 'phs001168', 'kf_id': 'SD_1',
+                  'version': 'v1.p1', 'accession': 'phs001168.v1.p1'},
+        'samples': [['S1', '1', 'GRU'], ['S2', '1', 'GRU'],
+                    ['S3', '1', 'GRU'], ['S4', '1', 'GRU']]
+    }
+
+    def update_acl(record):
+        if record.sample_id == 'S1':
+            return True
+        if record.sample_id == 'S2':
+            return 'Biospecimen does not exist'
+        if record.sample_id == 'S3':
+            raise service.DataserviceException('No biospecimen found')
+        raise service.TimeoutException()
+
+    with patch('service.RECORD_RETRY_DELAY', 0), \
+            patch('service.AclUpdater.update_acl', side_effect=update_acl):
+        service.handler(batch, DeadlineContext(300000))
+        service.handler(dict(batch, samples=batch['samples'][:1]),
+                        DeadlineContext(300000))
+
+    store = service.get_store()
+    keys = store.keys('failures/phs001168.v1.p1/')
+    assert len(keys) == 1
+    assert json.loads(store.get(keys[0]).decode('utf-8')) == ['S4']
+
+
+def test_process_records_retries():
+    """ Test that records are retried until they use up their attempts """
+    updater = MagicMock(bulk=False)
+    updater.client.breaker.is_open.return_value = False
+    tries = {}
+
+    def update_acl(record):
+        sample_id = record.sample_id
+        tries[sample_id] = tries.get(sample_id, 0) + 1
+        if sample_id == 'S1' and tries[sample_id] == 1:
+            raise ValueError('flaky')
+        if sample_id == 'S2':
+            raise ValueError('broken')
+        return True
+
+    updater.update_acl.side_effect = update_acl
+    records = [service.Record({'dbgap_id': 'phs001228'}, f'S{i}', '1', 'GRU',
+                              0)
+               for i in range(3)]
+    scheduler = service.Scheduler(MagicMock(spec=[
+        'get_remaining_time_in_millis']), 2)
+    with patch('service.RECORD_RETRY_DELAY', 0):
+        res = service.process_records(updater, records, scheduler,
+                                      workers=2)
+
+    statuses = {r['sample_id']: r['status'] for r in res['results']}
+    assert statuses == {'S0': 'updated', 'S1': 'updated',
+                        'S2': 'dead_letter'}
+    assert tries == {'S0': 1, 'S1': 2, 'S2': service.MAX_ATTEMPTS}
+    assert res['dead_letters'][0]['record']['attempts'] == \
+        service.MAX_ATTEMPTS
+    assert res['offset'] == 3
+    assert res['retried'] == []
+    assert updater.mark_applied.call_count == 2
@@ -0,0 +1,56 @@
+import boto3
+from moto import mock_s3
+import store
+
+
+def test_get_store(monkeypatch, tmpdir):
+    """ Test that the configured store is returned """
+    monkeypatch.delenv('STATE_BUCKET', raising=False)
+    monkeypatch.delenv('STATE_DIR', raising=False)
+    assert store.get_store() is None
+
+    monkeypatch.setenv('STATE_DIR', str(tmpdir))
+    assert isinstance(store.get_store(), store.LocalStore)
+
+    monkeypatch.setenv('STATE_BUCKET', 'kf-consent-state')
+    with mock_s3():
+        assert isinstance(store.get_store(), store.S3Store)
+
+
+def test_local_store(tmpdir):
+    """ Test that objects are written to and read from files """
+    local = store.LocalStore(str(tmpdir))
+    assert local.get('snapshots/phs001228.v1.p1.json.gz') is None
+
+    local.put('snapshots/phs001228.v1.p1.json.gz', b'one')
+    local.put('snapshots/phs001228.v1.p1.json.gz', b'two')
+    assert local.get('snapshots/phs001228.v1.p1.json.gz') == b'two'
+    assert tmpdir.join('snapshots').listdir() == [
+        tmpdir.join('snapshots', 'phs001228.v1.p1.json.gz')]
+
+    assert local.keys('snapshots/') == ['snapshots/phs001228.v1.p1.json.gz']
+    assert local.keys('failures/') == []
+
+    local.delete('snapshots/phs001228.v1.p1.json.gz')
+    local.delete('snapshots/phs001228.v1.p1.json.gz')
+    assert local.get('snapshots/phs001228.v1.p1.json.gz') is None
+
+
+@mock_s3
+def test_s3_store():
+    """ Test that objects are written to and read from a bucket """
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='kf-consent-state')
+
+    bucket = store.S3Store('kf-consent-state', 'state/')
+    assert bucket.get('snapshots/phs001228.v1.p1.json.gz') is None
+
+    bucket.put('snapshots/phs001228.v1.p1.json.gz', b'one')
+    assert bucket.get('snapshots/phs001228.v1.p1.json.gz') == b'one'
+    obj = s3.get_object(Bucket='kf-consent-state',
+                        Key='state/snapshots/phs001228.v1.p1.json.gz')
+    assert obj['Body'].read() == b'one'
+    assert bucket.keys('snapshots/') == ['snapshots/phs001228.v1.p1.json.gz']
+
+    bucket.delete('snapshots/phs001228.v1.p1.json.gz')
+    assert bucket.get('snapshots/phs001228.v1.p1.json.gz') is None